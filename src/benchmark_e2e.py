@@ -0,0 +1,169 @@
+import argparse
+import json
+import time
+from typing import *
+from response_parser import *
+from mock_openai_server import MockOpenAIServer, load_scenarios, DEFAULT_SCENARIOS_PATH
+
+PERCENTILES = (50, 90, 99)
+
+
+def get_percentile(sorted_values: List[float], percentile):
+    """ Percentile par interpolation linéaire entre les deux rangs les plus proches. """
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * percentile / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    sorted_values = sorted(values)
+    summary = {'count': len(values)}
+    for percentile in PERCENTILES:
+        summary[f'p{percentile}'] = get_percentile(sorted_values, percentile)
+    summary['mean'] = sum(values) / len(values) if values else None
+    summary['max'] = sorted_values[-1] if values else None
+    return summary
+
+
+class KernelTimer:
+    """ Mesure le temps d'aller-retour du noyau : de l'envoi du code à la dernière sortie reçue. """
+    def __init__(self, jupyter_kernel):
+        self.execute_code_stream = jupyter_kernel.execute_code_stream
+        self.durations = []
+        self.pending_duration = 0.0
+        jupyter_kernel.execute_code_stream = self
+
+    def __call__(self, code):
+        start_time = time.perf_counter()
+        try:
+            yield from self.execute_code_stream(code)
+        finally:
+            duration = time.perf_counter() - start_time
+            self.durations.append(duration)
+            self.pending_duration += duration
+
+    def pop_pending_duration(self):
+        duration, self.pending_duration = self.pending_duration, 0.0
+        return duration
+
+
+def run_turn(bot_backend: BotBackend, kernel_timer: KernelTimer, prompt, metrics: Dict[str, List[float]]):
+    """ Joue un tour complet : message de l'utilisateur puis requêtes successives jusqu'à la réponse finale. """
+    history = [[prompt, None]]
+    bot_backend.add_text_message(user_text=prompt)
+    turn_start_time = time.perf_counter()
+
+    while bot_backend.finish_reason in ('new_input', 'function_call'):
+        if history[-1][1]:
+            history.append([None, ""])
+        else:
+            history[-1][1] = ""
+
+        request_start_time = time.perf_counter()
+        response = chat_completion(bot_backend=bot_backend)
+        dispatcher = ChunkDispatcher(bot_backend=bot_backend)
+        first_chunk = True
+        for chunk in response:
+            if first_chunk:
+                metrics['time_to_first_token'].append(time.perf_counter() - request_start_time)
+                first_chunk = False
+            parse_start_time = time.perf_counter()
+            history, whether_exit = dispatcher.dispatch(chunk=chunk, history=history)
+            parse_duration = time.perf_counter() - parse_start_time
+            kernel_duration = kernel_timer.pop_pending_duration()
+            if kernel_duration:
+                metrics['kernel_round_trip'].append(kernel_duration)
+            metrics['parser_overhead_per_chunk'].append(parse_duration - kernel_duration)
+            if whether_exit:
+                raise RuntimeError(f'Réponse invalide: {bot_backend.function_args_str}')
+
+    metrics['turn_latency'].append(time.perf_counter() - turn_start_time)
+    return history
+
+
+def run_scenario(scenario_name, iterations, prompt, server: Optional[MockOpenAIServer]):
+    if server is not None:
+        server.default_scenario = scenario_name
+    metrics = {
+        'time_to_first_token': [],
+        'parser_overhead_per_chunk': [],
+        'kernel_round_trip': [],
+        'turn_latency': []
+    }
+    bot_backend = BotBackend()
+    kernel_timer = KernelTimer(bot_backend.jupyter_kernel)
+    try:
+        for _ in range(iterations):
+            run_turn(bot_backend, kernel_timer, prompt, metrics)
+            # Chaque itération repart d'une conversation vide pour rejouer le même scénario
+            bot_backend.restart()
+    finally:
+        bot_backend.jupyter_kernel.kernel_client.shutdown()
+    return {name: summarize(values) for name, values in metrics.items()}
+
+
+def format_seconds(value):
+    if value is None:
+        return '-'
+    if value < 0.001:
+        return f'{value * 1e6:.0f}µs'
+    if value < 1:
+        return f'{value * 1e3:.1f}ms'
+    return f'{value:.2f}s'
+
+
+def print_report(results: Dict[str, Dict[str, Dict]]):
+    columns = ['count'] + [f'p{percentile}' for percentile in PERCENTILES] + ['mean', 'max']
+    for scenario_name, metrics in results.items():
+        print(f'\n== {scenario_name}')
+        print(f'{"métrique":<28}' + ''.join(f'{column:>11}' for column in columns))
+        for metric_name, summary in metrics.items():
+            cells = [str(summary['count'])] + [format_seconds(summary[column]) for column in columns[1:]]
+            print(f'{metric_name:<28}' + ''.join(f'{cell:>11}' for cell in cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Mesure la latence de bout en bout (API simulée -> analyse des réponses -> noyau Jupyter)."
+    )
+    parser.add_argument("--scenarios", help="fichier JSON des scénarios", default=DEFAULT_SCENARIOS_PATH, type=str)
+    parser.add_argument("-s", "--scenario", help="scénario à exécuter (tous par défaut)", action='append', default=None)
+    parser.add_argument("-n", "--iterations", help="nombre de tours par scénario", default=5, type=int)
+    parser.add_argument("--time-scale", help="facteur appliqué aux latences simulées (0 : sans attente)",
+                        default=1.0, type=float)
+    parser.add_argument("--api-base", help="URL d'un serveur déjà démarré (sinon un serveur local est lancé)",
+                        default=None, type=str)
+    parser.add_argument("--prompt", default="Analyse ces données.", type=str)
+    parser.add_argument("-o", "--output", help="fichier JSON où écrire les résultats", default=None, type=str)
+    cli_args = parser.parse_args()
+
+    scenarios = load_scenarios(cli_args.scenarios)
+    server = None
+    if cli_args.api_base is None:
+        server = MockOpenAIServer(scenarios=scenarios, time_scale=cli_args.time_scale)
+        api_base = server.start()
+    else:
+        api_base = cli_args.api_base
+
+    # Toutes les requêtes vont au serveur simulé, sans passer par le cache de réponses
+    config['API_TYPE'] = 'open_ai'
+    config['API_base'] = api_base
+    config['API_VERSION'] = None
+    config['API_KEY'] = 'mock'
+    config['response_cache'] = {'mode': 'off'}
+
+    results = {}
+    try:
+        for scenario_name in cli_args.scenario or list(scenarios):
+            results[scenario_name] = run_scenario(scenario_name, cli_args.iterations, cli_args.prompt, server)
+    finally:
+        if server is not None:
+            server.stop()
+
+    print_report(results)
+    if cli_args.output:
+        with open(cli_args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,371 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import timeit
+import zlib
+from typing import *
+from response_parser import *
+from function_args_parser import StreamingCodeArgumentParser
+from notebook_serializer import NotebookLog
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baseline_hot_paths.json')
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_REPEAT = 5
+# Taille moyenne d'un delta d'arguments envoyé par l'API
+DELTA_SIZE = 4
+BENCHMARK_SESSION_ID = 'benchmark'
+
+CODE_TEMPLATE = '''df_{i} = pd.read_csv("data/part_{i}.csv", sep=";")
+df_{i}["ratio"] = df_{i}["value"] / df_{i}["total"].replace(0, 1)
+summary_{i} = df_{i}.groupby("category").agg({{"ratio": ["mean", "std"], "value": "sum"}})
+print(f"Partie {i} : {{len(df_{i})}} lignes, moyenne = {{summary_{i}['ratio']['mean'].mean():.3f}}")
+'''
+
+
+# ------------------------------------------------------------------ entrées synthétiques
+def make_code(size):
+    """ Code Python réaliste (guillemets, accolades, sauts de ligne) d'environ `size` caractères. """
+    lines, index = [], 0
+    while sum(len(line) for line in lines) < size:
+        lines.append(CODE_TEMPLATE.format(i=index))
+        index += 1
+    return ''.join(lines)[:size]
+
+
+def make_function_args(size):
+    return json.dumps({'code': make_code(size)})
+
+
+def split_into_deltas(text, delta_size=DELTA_SIZE):
+    return [text[index:index + delta_size] for index in range(0, len(text), delta_size)]
+
+
+def make_conversation(turns):
+    """ Conversation de `turns` tours : question, appel de fonction, sortie du code et analyse. """
+    conversation = [{'role': 'system', 'content': system_msg}]
+    for index in range(turns):
+        conversation.append({'role': 'user', 'content': f'Peux-tu analyser la partie {index} des données ?'})
+        conversation.append({'role': 'assistant', 'name': 'execute_code', 'content': make_function_args(600)})
+        conversation.append({
+            'role': 'function', 'name': 'execute_code',
+            'content': '\n'.join(f'{row} {row * 0.173:.4f} catégorie_{row % 7}' for row in range(12))
+        })
+        conversation.append({
+            'role': 'assistant',
+            'content': f'La partie {index} contient 12 lignes ; le ratio moyen est stable autour de 0,17.'
+        })
+    return conversation
+
+
+def make_png(width, height, seed):
+    """ PNG RGB valide, sans dépendance à PIL. """
+    rows = b''.join(
+        b'\x00' + bytes(((x * 7 + y * 3 + seed) % 256) for x in range(width * 3)) for y in range(height)
+    )
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def make_chunk(delta, finish_reason=None):
+    return {'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+
+class BenchmarkBackend(GPTResponseLog):
+    """
+    Backend réduit à l'état d'une réponse : suffisant pour ChoiceHandler tant qu'aucun code n'est exécuté,
+    sans démarrer de noyau Jupyter.
+    """
+    def __init__(self):
+        super().__init__()
+        self.jupyter_kernel = type('BenchmarkKernel', (), {'available_functions': {'execute_code': None, 'python': None}})
+        self.additional_tools = {}
+
+
+# ------------------------------------------------------------------ aiguillage historique
+class ChoiceHandler:
+    # Aiguillage historique, un ChoiceHandler et cinq stratégies par chunk, remplacé par ChunkDispatcher ; conservé
+    # ici comme référence des cas choice_handler.
+    strategies = [
+        RoleChoiceStrategy, ContentChoiceStrategy, NameFunctionCallChoiceStrategy,
+        ArgumentsFunctionCallChoiceStrategy, FinishReasonChoiceStrategy
+    ]
+
+    def __init__(self, choice):
+        self.choice = choice
+
+    def handle(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+        for Strategy in self.strategies:
+            strategy_instance = Strategy(choice=self.choice)
+            if not strategy_instance.support():
+                continue
+            history, whether_exit = strategy_instance.execute(
+                bot_backend=bot_backend,
+                history=history,
+                whether_exit=whether_exit
+            )
+        return history, whether_exit
+
+
+def parse_response(chunk, history: List, bot_backend: BotBackend):
+    """
+    :return: history, whether_exit
+    """
+    whether_exit = False
+    if chunk['choices']:
+        choice = chunk['choices'][0]
+        choice_handler = ChoiceHandler(choice=choice)
+        history, whether_exit = choice_handler.handle(
+            history=history,
+            bot_backend=bot_backend,
+            whether_exit=whether_exit
+        )
+
+    return history, whether_exit
+
+
+# ------------------------------------------------------------------ cas mesurés
+def bench_parse_json(size, finished):
+    function_args = make_function_args(size)
+    if not finished:
+        function_args = function_args[:int(len(function_args) * 0.9)]
+    return lambda: parse_json(function_args=function_args, finished=finished), 1, 'appel'
+
+
+def bench_function_args_parser(size):
+    deltas = split_into_deltas(make_function_args(size))
+    def run():
+        parser = StreamingCodeArgumentParser()
+        for delta in deltas:
+            parser.feed(delta)
+        parser.finish()
+    return run, len(deltas), 'chunk'
+
+
+def bench_conversation_slice(turns):
+    conversation = make_conversation(turns)
+    model = config['model']['GPT-3.5']['model_name']
+    ledger = TokenLedger(encoding_for_which_model=model, functions=functions)
+    for message in conversation:
+        ledger.append(message)
+    return lambda: get_conversation_slice(
+        conversation=conversation, model=model, token_ledger=ledger, functions=functions
+    ), 1, 'appel'
+
+
+def make_content_chunks(size):
+    return [make_chunk({'role': 'assistant', 'content': ''})] + \
+        [make_chunk({'content': delta}) for delta in split_into_deltas(make_code(size))]
+
+
+def make_function_call_chunks(size):
+    return [make_chunk({'role': 'assistant', 'content': None,
+                        'function_call': {'name': 'execute_code', 'arguments': ''}})] + \
+        [make_chunk({'function_call': {'arguments': delta}}) for delta in split_into_deltas(make_function_args(size))]
+
+
+def bench_choice_handler(chunks):
+    """ Aiguillage historique : un ChoiceHandler et ses stratégies créés pour chaque chunk. """
+    backend = BenchmarkBackend()
+    def run():
+        backend.reset_gpt_response_log_values()
+        history = [['question', '']]
+        for chunk in chunks:
+            history, _ = parse_response(chunk=chunk, history=history, bot_backend=backend)
+    return run, len(chunks), 'chunk'
+
+
+def bench_chunk_dispatcher(chunks, batch_size=None):
+    """ Même flux que les cas choice_handler, traité par un ChunkDispatcher (par lots de batch_size chunks). """
+    backend = BenchmarkBackend()
+    def run():
+        backend.reset_gpt_response_log_values()
+        history = [['question', '']]
+        dispatcher = ChunkDispatcher(bot_backend=backend)
+        if batch_size is None:
+            for chunk in chunks:
+                history, _ = dispatcher.dispatch(chunk=chunk, history=history)
+        else:
+            for index in range(0, len(chunks), batch_size):
+                history, _ = dispatcher.dispatch_batch(chunks[index:index + batch_size], history=history)
+    return run, len(chunks), 'chunk'
+
+
+def bench_code_execution_result(text_lines, images):
+    content_to_display = [('stdout', '\n'.join(f'ligne {index}: {index * 0.5}' for index in range(text_lines)))]
+    for index in range(images):
+        content_to_display.append(('display_png', base64.b64encode(make_png(64, 48, index)).decode('utf-8')))
+        content_to_display.append(('stdout', f'figure {index} enregistrée'))
+    def run():
+        add_code_execution_result_to_bot_history(
+            content_to_display=content_to_display, history=[], unique_id=BENCHMARK_SESSION_ID,
+            notebook_log=NotebookLog()
+        )
+    return run, 1, 'appel'
+
+
+def make_notebook_log(cells, image_path):
+    notebook_log = NotebookLog()
+    for index in range(cells):
+        notebook_log.add_markdown(f'Analyse de la partie {index}', title='User')
+        notebook_log.add_code_cell(make_code(400))
+        notebook_log.add_code_cell_output('\n'.join(f'{row} {row * 0.173:.4f}' for row in range(12)))
+        if index % 10 == 0:
+            notebook_log.add_image(image_path, 'image/png')
+    return notebook_log
+
+
+def bench_notebook(cells, export, work_dir):
+    image_path = os.path.join(work_dir, 'figure.png')
+    with open(image_path, 'wb') as f:
+        f.write(make_png(640, 480, 0))
+    notebook_log = make_notebook_log(cells, image_path)
+    if export:
+        notebook_path = os.path.join(work_dir, 'benchmark.ipynb')
+        return lambda: notebook_log.export(notebook_path), 1, 'appel'
+    return notebook_log.to_notebook, 1, 'appel'
+
+
+def get_benchmarks(work_dir) -> Dict[str, Callable]:
+    """ Fabriques des cas mesurés, par nom ; chaque fabrique retourne (fonction, opérations par appel, unité). """
+    benchmarks = {}
+    for size in (1000, 10000, 50000):
+        label = f'{size // 1000}k'
+        benchmarks[f'parse_json/partial_{label}'] = lambda size=size: bench_parse_json(size, finished=False)
+        benchmarks[f'parse_json/finished_{label}'] = lambda size=size: bench_parse_json(size, finished=True)
+        benchmarks[f'function_args_parser/stream_{label}'] = lambda size=size: bench_function_args_parser(size)
+        benchmarks[f'choice_handler/function_call_{label}'] = \
+            lambda size=size: bench_choice_handler(make_function_call_chunks(size))
+        benchmarks[f'chunk_dispatcher/function_call_{label}'] = \
+            lambda size=size: bench_chunk_dispatcher(make_function_call_chunks(size))
+        benchmarks[f'chunk_dispatcher/function_call_{label}_batch_16'] = \
+            lambda size=size: bench_chunk_dispatcher(make_function_call_chunks(size), batch_size=16)
+    benchmarks['choice_handler/content_2k'] = lambda: bench_choice_handler(make_content_chunks(2000))
+    benchmarks['chunk_dispatcher/content_2k'] = lambda: bench_chunk_dispatcher(make_content_chunks(2000))
+    benchmarks['chunk_dispatcher/content_2k_batch_16'] = \
+        lambda: bench_chunk_dispatcher(make_content_chunks(2000), batch_size=16)
+    for turns in (50, 200):
+        benchmarks[f'get_conversation_slice/{turns}_turns'] = lambda turns=turns: bench_conversation_slice(turns)
+    benchmarks['code_execution_result/text_2000_lines'] = lambda: bench_code_execution_result(2000, 0)
+    benchmarks['code_execution_result/48_images'] = lambda: bench_code_execution_result(20, 48)
+    benchmarks['notebook/to_notebook_200_cells'] = lambda: bench_notebook(200, export=False, work_dir=work_dir)
+    benchmarks['notebook/export_200_cells'] = lambda: bench_notebook(200, export=True, work_dir=work_dir)
+    return benchmarks
+
+
+# ------------------------------------------------------------------ exécution et comparaison
+def measure(function, operations, repeat=DEFAULT_REPEAT):
+    """ Temps par opération (min et médiane sur `repeat` séries d'au moins 0,2 s). """
+    timer = timeit.Timer(function)
+    loops, _ = timer.autorange()
+    timings = [duration / (loops * operations) for duration in timer.repeat(repeat=repeat, number=loops)]
+    return {'min': min(timings), 'median': statistics.median(timings), 'loops': loops, 'operations': operations}
+
+
+def run_benchmarks(name_filter=None, repeat=DEFAULT_REPEAT, verbose=True):
+    work_dir = tempfile.mkdtemp(prefix='benchmark_hot_paths_')
+    results = {}
+    try:
+        for name, factory in get_benchmarks(work_dir).items():
+            if name_filter and name_filter not in name:
+                continue
+            function, operations, unit = factory()
+            function()  # échauffement (caches, encodeur de tokens, images déjà écrites)
+            results[name] = dict(measure(function, operations, repeat=repeat), unit=unit)
+            if verbose:
+                print(f'{name:<45}{format_seconds(results[name]["median"]):>12} / {unit}')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        shutil.rmtree(f'cache/temp_{BENCHMARK_SESSION_ID}', ignore_errors=True)
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results
+    }
+
+
+def compare_results(baseline: Dict, current: Dict, threshold=DEFAULT_THRESHOLD):
+    """ Affiche l'écart de chaque cas par rapport à la référence et retourne la liste des régressions. """
+    regressions = []
+    print(f'{"cas":<45}{"référence":>12}{"actuel":>12}{"écart":>10}')
+    for name, result in current['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            print(f'{name:<45}{"-":>12}{format_seconds(result["median"]):>12}{"nouveau":>10}')
+            continue
+        ratio = result['median'] / reference['median'] - 1
+        status = ''
+        if ratio > threshold:
+            regressions.append(name)
+            status = '  RÉGRESSION'
+        print(f'{name:<45}{format_seconds(reference["median"]):>12}{format_seconds(result["median"]):>12}'
+              f'{ratio:>+10.1%}{status}')
+    return regressions
+
+
+def format_seconds(value):
+    if value < 1e-6:
+        return f'{value * 1e9:.0f}ns'
+    if value < 1e-3:
+        return f'{value * 1e6:.1f}µs'
+    if value < 1:
+        return f'{value * 1e3:.2f}ms'
+    return f'{value:.3f}s'
+
+
+def write_results(path, results):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mesures des chemins critiques (par chunk et par tour).")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="exécute les mesures")
+    run_parser.add_argument("-k", "--filter", help="n'exécute que les cas dont le nom contient ce texte", default=None)
+    run_parser.add_argument("-r", "--repeat", default=DEFAULT_REPEAT, type=int)
+    run_parser.add_argument("-o", "--output", help="fichier JSON des résultats", default=None)
+    run_parser.add_argument("--save-baseline", help=f"enregistre les résultats comme référence ({DEFAULT_BASELINE_PATH})",
+                            action='store_true')
+
+    compare_parser = subparsers.add_parser('compare', help="compare des résultats à la référence")
+    compare_parser.add_argument("-b", "--baseline", default=DEFAULT_BASELINE_PATH)
+    compare_parser.add_argument("-c", "--current", help="résultats à comparer (sinon les mesures sont exécutées)",
+                                default=None)
+    compare_parser.add_argument("-t", "--threshold", help="ralentissement toléré (0.2 = 20 %%)",
+                                default=DEFAULT_THRESHOLD, type=float)
+    compare_parser.add_argument("-k", "--filter", default=None)
+    compare_parser.add_argument("-r", "--repeat", default=DEFAULT_REPEAT, type=int)
+    cli_args = parser.parse_args()
+
+    if cli_args.command == 'run':
+        results = run_benchmarks(name_filter=cli_args.filter, repeat=cli_args.repeat)
+        if cli_args.output:
+            write_results(cli_args.output, results)
+        if cli_args.save_baseline:
+            write_results(DEFAULT_BASELINE_PATH, results)
+    else:
+        with open(cli_args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if cli_args.current:
+            with open(cli_args.current, 'r', encoding='utf-8') as f:
+                current = json.load(f)
+        else:
+            current = run_benchmarks(name_filter=cli_args.filter, repeat=cli_args.repeat, verbose=False)
+        regressions = compare_results(baseline, current, threshold=cli_args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} régression(s) au-delà de {cli_args.threshold:.0%} : {", ".join(regressions)}')
+            sys.exit(1)
+        print(f'\nAucune régression au-delà de {cli_args.threshold:.0%}.')
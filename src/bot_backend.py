@@ -1,10 +1,22 @@
 import json
 import copy
 import shutil
+import threading
+import time
 from jupyter_backend import *
 from tools import *
 from typing import *
-from notebook_serializer import add_markdown_to_notebook, add_code_cell_to_notebook
+from token_ledger import TokenLedger
+from function_args_parser import StreamingCodeArgumentParser
+from notebook_serializer import NotebookLog, get_session_notebook_path
+from tool_log import ToolLog, get_tool_log_writer
+from cache_manager import get_cache_manager
+from snapshot import get_snapshot_store, move_file
+from tracing import get_tracer
+from context_compactor import create_context_compactor
+from kernel_limits import get_kernel_monitor
+from session_reaper import get_session_reaper
+from spill_store import SpillStore, get_tool_output_max_tokens, exceeds_token_limit, truncate_output
 
 # Configuration des fonctions utilisables via l'API
 functions = [
@@ -40,6 +52,13 @@ Vous devriez :
 
 Note : Si l'utilisateur télécharge un fichier, vous recevrez un message système "User uploaded a file: filename". Utilisez le nom du fichier comme chemin dans le code.'''
 
+# Messages système ajoutés au réveil d'une session mise en veille, lorsque des variables du noyau sont perdues
+KERNEL_RESUMED_MSG = "Le noyau Jupyter a été arrêté après une période d'inactivité puis redémarré. Les variables " \
+                     "suivantes n'ont pas pu être restaurées et doivent être recalculées si nécessaire : {names}"
+KERNEL_RESUMED_EMPTY_MSG = "Le noyau Jupyter a été arrêté après une période d'inactivité puis redémarré. Son espace " \
+                           "de noms n'a pas pu être restauré : les variables, imports et fonctions doivent être " \
+                           "recréés si nécessaire."
+
 # Chargement de la configuration à partir d'un fichier JSON
 with open('config.json') as f:
     config = json.load(f)
@@ -60,6 +79,25 @@ def config_openai_api(api_type, api_base, api_version, api_key):
     openai.api_version = api_version
     openai.api_key = api_key
 
+class BotHistorySnapshot:
+    """
+    Instantané copy-on-write de l'historique Gradio.
+    Les tours précédents restent partagés avec l'historique affiché et ne sont jamais copiés : seul le texte de la
+    dernière bulle est mémorisé (chaîne immuable) afin de pouvoir la réécrire en O(taille du dernier message).
+    """
+    def __init__(self, history: List):
+        self.history = history
+        self.length = len(history)
+        self.user_message, self.bot_message = history[-1]
+
+    def render(self, suffix: str = ''):
+        """ Restaure l'historique tel qu'il était lors de l'instantané et ajoute `suffix` à la dernière bulle. """
+        history = self.history
+        del history[self.length:]
+        history[-1] = [self.user_message, (self.bot_message or '') + suffix]
+        return history
+
+
 class GPTResponseLog:
     """ Classe pour logger les réponses du modèle GPT utilisé par le backend. """
     def __init__(self):
@@ -67,6 +105,7 @@ class GPTResponseLog:
         self.content = ''
         self.function_name = None
         self.function_args_str = ''
+        self.function_args_parser = None
         self.code_str = ''
         self.display_code_block = ''
         self.finish_reason = 'stop'
@@ -74,6 +113,7 @@ class GPTResponseLog:
         self.stop_generating = False
         self.code_executing = False
         self.interrupt_signal_sent = False
+        self.tool_execution_started_at = None
 
     def reset_gpt_response_log_values(self, exclude=None):
         """ Réinitialise les valeurs du log, sauf celles spécifiées. """
@@ -84,13 +124,15 @@ class GPTResponseLog:
                       'content': '',
                       'function_name': None,
                       'function_args_str': '',
+                      'function_args_parser': None,
                       'code_str': '',
                       'display_code_block': '',
                       'finish_reason': 'stop',
                       'bot_history': None,
                       'stop_generating': False,
                       'code_executing': False,
-                      'interrupt_signal_sent': False}
+                      'interrupt_signal_sent': False,
+                      'tool_execution_started_at': None}
 
         for attr_name in exclude:
             del attributes[attr_name]
@@ -106,16 +148,23 @@ class GPTResponseLog:
         self.content += content
 
     def set_function_name(self, function_name: str):
-        """ Définit le nom de la fonction à appeler. """
+        """ Définit le nom de la fonction à appeler et prépare le décodeur incrémental de ses arguments. """
         self.function_name = function_name
+        self.function_args_parser = StreamingCodeArgumentParser(raw_code=function_name == 'python')
 
     def copy_current_bot_history(self, bot_history: List):
-        """ Copie l'historique actuel du bot pour référence future. """
-        self.bot_history = copy.deepcopy(bot_history)
+        """ Mémorise un instantané copy-on-write de l'historique actuel du bot pour référence future. """
+        self.bot_history = BotHistorySnapshot(bot_history)
+
+    def render_bot_history(self):
+        """ Réécrit la dernière bulle de l'historique à partir de l'instantané et du bloc de code affiché. """
+        return self.bot_history.render(suffix=self.display_code_block)
 
     def add_function_args_str(self, function_args_str: str):
         """ Ajoute des arguments à la fonction appelée sous forme de chaîne de caractères. """
         self.function_args_str += function_args_str
+        if self.function_args_parser is not None:
+            self.function_args_parser.feed(function_args_str)
 
     def update_code_str(self, code_str: str):
         """ Met à jour la chaîne de code à exécuter. """
@@ -137,6 +186,10 @@ class GPTResponseLog:
         """ Met à jour l'état d'exécution de code. """
         self.code_executing = code_executing
 
+    def mark_tool_execution_start(self):
+        """ Mémorise l'instant où l'outil appelé commence à s'exécuter. """
+        self.tool_execution_started_at = time.time()
+
     def update_interrupt_signal_sent(self, interrupt_signal_sent: bool):
         """ Met à jour si un signal d'interruption a été envoyé. """
         self.interrupt_signal_sent = interrupt_signal_sent
@@ -148,16 +201,42 @@ class BotBackend(GPTResponseLog):
         super().__init__()
         self.unique_id = hash(id(self))
         self.jupyter_work_dir = f'cache/work_dir_{self.unique_id}'
-        self.tool_log = f'cache/tool_{self.unique_id}.log'
-        self.jupyter_kernel = JupyterKernel(work_dir=self.jupyter_work_dir)
+        self.tool_log = f'cache/tool_{self.unique_id}.jsonl'
+        self.hibernation_dir = f'cache/hibernate_{self.unique_id}'
+        self.hibernated = False
+        self.hibernation_lost_names = []
+        self.last_activity = time.time()
+        # Sérialise la mise en veille et le réveil avec les autres opérations sur le noyau
+        self.activity_lock = threading.Lock()
+        self.notebook_log = NotebookLog(autosave_path=get_session_notebook_path())
         self.gpt_model_choice = "GPT-3.5"
         self.revocable_files = []
         self.system_msg = system_msg
         self.functions = copy.deepcopy(functions)
         self._init_api_config()
+        get_tracer(self.config.get('tracing'))
+        self.tool_logger = ToolLog(
+            path=self.tool_log,
+            session_id=self.unique_id,
+            writer=get_tool_log_writer(self.config.get('tool_log'))
+        )
+        self.cache_manager = get_cache_manager(self.config.get('cache'))
+        self.cache_manager.register_session(self)
+        self.snapshot_store = get_snapshot_store()
+        self.spill_store = SpillStore(f'cache/spill_{self.unique_id}')
+        self.context_compactor = create_context_compactor(
+            self.config.get('context_compaction'), api_type=self.config['API_TYPE'],
+            response_cache_config=self.config.get('response_cache')
+        )
+        self.jupyter_kernel = JupyterKernel(
+            work_dir=self.jupyter_work_dir,
+            kernel_pool=get_kernel_pool(size=int(self.config.get('kernel_pool_size', 2))),
+            kernel_monitor=get_kernel_monitor(self.config.get('kernel_limits'))
+        )
         self._init_tools()
         self._init_conversation()
         self._init_kwargs_for_chat_completion()
+        get_session_reaper(self.config.get('session_reaper'), self.cache_manager)
 
     def _init_conversation(self):
         """ Initialise la conversation avec le message système initial. """
@@ -166,9 +245,28 @@ class BotBackend(GPTResponseLog):
         self.sliced = False  # Indique si la conversion est tronquée
         if hasattr(self, 'conversation'):
             self.conversation.clear()
-            self.conversation.append(first_system_msg)
+            self.token_ledger.clear()
+            self.tool_logger.truncate(0)
+            if self.context_compactor is not None:
+                self.context_compactor.truncate(0)
         else:
-            self.conversation: List[Dict] = [first_system_msg]
+            self.conversation: List[Dict] = []
+            self.token_ledger = TokenLedger(
+                encoding_for_which_model=self.get_encoding_model_name(),
+                functions=self.functions
+            )
+        self._append_to_conversation(first_system_msg)
+
+    def _append_to_conversation(self, message: Dict):
+        """ Ajoute un message à la conversation en le comptant une seule fois dans le registre de tokens. """
+        self.conversation.append(message)
+        self.token_ledger.append(message)
+
+    def get_encoding_model_name(self):
+        """ Retourne le nom du modèle dont l'encodage tiktoken doit être utilisé pour compter les tokens. """
+        if self.config['API_TYPE'] == 'azure':
+            return 'gpt-3.5-turbo' if self.gpt_model_choice == 'GPT-3.5' else 'gpt-4'
+        return self.config['model'][self.gpt_model_choice]['model_name']
 
     def _init_api_config(self):
         """ Initialise la configuration de l'API en fonction du fichier de configuration. """
@@ -219,19 +317,17 @@ class BotBackend(GPTResponseLog):
         else:
             self.kwargs_for_chat_completion['model'] = model_name
 
-    def _backup_all_files_in_work_dir(self):
-        """ Sauvegarde tous les fichiers dans le répertoire de travail. """
-        count = 1
-        backup_dir = f'cache/backup_{self.unique_id}'
-        while os.path.exists(backup_dir):
-            count += 1
-            backup_dir = f'cache/backup_{self.unique_id}_{count}'
-        shutil.copytree(src=self.jupyter_work_dir, dst=backup_dir)
-
     def _clear_all_files_in_work_dir(self, backup=True):
-        """ Efface tous les fichiers du répertoire de travail, avec une option de sauvegarde. """
+        """
+        Vide le répertoire de travail, avec une option de sauvegarde.
+        Le répertoire est remplacé immédiatement par un répertoire vide ; l'instantané (ou la suppression) des
+        anciens fichiers se fait en arrière-plan.
+        """
         if backup:
-            self._backup_all_files_in_work_dir()
+            future = self.snapshot_store.snapshot_and_remove(self.unique_id, self.jupyter_work_dir)
+            if future is not None:
+                future.add_done_callback(lambda _: self.cache_manager.request_sweep())
+            return
         for filename in os.listdir(self.jupyter_work_dir):
             path = os.path.join(self.jupyter_work_dir, filename)
             if os.path.isdir(path):
@@ -239,41 +335,63 @@ class BotBackend(GPTResponseLog):
             else:
                 os.remove(path)
 
+    def list_snapshots(self):
+        """ Liste les instantanés du répertoire de travail pris à chaque redémarrage. """
+        return self.snapshot_store.list_snapshots(self.unique_id)
+
+    def restore_snapshot(self, snapshot_id):
+        """ Restaure les fichiers d'un instantané dans le répertoire de travail. """
+        return self.snapshot_store.restore(self.unique_id, snapshot_id, self.jupyter_work_dir)
+
     def _save_tool_log(self, tool_response):
-        """ Enregistre la réponse d'un outil dans le log du bot. """
-        with open(self.tool_log, 'a', encoding='utf-8') as log_file:
-            log_file.write(f'Previous conversion: {self.conversation}\n')
-            log_file.write(f'Model choice: {self.gpt_model_choice}\n')
-            log_file.write(f'Tool name: {self.function_name}\n')
-            log_file.write(f'Parameters: {self.function_args_str}\n')
-            log_file.write(f'Response: {tool_response}\n')
-            log_file.write('----------\n\n')
+        """ Enregistre l'appel d'outil et les nouveaux messages de la conversation dans le journal des outils. """
+        duration = None
+        if self.tool_execution_started_at is not None:
+            duration = time.time() - self.tool_execution_started_at
+        self.tool_logger.record_tool_call(
+            conversation=self.conversation,
+            model_choice=self.gpt_model_choice,
+            tool_name=self.function_name,
+            parameters=self.function_args_str,
+            response=tool_response,
+            duration=duration
+        )
 
     def add_gpt_response_content_message(self):
         """ Ajoute la réponse contentieuse du GPT à l'historique de la conversation. """
-        self.conversation.append(
+        self._append_to_conversation(
             {'role': self.assistant_role_name, 'content': self.content}
         )
-        add_markdown_to_notebook(self.content, title="Assistant")
+        self.notebook_log.add_markdown(self.content, title="Assistant")
 
     def add_text_message(self, user_text):
         """ Ajoute un message texte de l'utilisateur à l'historique de la conversation. """
-        self.conversation.append(
+        self.wake_up()
+        self._append_to_conversation(
             {'role': 'user', 'content': user_text}
         )
         self.revocable_files.clear()
         self.update_finish_reason(finish_reason='new_input')
-        add_markdown_to_notebook(user_text, title="User")
+        self.notebook_log.add_markdown(user_text, title="User")
 
     def add_file_message(self, path, bot_msg):
         """ Ajoute un message de fichier téléchargé par l'utilisateur à l'historique. """
+        self.wake_up()
         filename = os.path.basename(path)
         work_dir = self.jupyter_work_dir
 
-        shutil.copy(path, work_dir)
+        # Le fichier temporaire de Gradio est déplacé (sans copie sur le même système de fichiers) : il appartient
+        # désormais à la session, qui peut le modifier ; il sera dédupliqué au premier instantané qui le contient
+        move_file(path, os.path.join(work_dir, filename))
+        if 'inquire_image' in self.additional_tools and filename.lower().endswith(VISION_IMAGE_SUFFIXES):
+            # L'image est préparée pour le modèle de vision pendant que l'utilisateur écrit sa question
+            additional_parameters = self.additional_tools['inquire_image']['additional_parameters']
+            get_image_encoding_cache(additional_parameters['vision_image_config']).prefetch(
+                os.path.join(work_dir, filename)
+            )
 
         gpt_msg = {'role': 'system', 'content': f'User uploaded a file: {filename}'}
-        self.conversation.append(gpt_msg)
+        self._append_to_conversation(gpt_msg)
         self.revocable_files.append(
             {
                 'bot_msg': bot_msg,
@@ -285,9 +403,9 @@ class BotBackend(GPTResponseLog):
     def add_function_call_response_message(self, function_response: Union[str, None], save_tokens=True):
         """ Ajoute la réponse d'une fonction appelée à l'historique de la conversation. """
         if self.code_str is not None:
-            add_code_cell_to_notebook(self.code_str)
+            self.notebook_log.add_code_cell(self.code_str)
 
-        self.conversation.append(
+        self._append_to_conversation(
             {
                 "role": self.assistant_role_name,
                 "name": self.function_name,
@@ -295,10 +413,9 @@ class BotBackend(GPTResponseLog):
             }
         )
         if function_response is not None:
-            if save_tokens and len(function_response) > 500:
-                function_response = f'{function_response[:200]}\n[La sortie est trop volumineuse, une partie du milieu est omise]\n' \
-                                    f'Partie finale de la sortie:\n{function_response[-200:]}'
-            self.conversation.append(
+            if save_tokens:
+                function_response = self._truncate_function_response(function_response)
+            self._append_to_conversation(
                 {
                     "role": "function",
                     "name": self.function_name,
@@ -307,9 +424,31 @@ class BotBackend(GPTResponseLog):
             )
         self._save_tool_log(tool_response=function_response)
 
+    def get_tool_output_max_tokens(self):
+        """ Limite de tokens d'une sortie d'outil ajoutée à la conversation, pour le modèle courant. """
+        return get_tool_output_max_tokens(self.config, self.config['model'][self.gpt_model_choice]['model_name'])
+
+    def count_tokens(self, text):
+        """ Compte les tokens d'une chaîne avec l'encodeur de la conversation. """
+        return self.token_ledger.count_tokens(text)
+
+    def _truncate_function_response(self, function_response: str):
+        """
+        Tronque une sortie qui dépasse la limite de tokens du modèle ; la sortie complète est enregistrée dans le
+        spill store de la session pour être relue avec l'outil read_output.
+        """
+        max_tokens = self.get_tool_output_max_tokens()
+        encoder = self.token_ledger.encoder
+        if not exceeds_token_limit(encoder, function_response, max_tokens):
+            return function_response
+        call_id = self.spill_store.store(function_response)
+        return truncate_output(
+            encoder, function_response, max_tokens, call_id, self.spill_store.get_line_count(call_id)
+        )
+
     def append_system_msg(self, prompt):
         """ Ajoute un message système à l'historique de la conversation. """
-        self.conversation.append(
+        self._append_to_conversation(
             {'role': 'system', 'content': prompt}
         )
 
@@ -323,6 +462,10 @@ class BotBackend(GPTResponseLog):
 
             assert self.conversation[-1] is gpt_msg
             del self.conversation[-1]
+            self.token_ledger.pop()
+            self.tool_logger.truncate(len(self.conversation))
+            if self.context_compactor is not None:
+                self.context_compactor.truncate(len(self.conversation))
 
             os.remove(path)
 
@@ -332,9 +475,14 @@ class BotBackend(GPTResponseLog):
         else:
             return None
 
+    def export_notebook(self):
+        """ Construit le notebook Jupyter de la session à partir de son journal de cellules et retourne son chemin. """
+        return self.notebook_log.export(f'cache/notebook_{self.unique_id}.ipynb')
+
     def update_gpt_model_choice(self, model_choice):
         """ Met à jour le choix du modèle GPT utilisé. """
         self.gpt_model_choice = model_choice
+        self.token_ledger.set_encoding_model(self.get_encoding_model_name())
         self._init_kwargs_for_chat_completion()
 
     def update_token_count(self, num_tokens):
@@ -352,8 +500,72 @@ class BotBackend(GPTResponseLog):
 
     def restart(self):
         """ Redémarre le backend du bot, réinitialisant l'environnement et la conversation. """
-        self.revocable_files.clear()
-        self._init_conversation()
-        self.reset_gpt_response_log_values()
-        self.jupyter_kernel.restart_jupyter_kernel()
-        self._clear_all_files_in_work_dir()
+        with self.activity_lock:
+            self.last_activity = time.time()
+            self.revocable_files.clear()
+            self._init_conversation()
+            self.reset_gpt_response_log_values()
+            self.spill_store.clear()
+            # Le répertoire est vidé avant le démarrage du nouveau noyau, qui s'y place ensuite
+            self._clear_all_files_in_work_dir()
+            # Un espace de noms enregistré lors d'une mise en veille est abandonné
+            self.hibernated = False
+            self.hibernation_lost_names = []
+            shutil.rmtree(self.hibernation_dir, ignore_errors=True)
+            self.jupyter_kernel.restart_jupyter_kernel()
+
+    def get_idle_time(self):
+        """ Durée (en secondes) écoulée depuis le dernier message de l'utilisateur ou la dernière exécution de code. """
+        if self.jupyter_kernel.executing:
+            return 0
+        return time.time() - max(self.last_activity, self.jupyter_kernel.last_activity)
+
+    def hibernate(self, namespace_max_bytes):
+        """
+        Met la session en veille : ce qui peut être enregistré de l'espace de noms du noyau est écrit dans
+        cache/hibernate_<id>/, puis le noyau est arrêté ; la conversation reste en mémoire. Retourne False si la
+        session est occupée.
+        """
+        if not self.activity_lock.acquire(blocking=False):
+            return False
+        try:
+            if self.hibernated or self.jupyter_kernel.executing:
+                return False
+            os.makedirs(self.hibernation_dir, exist_ok=True)
+            report = self.jupyter_kernel.hibernate(
+                os.path.abspath(os.path.join(self.hibernation_dir, 'namespace.pkl')), namespace_max_bytes
+            )
+            self.hibernation_lost_names = report['lost']
+            self.hibernated = True
+            return True
+        finally:
+            self.activity_lock.release()
+
+    def wake_up(self):
+        """
+        Enregistre une activité de la session et, si elle est en veille, démarre un nouveau noyau et y restaure
+        l'espace de noms enregistré. Les variables perdues sont signalées au modèle.
+        """
+        with self.activity_lock:
+            self.last_activity = time.time()
+            if not self.hibernated:
+                return
+            namespace_path = os.path.abspath(os.path.join(self.hibernation_dir, 'namespace.pkl'))
+            try:
+                if os.path.exists(namespace_path):
+                    lost_names = self.jupyter_kernel.resume(namespace_path)
+                    lost_names = sorted(set(self.hibernation_lost_names) | set(lost_names))
+                else:
+                    # Espace de noms supprimé par le gestionnaire de cache pour respecter les quotas
+                    self.jupyter_kernel.resume()
+                    lost_names = None
+            except RuntimeError as e:
+                print(f'Erreur lors de la restauration du noyau de la session {self.unique_id}: {e}')
+                lost_names = None
+            self.hibernated = False
+            self.hibernation_lost_names = []
+            shutil.rmtree(self.hibernation_dir, ignore_errors=True)
+            if lost_names is None:
+                self.append_system_msg(KERNEL_RESUMED_EMPTY_MSG)
+            elif lost_names:
+                self.append_system_msg(KERNEL_RESUMED_MSG.format(names=', '.join(lost_names)))
@@ -0,0 +1,294 @@
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+from typing import *
+from snapshot import get_snapshot_store, load_manifests, get_referenced_bytes
+from tracing import register_gauges
+from tool_log import get_tool_log_writer
+
+# Entrées de cache/ appartenant à une session : work_dir_<id>, backup_<id>[_<n>], temp_<id>,
+# tool_<id>.jsonl[.<n>[.gz]], notebook_<id>.ipynb, snapshots_<id>, trash_<id>_<n>, spill_<id>, hibernate_<id>
+SESSION_ENTRY_PATTERN = re.compile(
+    r'^(work_dir|backup|temp|tool|notebook|snapshots|trash|spill|hibernate)_(-?\d+)(?:_(\d+))?(?:\.|$)'
+)
+# Entrées qu'on peut supprimer pour faire respecter le quota d'une session encore active ; viennent ensuite
+# ses instantanés les plus anciens. Une session en veille dont l'espace de noms enregistré est supprimé repart
+# d'un noyau vide à son réveil.
+EVICTABLE_LIVE_ENTRY_KINDS = ('backup', 'hibernate')
+
+# Valeurs par défaut de la section "cache" du fichier de configuration
+DEFAULT_SESSION_QUOTA_MB = 2048
+DEFAULT_GLOBAL_QUOTA_MB = 20480
+DEFAULT_SWEEP_INTERVAL = 300
+
+
+def get_entry_usage(path, seen_inodes: Optional[Set[Tuple[int, int]]] = None):
+    """
+    Retourne (taille en octets, date de dernière modification) d'un fichier ou d'un répertoire.
+    Les fichiers à liens multiples déjà présents dans `seen_inodes` ne sont pas comptés une seconde fois.
+    """
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return 0, 0
+    if not os.path.isdir(path) or os.path.islink(path):
+        return stat.st_size, stat.st_mtime
+    total_size, last_modified = 0, stat.st_mtime
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                file_stat = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            last_modified = max(last_modified, file_stat.st_mtime)
+            if seen_inodes is not None and file_stat.st_nlink > 1:
+                inode = (file_stat.st_dev, file_stat.st_ino)
+                if inode in seen_inodes:
+                    continue
+                seen_inodes.add(inode)
+            total_size += file_stat.st_size
+    return total_size, last_modified
+
+
+def remove_entry(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class CacheManager:
+    """
+    Gestionnaire du répertoire cache/.
+    Un thread d'arrière-plan mesure régulièrement l'espace occupé par chaque session et fait respecter :
+    - le quota par session, en supprimant les plus anciennes sauvegardes et instantanés des sessions actives ;
+    - le quota global, en supprimant les sessions terminées les moins récemment utilisées (LRU), puis les
+      espaces de noms enregistrés des sessions en veille, du plus ancien au plus récent.
+    Les fichiers d'une session active (répertoire de travail, images, journaux) ne sont jamais supprimés.
+    """
+    def __init__(self, cache_dir='cache', session_quota_bytes=None, global_quota_bytes=None,
+                 sweep_interval=DEFAULT_SWEEP_INTERVAL):
+        self.cache_dir = cache_dir
+        self.session_quota_bytes = session_quota_bytes
+        self.global_quota_bytes = global_quota_bytes
+        self.sweep_interval = sweep_interval
+        self.sessions: Dict[int, weakref.ref] = {}
+        self.lock = threading.Lock()
+        self.sweep_lock = threading.Lock()
+        self.metrics = {
+            'total_bytes': 0,
+            'objects_bytes': 0,
+            'sessions': 0,
+            'live_sessions': 0,
+            'evicted_sessions': 0,
+            'evicted_entries': 0,
+            'evicted_bytes': 0,
+            'last_sweep_time': None,
+            'last_sweep_duration': None
+        }
+        self.stop_event = threading.Event()
+        self.sweep_requested = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None and self.sweep_interval > 0:
+            self.thread = threading.Thread(target=self._run, name='cache-sweeper', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.sweep_requested.set()
+
+    def request_sweep(self):
+        """ Demande un nettoyage sans attendre l'échéance suivante (par exemple après une sauvegarde). """
+        self.sweep_requested.set()
+
+    def register_session(self, bot_backend):
+        """ Déclare une session active ; elle le reste tant que son backend existe. """
+        with self.lock:
+            self.sessions[bot_backend.unique_id] = weakref.ref(bot_backend)
+
+    def unregister_session(self, unique_id):
+        with self.lock:
+            self.sessions.pop(unique_id, None)
+
+    def get_live_sessions(self):
+        """ Retourne les backends des sessions actives. """
+        with self.lock:
+            bot_backends = [ref() for ref in self.sessions.values()]
+        return [bot_backend for bot_backend in bot_backends if bot_backend is not None]
+
+    def get_live_session_ids(self):
+        with self.lock:
+            return {unique_id for unique_id, ref in self.sessions.items() if ref() is not None}
+
+    def get_metrics(self):
+        with self.lock:
+            return dict(self.metrics)
+
+    def scan(self, seen_inodes: Optional[Set[Tuple[int, int]]] = None):
+        """
+        Mesure les entrées de cache/ regroupées par session.
+        Retourne {unique_id: [(kind, index, path, size, last_modified), ...]}.
+        """
+        usage = {}
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return usage
+        for name in names:
+            match = SESSION_ENTRY_PATTERN.match(name)
+            if match is None:
+                continue
+            kind, unique_id, index = match.group(1), int(match.group(2)), int(match.group(3) or 1)
+            path = os.path.join(self.cache_dir, name)
+            size, last_modified = get_entry_usage(path, seen_inodes)
+            if kind == 'snapshots':
+                # Les manifestes sont minuscules : la session occupe la taille des objets qu'ils référencent
+                size += get_referenced_bytes(manifest for _, manifest in load_manifests(path))
+            usage.setdefault(unique_id, []).append((kind, index, path, size, last_modified))
+        return usage
+
+    def _trim_snapshots(self, entry, session_bytes):
+        """
+        Supprime les instantanés les plus anciens d'une session active jusqu'à respecter son quota.
+        Retourne la nouvelle taille de la session et le nombre d'instantanés supprimés.
+        """
+        manifests = load_manifests(entry[2])
+        removed_count = 0
+        referenced_bytes = get_referenced_bytes(manifest for _, manifest in manifests)
+        while manifests and session_bytes > self.session_quota_bytes:
+            path, _ = manifests.pop(0)
+            os.remove(path)
+            removed_count += 1
+            remaining_bytes = get_referenced_bytes(manifest for _, manifest in manifests)
+            session_bytes -= referenced_bytes - remaining_bytes
+            referenced_bytes = remaining_bytes
+        return session_bytes, removed_count
+
+    def sweep(self):
+        """ Mesure le cache et supprime des entrées jusqu'à respecter les quotas. """
+        with self.sweep_lock:
+            start_time = time.time()
+            snapshot_store = get_snapshot_store()
+            # Les fichiers liés aux objets du magasin (instantanés en cours) ne sont comptés qu'une fois
+            seen_inodes = set()
+            usage = self.scan(seen_inodes)
+            live_session_ids = self.get_live_session_ids()
+            evicted_sessions = evicted_entries = evicted_bytes = 0
+
+            if self.session_quota_bytes:
+                for unique_id, entries in usage.items():
+                    if unique_id not in live_session_ids:
+                        continue
+                    session_bytes = sum(entry[3] for entry in entries)
+                    candidates = sorted(
+                        (entry for entry in entries if entry[0] in EVICTABLE_LIVE_ENTRY_KINDS),
+                        key=lambda entry: (entry[4], entry[1])
+                    )
+                    for entry in candidates:
+                        if session_bytes <= self.session_quota_bytes:
+                            break
+                        remove_entry(entry[2])
+                        entries.remove(entry)
+                        session_bytes -= entry[3]
+                        evicted_entries += 1
+                        evicted_bytes += entry[3]
+                    for entry in entries:
+                        if entry[0] == 'snapshots' and session_bytes > self.session_quota_bytes:
+                            session_bytes, removed_count = self._trim_snapshots(entry, session_bytes)
+                            evicted_entries += removed_count
+
+            # Les objets des instantanés sont partagés entre sessions : ils sont comptés une seule fois
+            freed_bytes = snapshot_store.collect_garbage()
+            evicted_bytes += freed_bytes
+            objects_bytes = get_entry_usage(snapshot_store.objects_dir, seen_inodes)[0]
+            total_bytes = objects_bytes + sum(
+                get_entry_usage(entry[2])[0] if entry[0] == 'snapshots' else entry[3]
+                for entries in usage.values() for entry in entries
+            )
+            if self.global_quota_bytes and total_bytes > self.global_quota_bytes:
+                dead_sessions = sorted(
+                    (unique_id for unique_id in usage if unique_id not in live_session_ids),
+                    key=lambda unique_id: max(entry[4] for entry in usage[unique_id])
+                )
+                for unique_id in dead_sessions:
+                    if total_bytes <= self.global_quota_bytes:
+                        break
+                    has_snapshots = False
+                    for entry in usage.pop(unique_id):
+                        if entry[0] == 'snapshots':
+                            has_snapshots = True
+                            total_bytes -= get_entry_usage(entry[2])[0]
+                        else:
+                            total_bytes -= entry[3]
+                            evicted_bytes += entry[3]
+                        remove_entry(entry[2])
+                        evicted_entries += 1
+                    # L'écrivain ne doit pas reprendre la taille ni la conversation d'un journal supprimé
+                    get_tool_log_writer().release(os.path.join(self.cache_dir, f'tool_{unique_id}.jsonl'))
+                    if has_snapshots:
+                        freed_bytes = snapshot_store.collect_garbage()
+                        objects_bytes -= freed_bytes
+                        total_bytes -= freed_bytes
+                        evicted_bytes += freed_bytes
+                    evicted_sessions += 1
+                if total_bytes > self.global_quota_bytes:
+                    hibernate_entries = sorted(
+                        (entry for entries in usage.values() for entry in entries if entry[0] == 'hibernate'),
+                        key=lambda entry: entry[4]
+                    )
+                    for entry in hibernate_entries:
+                        if total_bytes <= self.global_quota_bytes:
+                            break
+                        remove_entry(entry[2])
+                        total_bytes -= entry[3]
+                        evicted_entries += 1
+                        evicted_bytes += entry[3]
+
+            with self.lock:
+                self.metrics['total_bytes'] = total_bytes
+                self.metrics['objects_bytes'] = objects_bytes
+                self.metrics['sessions'] = len(usage)
+                self.metrics['live_sessions'] = len(live_session_ids)
+                self.metrics['evicted_sessions'] += evicted_sessions
+                self.metrics['evicted_entries'] += evicted_entries
+                self.metrics['evicted_bytes'] += evicted_bytes
+                self.metrics['last_sweep_time'] = start_time
+                self.metrics['last_sweep_duration'] = time.time() - start_time
+
+    def _run(self):
+        while True:
+            self.sweep_requested.wait(self.sweep_interval)
+            self.sweep_requested.clear()
+            if self.stop_event.is_set():
+                return
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f'Erreur lors du nettoyage du cache: {e}')
+
+
+_cache_manager = None
+_cache_manager_lock = threading.Lock()
+
+
+def get_cache_manager(cache_config: Optional[Dict] = None):
+    """ Retourne le gestionnaire de cache du processus, créé et démarré au premier appel. """
+    global _cache_manager
+    with _cache_manager_lock:
+        if _cache_manager is None:
+            cache_config = cache_config or {}
+            session_quota_mb = cache_config.get('session_quota_mb', DEFAULT_SESSION_QUOTA_MB)
+            global_quota_mb = cache_config.get('global_quota_mb', DEFAULT_GLOBAL_QUOTA_MB)
+            _cache_manager = CacheManager(
+                session_quota_bytes=int(session_quota_mb * 1024 * 1024) if session_quota_mb else None,
+                global_quota_bytes=int(global_quota_mb * 1024 * 1024) if global_quota_mb else None,
+                sweep_interval=float(cache_config.get('sweep_interval', DEFAULT_SWEEP_INTERVAL))
+            )
+            _cache_manager.start()
+            register_gauges('cache', _cache_manager.get_metrics)
+        return _cache_manager
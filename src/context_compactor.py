@@ -0,0 +1,286 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import *
+import openai
+from response_cache import get_response_cache
+from tracing import span
+
+# Valeurs par défaut de la section "context_compaction" du fichier de configuration
+DEFAULT_ENABLED = False
+DEFAULT_SEGMENT_MESSAGES = 8
+# La compaction commence lorsque la conversation dépasse cette part du budget de tokens...
+DEFAULT_TRIGGER_RATIO = 0.75
+# ... et ne garde alors intacts que les messages récents qui tiennent dans cette part du budget
+DEFAULT_TARGET_RATIO = 0.5
+DEFAULT_SUMMARY_MAX_TOKENS = 400
+# Longueur maximale de chaque message dans la transcription envoyée au modèle de résumé
+DEFAULT_MESSAGE_CHARS = 2000
+DEFAULT_CACHE_SIZE = 1024
+
+SUMMARY_PROMPT = '''Vous résumez le début d'une session d'analyse de données menée avec un interprète de code Python.
+Rédigez un résumé factuel et concis qui permette de poursuivre la session sans relire les messages :
+- demandes de l'utilisateur et conclusions obtenues ;
+- fichiers chargés ou créés, variables et DataFrames définis dans le noyau (noms, colonnes, formes) ;
+- fonctions définies, bibliothèques importées, erreurs rencontrées et leur correction.
+Intégrez le résumé précédent s'il est fourni. Répondez dans la langue de l'utilisateur.'''
+
+SUMMARY_MESSAGE = "[Résumé des échanges précédents, retirés de la conversation pour tenir dans la fenêtre contextuelle.]\n{summary}"
+
+
+def get_segment_key(previous_key, messages: List[Dict]):
+    """ Empreinte d'un segment et du résumé qui le précède : deux conversations identiques partagent leurs résumés. """
+    digest = hashlib.sha256(previous_key.encode('utf-8'))
+    digest.update(json.dumps(messages, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def render_transcript(messages: List[Dict], message_chars=DEFAULT_MESSAGE_CHARS):
+    """ Transcription textuelle des messages, chacun tronqué à message_chars caractères. """
+    lines = []
+    for message in messages:
+        role = message.get('role')
+        if message.get('name'):
+            role = f"{role} ({message['name']})"
+        content = message.get('content')
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False, default=str)
+        if len(content) > message_chars:
+            content = content[:message_chars] + f' [... {len(content) - message_chars} caractères omis]'
+        lines.append(f'{role}: {content}')
+    return '\n\n'.join(lines)
+
+
+class SummaryCache:
+    """ Résumés déjà produits, par empreinte de segment, partagés par toutes les sessions (LRU). """
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self.lock:
+            summary = self.entries.get(key)
+            if summary is not None:
+                self.entries.move_to_end(key)
+            return summary
+
+    def put(self, key, summary: str):
+        with self.lock:
+            self.entries[key] = summary
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class SegmentSummary:
+    """ Résumé glissant des messages [1, end) : résumé précédent complété par le segment [start, end). """
+    def __init__(self, start, end, key, text):
+        self.start = start
+        self.end = end
+        self.key = key
+        self.text = text
+        self.message = {'role': 'system', 'content': SUMMARY_MESSAGE.format(summary=text)}
+        self.tokens = None
+        self.tokens_encoding = None
+
+    def count_tokens(self, token_ledger):
+        # Recompté seulement si l'encodeur du registre change (changement de modèle)
+        if self.tokens_encoding != token_ledger.encoding_for_which_model:
+            self.tokens = token_ledger.count_message(self.message)
+            self.tokens_encoding = token_ledger.encoding_for_which_model
+        return self.tokens
+
+
+class ContextCompactor:
+    """
+    Compaction de la conversation d'une session par résumés glissants.
+    La conversation (hors message système) est découpée en segments fixes de segment_messages messages ; le
+    résumé k couvre tous les messages jusqu'à la fin du segment k et se calcule à partir du résumé k-1. Les
+    résumés sont produits en arrière-plan dès que la conversation approche de la limite et get_slice() n'attend
+    jamais : il utilise le résumé le plus récent disponible, ou laisse get_conversation_slice tronquer comme
+    avant si aucun n'est prêt.
+    """
+    def __init__(self, api_type, summary_model=None, segment_messages=DEFAULT_SEGMENT_MESSAGES,
+                 trigger_ratio=DEFAULT_TRIGGER_RATIO, target_ratio=DEFAULT_TARGET_RATIO,
+                 summary_max_tokens=DEFAULT_SUMMARY_MAX_TOKENS, message_chars=DEFAULT_MESSAGE_CHARS,
+                 summary_cache: Optional[SummaryCache] = None, executor: Optional[ThreadPoolExecutor] = None,
+                 response_cache_config: Optional[Dict] = None):
+        self.api_type = api_type
+        self.summary_model = summary_model
+        self.segment_messages = max(1, int(segment_messages))
+        self.trigger_ratio = trigger_ratio
+        self.target_ratio = target_ratio
+        self.summary_max_tokens = summary_max_tokens
+        self.message_chars = message_chars
+        self.summary_cache = summary_cache or get_summary_cache()
+        self.executor = executor or get_summary_executor()
+        self.response_cache_config = response_cache_config
+        self.summaries: List[SegmentSummary] = []
+        self.pending = None
+        # Incrémenté à chaque raccourcissement de la conversation : un résumé calculé entre-temps est ignoré
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get_segment_end(self, index):
+        """ Indice (exclu) de la fin du segment `index` ; le message système d'indice 0 n'appartient à aucun segment. """
+        return 1 + (index + 1) * self.segment_messages
+
+    def truncate(self, length):
+        """ Signale que la conversation a été raccourcie à `length` messages (redémarrage, annulation). """
+        with self.lock:
+            self.generation += 1
+            while self.summaries and self.summaries[-1].end > length:
+                self.summaries.pop()
+
+    def get_slice(self, conversation: List[Dict], token_ledger, model, max_tokens, fixed_tokens,
+                  sliced_conv_message: Dict):
+        """
+        Retourne (conversation compactée, nombre de tokens, True), ou None lorsque la conversation tient encore
+        sous le seuil de compaction ou qu'aucun résumé n'est prêt.
+        """
+        conversation_tokens = token_ledger.suffix_tokens(1)
+        if conversation_tokens <= max_tokens * self.trigger_ratio:
+            return None
+
+        # Segments à résumer pour ne garder intacts que les messages qui tiennent dans target_ratio du budget
+        target_cut = token_ledger.find_cut_index(budget=int(max_tokens * self.target_ratio))
+        complete_segments = (len(conversation) - 1) // self.segment_messages
+        wanted_segments = min(-(-(target_cut - 1) // self.segment_messages), complete_segments)
+        with self.lock:
+            available_segments = min(len(self.summaries), wanted_segments)
+            summary = self.summaries[available_segments - 1] if available_segments else None
+            missing_summaries = len(self.summaries) < wanted_segments
+        if missing_summaries:
+            self.schedule(conversation, wanted_segments, model)
+        if summary is None:
+            return None
+
+        summary_tokens = summary.count_tokens(token_ledger)
+        cut_index = summary.end
+        sliced_conv = [conversation[0], summary.message]
+        nb_tokens = fixed_tokens + summary_tokens
+        if summary_tokens + token_ledger.suffix_tokens(cut_index) > max_tokens:
+            # Résumés en retard sur la conversation : les messages non résumés les plus anciens sont retirés
+            cut_index = token_ledger.find_cut_index(budget=max_tokens - summary_tokens, lo=cut_index)
+            sliced_conv.append(sliced_conv_message)
+            nb_tokens += token_ledger.count_message(sliced_conv_message)
+        sliced_conv.extend(conversation[cut_index:])
+        nb_tokens += token_ledger.suffix_tokens(cut_index)
+        return sliced_conv, nb_tokens, True
+
+    def schedule(self, conversation: List[Dict], wanted_segments, model):
+        """ Lance en arrière-plan le calcul des résumés manquants, jusqu'au segment wanted_segments - 1. """
+        with self.lock:
+            if self.pending is not None and not self.pending.done():
+                return
+            generation = self.generation
+            first_segment = len(self.summaries)
+            if first_segment >= wanted_segments:
+                return
+            # Copie superficielle : les messages ne sont plus modifiés une fois ajoutés
+            segments = [
+                conversation[self.get_segment_end(index) - self.segment_messages:self.get_segment_end(index)]
+                for index in range(first_segment, wanted_segments)
+            ]
+            previous = self.summaries[-1] if self.summaries else None
+            self.pending = self.executor.submit(
+                self._summarize_segments, generation, first_segment, segments, previous, model
+            )
+
+    def _summarize_segments(self, generation, first_segment, segments: List[List[Dict]],
+                            previous: Optional[SegmentSummary], model):
+        for offset, messages in enumerate(segments):
+            index = first_segment + offset
+            key = get_segment_key(previous.key if previous else '', messages)
+            text = self.summary_cache.get(key)
+            if text is None:
+                try:
+                    text = self.summarize(previous.text if previous else None, messages, model)
+                except Exception as e:
+                    print(f'Erreur lors du résumé de la conversation: {e}')
+                    return
+                self.summary_cache.put(key, text)
+            summary = SegmentSummary(
+                start=self.get_segment_end(index) - self.segment_messages, end=self.get_segment_end(index),
+                key=key, text=text
+            )
+            with self.lock:
+                if self.generation != generation or len(self.summaries) != index:
+                    return
+                self.summaries.append(summary)
+            previous = summary
+
+    def summarize(self, previous_summary: Optional[str], messages: List[Dict], model):
+        """ Demande au modèle le résumé glissant : résumé précédent complété par les messages du segment. """
+        summary_model = self.summary_model or model
+        user_content = ''
+        if previous_summary:
+            user_content += f'Résumé précédent :\n{previous_summary}\n\n'
+        user_content += f'Nouveaux messages :\n{render_transcript(messages, self.message_chars)}'
+        kwargs = {
+            'messages': [
+                {'role': 'system', 'content': SUMMARY_PROMPT},
+                {'role': 'user', 'content': user_content}
+            ],
+            'max_tokens': self.summary_max_tokens,
+            'temperature': 0,
+            # Le cache de réponses n'enregistre que les réponses en streaming
+            'stream': True
+        }
+        if self.api_type == 'azure':
+            kwargs['engine'] = summary_model
+        else:
+            kwargs['model'] = summary_model
+        with span('context.summarize', model=summary_model):
+            response = get_response_cache(self.response_cache_config).create(kwargs, openai.ChatCompletion.create)
+            chunks = []
+            for chunk in response:
+                if chunk['choices']:
+                    chunks.append(chunk['choices'][0].get('delta', {}).get('content') or '')
+        return ''.join(chunks).strip()
+
+
+_summary_cache = None
+_summary_executor = None
+_summary_lock = threading.Lock()
+
+
+def get_summary_cache():
+    global _summary_cache
+    with _summary_lock:
+        if _summary_cache is None:
+            _summary_cache = SummaryCache()
+        return _summary_cache
+
+
+def get_summary_executor():
+    """ Threads partagés par toutes les sessions pour les appels de résumé. """
+    global _summary_executor
+    with _summary_lock:
+        if _summary_executor is None:
+            _summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='context-summary')
+        return _summary_executor
+
+
+def create_context_compactor(compaction_config: Optional[Dict], api_type,
+                             response_cache_config: Optional[Dict] = None) -> Optional[ContextCompactor]:
+    """
+    Crée le compacteur d'une session à partir de la section "context_compaction" (None si désactivée) ; les
+    appels de résumé passent par le cache de réponses configuré par la section "response_cache".
+    """
+    compaction_config = compaction_config or {}
+    if not compaction_config.get('enabled', DEFAULT_ENABLED):
+        return None
+    return ContextCompactor(
+        api_type=api_type,
+        summary_model=compaction_config.get('summary_model'),
+        segment_messages=int(compaction_config.get('segment_messages', DEFAULT_SEGMENT_MESSAGES)),
+        trigger_ratio=float(compaction_config.get('trigger_ratio', DEFAULT_TRIGGER_RATIO)),
+        target_ratio=float(compaction_config.get('target_ratio', DEFAULT_TARGET_RATIO)),
+        summary_max_tokens=int(compaction_config.get('summary_max_tokens', DEFAULT_SUMMARY_MAX_TOKENS)),
+        message_chars=int(compaction_config.get('message_chars', DEFAULT_MESSAGE_CHARS)),
+        response_cache_config=response_cache_config
+    )
@@ -0,0 +1,210 @@
+import re
+from typing import *
+
+# Caractères qui interrompent une suite de caractères ordinaires dans une chaîne JSON
+_STRING_SPECIAL_CHARS = re.compile(r'[\\"\n]')
+_SIMPLE_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class StreamingCodeArgumentParser:
+    """
+    Décodeur JSON incrémental pour les arguments `{"code": "..."}` transmis en flux par l'API.
+    Chaque delta n'est lu qu'une seule fois : le coût d'un appel à feed() est proportionnel à la taille du delta.
+    Le décodeur tolère le format non standard souvent produit par GPT (sauts de ligne bruts dans la chaîne) :
+    dans ce cas, comme parse_json, le code est conservé tel quel, sans interprétation des séquences d'échappement.
+    Avec raw_code=True (appel halluciné de la fonction `python`), les arguments sont du code brut.
+    """
+    def __init__(self, raw_code=False, key='code'):
+        self.raw_code = raw_code
+        self.key = key
+        self.state = 'value' if raw_code else 'object_start'
+        self.current_key = ''
+        self.in_code_value = raw_code
+        self.has_code = raw_code
+        self.non_standard = False
+        self.error = False
+        self.code = ''
+        self.raw = ''
+        self.pending = ''  # Échappement \uXXXX incomplet ou guillemet de fin potentiel (format non standard)
+        self.high_surrogate = None
+
+    def feed(self, delta: str):
+        """ Consomme un nouveau delta. Retourne True si le code décodé a changé. """
+        if self.error or not delta:
+            return False
+        if self.raw_code:
+            self.code += delta
+            return True
+        previous_length = len(self.code)
+        index = 0
+        length = len(delta)
+        while index < length and not self.error:
+            index = getattr(self, f'_feed_{self.state}')(delta, index)
+        return len(self.code) != previous_length
+
+    def finish(self) -> Optional[str]:
+        """
+        Retourne le code complet une fois le flux terminé, ou None si les arguments n'ont pas pu être décodés.
+        """
+        if self.raw_code:
+            return self.code
+        if self.error or not self.has_code:
+            return None
+        if self.non_standard:
+            if self.state in ('maybe_end', 'after_value', 'done') and self.pending.strip() in ('', '}'):
+                return self.code.strip('\n')
+            return None
+        if self.state in ('after_value', 'done'):
+            return self.code
+        return None
+
+    def _append(self, decoded, raw):
+        if self.in_code_value:
+            self.code += decoded
+            self.raw += raw
+
+    def _fail(self):
+        self.error = True
+        return 0
+
+    def _feed_object_start(self, delta, index):
+        char = delta[index]
+        if char == '{':
+            self.state = 'key_start'
+        elif not char.isspace():
+            self._fail()
+        return index + 1
+
+    def _feed_key_start(self, delta, index):
+        char = delta[index]
+        if char == '"':
+            self.current_key = ''
+            self.state = 'key'
+        elif char == '}':
+            self.state = 'done'
+        elif not (char.isspace() or char == ','):
+            self._fail()
+        return index + 1
+
+    def _feed_key(self, delta, index):
+        end = delta.find('"', index)
+        if end == -1:
+            self.current_key += delta[index:]
+            return len(delta)
+        self.current_key += delta[index:end]
+        self.state = 'colon'
+        return end + 1
+
+    def _feed_colon(self, delta, index):
+        char = delta[index]
+        if char == ':':
+            self.state = 'value_start'
+        elif not char.isspace():
+            self._fail()
+        return index + 1
+
+    def _feed_value_start(self, delta, index):
+        char = delta[index]
+        if char == '"':
+            self.state = 'value'
+            self.in_code_value = self.current_key == self.key
+            if self.in_code_value:
+                self.has_code = True
+        elif not char.isspace():
+            self._fail()
+        return index + 1
+
+    def _feed_value(self, delta, index):
+        if self.non_standard:
+            end = delta.find('"', index)
+            if end == -1:
+                self._append(delta[index:], delta[index:])
+                return len(delta)
+            self._append(delta[index:end], delta[index:end])
+            self.pending = ''
+            self.state = 'maybe_end'
+            return end + 1
+
+        match = _STRING_SPECIAL_CHARS.search(delta, index)
+        if match is None:
+            self._append(delta[index:], delta[index:])
+            return len(delta)
+        end = match.start()
+        self._append(delta[index:end], delta[index:end])
+        char = delta[end]
+        if char == '\\':
+            self.state = 'escape'
+        elif char == '"':
+            self.in_code_value = False
+            self.state = 'after_value'
+        else:
+            # Saut de ligne brut : format non standard, le code est conservé tel quel
+            if self.in_code_value:
+                self.non_standard = True
+                self.code = self.raw
+            self._append('\n', '\n')
+        return end + 1
+
+    def _feed_escape(self, delta, index):
+        char = delta[index]
+        if char == 'u':
+            self.pending = ''
+            self.state = 'unicode'
+        else:
+            self._append(_SIMPLE_ESCAPES.get(char, char), '\\' + char)
+            self.state = 'value'
+        return index + 1
+
+    def _feed_unicode(self, delta, index):
+        needed = 4 - len(self.pending)
+        self.pending += delta[index:index + needed]
+        index += needed
+        if len(self.pending) < 4:
+            return index
+        try:
+            code_point = int(self.pending, 16)
+        except ValueError:
+            return self._fail()
+        raw = '\\u' + self.pending
+        self.pending = ''
+        self.state = 'value'
+        if 0xD800 <= code_point < 0xDC00:
+            self.high_surrogate = code_point
+            self.raw += raw if self.in_code_value else ''
+            return index
+        if 0xDC00 <= code_point < 0xE000 and self.high_surrogate is not None:
+            code_point = 0x10000 + ((self.high_surrogate - 0xD800) << 10) + (code_point - 0xDC00)
+        self.high_surrogate = None
+        self._append(chr(code_point), raw)
+        return index
+
+    def _feed_maybe_end(self, delta, index):
+        # Format non standard : un guillemet ne termine le code que s'il n'est suivi que de blancs puis de '}'
+        while index < len(delta):
+            char = delta[index]
+            if char.isspace():
+                self.pending += char
+                index += 1
+            elif char == '}' and '}' not in self.pending:
+                self.pending += char
+                index += 1
+            else:
+                restored = '"' + self.pending
+                self.pending = ''
+                self._append(restored, restored)
+                self.state = 'value'
+                return index
+        return index
+
+    def _feed_after_value(self, delta, index):
+        char = delta[index]
+        if char == ',':
+            self.state = 'key_start'
+        elif char == '}':
+            self.state = 'done'
+        elif not char.isspace():
+            self._fail()
+        return index + 1
+
+    def _feed_done(self, delta, index):
+        return len(delta)
@@ -1,116 +1,202 @@
 from bot_backend import *
+import asyncio
 import base64
-import time
-import tiktoken
-from notebook_serializer import add_code_cell_error_to_notebook, add_image_to_notebook, add_code_cell_output_to_notebook
+from token_ledger import TOKENS_PER_REPLY
+from response_cache import get_response_cache
+from image_utils import get_image_size_from_bytes, get_image_size_from_file, save_image_bytes
+from tracing import span, traced
 
 # Message utilisé pour indiquer que la conversation a été tronquée pour tenir dans la fenêtre de tokens
 SLICED_CONV_MESSAGE = "[Le reste de la conversation a été omis pour s'intégrer dans la fenêtre contextuelle.]"
 
-def get_conversation_slice(conversation, model, encoding_for_which_model, min_output_tokens_count=500):
+@traced('conversation_slice')
+def get_conversation_slice(conversation, model, token_ledger, functions=None, min_output_tokens_count=500,
+                           context_compactor=None):
     """
     Extrait une portion de la conversation qui s'adapte à la limite de tokens du modèle utilisé.
-    Cette fonction garde le premier message complet et autant de messages récents que possible.
+    Cette fonction garde le premier message complet et autant de messages récents que possible ; avec un
+    compacteur, les messages les plus anciens sont remplacés par leur résumé plutôt que simplement retirés.
     Paramètres :
     - conversation : Liste des messages échangés
     - model : Le modèle de GPT utilisé
-    - encoding_for_which_model : Encodage spécifique au modèle
+    - token_ledger : Registre des tokens de la conversation (voir token_ledger.TokenLedger)
+    - functions : Schéma des fonctions envoyé avec la requête, compté dans le budget
     - min_output_tokens_count : Nombre minimal de tokens réservés pour la réponse du modèle
+    - context_compactor : Compacteur de la session (voir context_compactor.ContextCompactor), ou None
     Retourne un tuple contenant la conversation tronquée, le nombre total de tokens, et un booléen indiquant si la troncature a eu lieu.
     """
-    encoder = tiktoken.encoding_for_model(encoding_for_which_model)
-    count_tokens = lambda txt: len(encoder.encode(txt))
-    nb_tokens = count_tokens(conversation[0]['content'])
-    sliced_conv = [conversation[0]]
+    assert len(token_ledger) == len(conversation), "Le registre de tokens n'est pas synchronisé avec la conversation."
+    sliced_conv_message = {'role': 'system', 'content': SLICED_CONV_MESSAGE}
+    fixed_tokens = token_ledger.message_tokens[0] + TOKENS_PER_REPLY
+    if functions:
+        fixed_tokens += token_ledger.functions_tokens
     context_window_limit = int(config['model_context_window'][model])
-    max_tokens = context_window_limit - count_tokens(SLICED_CONV_MESSAGE) - min_output_tokens_count
-    sliced = False
-    for message in conversation[-1:0:-1]:
-        nb_tokens += count_tokens(message['content'])
-        if nb_tokens > max_tokens:
-            sliced_conv.insert(1, {'role': 'system', 'content': SLICED_CONV_MESSAGE})
-            sliced = True
-            break
-        sliced_conv.insert(1, message)
+    max_tokens = context_window_limit - token_ledger.count_message(sliced_conv_message) \
+        - min_output_tokens_count - fixed_tokens
+
+    if context_compactor is not None:
+        compacted = context_compactor.get_slice(
+            conversation=conversation, token_ledger=token_ledger, model=model, max_tokens=max_tokens,
+            fixed_tokens=fixed_tokens, sliced_conv_message=sliced_conv_message
+        )
+        if compacted is not None:
+            return compacted
+
+    cut_index = token_ledger.find_cut_index(budget=max_tokens)
+    nb_tokens = fixed_tokens + token_ledger.suffix_tokens(cut_index)
+    sliced = cut_index > 1
+    if sliced:
+        sliced_conv = [conversation[0], sliced_conv_message]
+        sliced_conv.extend(conversation[cut_index:])
+        nb_tokens += token_ledger.count_message(sliced_conv_message)
+    else:
+        sliced_conv = list(conversation)
     return sliced_conv, nb_tokens, sliced
 
-def chat_completion(bot_backend: BotBackend):
+def get_kwargs_for_chat_completion(bot_backend: BotBackend):
     """
-    Réalise une complétion de chat en utilisant le modèle spécifié dans bot_backend.
-    Gère la troncature de la conversation pour s'adapter à la fenêtre de contexte du modèle.
+    Prépare les arguments de la requête de complétion : tronque la conversation pour l'adapter à la fenêtre de
+    contexte du modèle et met à jour le compteur de tokens du backend.
     """
     model_choice = bot_backend.gpt_model_choice
     model_name = bot_backend.config['model'][model_choice]['model_name']
-    kwargs_for_chat_completion = copy.deepcopy(bot_backend.kwargs_for_chat_completion)
-    if bot_backend.config['API_TYPE'] == "azure":
-        kwargs_for_chat_completion['messages'], nb_tokens, sliced = \
-            get_conversation_slice(
-                conversation=kwargs_for_chat_completion['messages'],
-                model=model_name,
-                encoding_for_which_model='gpt-3.5-turbo' if model_choice == 'GPT-3.5' else 'gpt-4'
-            )
-    else:
-        kwargs_for_chat_completion['messages'], nb_tokens, sliced = \
-            get_conversation_slice(
-                conversation=kwargs_for_chat_completion['messages'],
-                model=model_name,
-                encoding_for_which_model=model_name
-            )
+    kwargs_for_chat_completion = dict(bot_backend.kwargs_for_chat_completion)
+
+    assert config['model'][model_choice]['available'], f"{model_choice} n'est pas accessible avec votre clé API"
+    assert model_name in config['model_context_window'], f"{model_name} manque d'informations sur la fenêtre de contexte. Veuillez vérifier le fichier config.json."
+
+    kwargs_for_chat_completion['messages'], nb_tokens, sliced = \
+        get_conversation_slice(
+            conversation=bot_backend.conversation,
+            model=model_name,
+            token_ledger=bot_backend.token_ledger,
+            functions=kwargs_for_chat_completion.get('functions'),
+            context_compactor=bot_backend.context_compactor
+        )
 
     bot_backend.update_token_count(num_tokens=nb_tokens)
     bot_backend.update_sliced_state(sliced=sliced)
+    return kwargs_for_chat_completion
 
-    assert config['model'][model_choice]['available'], f"{model_choice} n'est pas accessible avec votre clé API"
-    assert model_name in config['model_context_window'], f"{model_name} manque d'informations sur la fenêtre de contexte. Veuillez vérifier le fichier config.json."
+def chat_completion(bot_backend: BotBackend):
+    """
+    Réalise une complétion de chat en utilisant le modèle spécifié dans bot_backend.
+    Gère la troncature de la conversation pour s'adapter à la fenêtre de contexte du modèle.
+    """
+    kwargs_for_chat_completion = get_kwargs_for_chat_completion(bot_backend)
+    with span('chat_completion.request'):
+        response = get_response_cache(config.get('response_cache')).create(
+            kwargs_for_chat_completion, openai.ChatCompletion.create
+        )
+    return response
 
-    response = openai.ChatCompletion.create(**kwargs_for_chat_completion)
+async def async_chat_completion(bot_backend: BotBackend):
+    """
+    Variante asynchrone de chat_completion : retourne un générateur asynchrone de chunks.
+    """
+    kwargs_for_chat_completion = get_kwargs_for_chat_completion(bot_backend)
+    with span('chat_completion.request'):
+        response = await get_response_cache(config.get('response_cache')).acreate(
+            kwargs_for_chat_completion, openai.ChatCompletion.acreate
+        )
     return response
 
-def add_code_execution_result_to_bot_history(content_to_display, history, unique_id):
+# Contenu provisoire de la bulle d'une image dont l'écriture sur disque n'est pas terminée
+IMAGE_PENDING_TEXT = '🖼️ ...'
+
+class CodeExecutionResultRenderer:
     """
-    Ajoute les résultats d'exécution de code à l'historique du bot, incluant texte et images.
-    Gère les erreurs et assure que toute sortie est correctement enregistrée et formatée.
+    Affiche les résultats d'exécution de code dans l'historique du bot au fur et à mesure de leur arrivée.
+    La bulle de texte est créée dès le départ et mise à jour en place, les images sont ajoutées à sa suite.
+    Les sorties ne sont inscrites dans le journal du notebook qu'à l'appel de finish(), une fois la cellule de code ajoutée.
     """
-    images, text = [], []
-    error_occurred = False
+    def __init__(self, history, unique_id, notebook_log=None):
+        self.history = history
+        self.unique_id = unique_id
+        self.notebook_log = notebook_log
+        self.text = []
+        self.notebook_outputs = []
+        self.image_writes = []
+        self.error_occurred = False
+        self.text_message = [None, self._render_text('⏳Sortie en cours:')]
+        history.append(self.text_message)
 
-    for mark, out_str in content_to_display:
+    def _render_text(self, header):
+        text = '\n'.join(self.text).strip('\n')
+        return f'{header}\n```shell\n{text}\n```'
+
+    def add_output(self, mark, out_str):
+        """ Ajoute une sortie (mark, out_str) du noyau à l'historique. """
         if mark in ('stdout', 'execute_result_text', 'display_text'):
-            text.append(out_str)
-            add_code_cell_output_to_notebook(out_str)
+            self.text.append(out_str)
+            self.notebook_outputs.append((mark, out_str))
+            self.text_message[1] = self._render_text('⏳Sortie en cours:')
         elif mark in ('execute_result_png', 'execute_result_jpeg', 'display_png', 'display_jpeg'):
-            if 'png' in mark:
-                images.append(('png', out_str))
-                add_image_to_notebook(out_str, 'image/png')
-            else:
-                add_image_to_notebook(out_str, 'image/jpeg')
-                images.append(('jpg', out_str))
+            path = self._add_image('png' if 'png' in mark else 'jpg', out_str)
+            self.notebook_outputs.append((mark, path))
         elif mark == 'error':
-            text.append(delete_color_control_char(out_str))
-            error_occurred = True
-            add_code_cell_error_to_notebook(out_str)
-    text = '\n'.join(text).strip('\n')
-    if error_occurred:
-        history.append([None, f'❌Erreur de sortie:\n```shell\n{text}\n```'])
-    else:
-        history.append([None, f'✔️Sortie du terminal:\n```shell\n{text}\n```'])
+            self.text.append(delete_color_control_char(out_str))
+            self.error_occurred = True
+            self.notebook_outputs.append((mark, out_str))
+            self.text_message[1] = self._render_text('⏳Sortie en cours:')
 
-    for filetype, img in images:
+    def _add_image(self, filetype, img):
         image_bytes = base64.b64decode(img)
-        temp_path = f'cache/temp_{unique_id}'
-        if not os.path.exists(temp_path):
-            os.mkdir(temp_path)
-        path = f'{temp_path}/{hash(time.time())}.{filetype}'
-        with open(path, 'wb') as f:
-            f.write(image_bytes)
-        width, height = get_image_size(path)
-        history.append(
-            [
-                None,
-                f'<img src=\"file={path}\" style=\'{"" if width < 800 else "width: 800px;"} max-width:none; '
-                f'max-height:none\'> '
-            ]
-        )
+        # Dimensions lues dans l'en-tête de l'image déjà en mémoire ; l'écriture sur disque se fait en arrière-plan
+        width, height = get_image_size_from_bytes(image_bytes) or (0, 0)
+        path, write_future = save_image_bytes(f'cache/temp_{self.unique_id}', image_bytes, filetype)
+        image_html = f'<img src=\"file={path}\" style=\'{"" if width < 800 else "width: 800px;"} max-width:none; ' \
+                     f'max-height:none\'> '
+        # La bulle est réservée à sa place mais ne référence le fichier qu'une fois celui-ci écrit : sinon le
+        # navigateur peut le demander avant qu'il existe
+        image_message = [None, IMAGE_PENDING_TEXT]
+        self.history.append(image_message)
+        write_future.add_done_callback(lambda future: self._show_image(image_message, image_html, future))
+        self.image_writes.append((write_future, image_message, image_html))
+        return path
+
+    @staticmethod
+    def _show_image(image_message, image_html, write_future):
+        if write_future.exception() is None:
+            image_message[1] = image_html
+
+    async def wait_for_images(self):
+        """ Attend l'écriture des images sans bloquer la boucle d'événements ; finish() n'a ensuite plus à attendre. """
+        for write_future, _, _ in self.image_writes:
+            await asyncio.wrap_future(write_future)
+
+    def finish(self):
+        """ Fige l'en-tête de la sortie, attend l'écriture des images et inscrit les sorties dans le notebook. """
+        for write_future, image_message, image_html in self.image_writes:
+            write_future.result()
+            # Le callback du Future peut ne pas encore avoir été exécuté lorsque result() retourne
+            image_message[1] = image_html
+        if self.error_occurred:
+            self.text_message[1] = self._render_text('❌Erreur de sortie:')
+        else:
+            self.text_message[1] = self._render_text('✔️Sortie du terminal:')
+
+        if self.notebook_log is None:
+            return
+        for mark, out_str in self.notebook_outputs:
+            if mark in ('stdout', 'execute_result_text', 'display_text'):
+                self.notebook_log.add_code_cell_output(out_str)
+            elif mark == 'error':
+                self.notebook_log.add_code_cell_error(out_str)
+            elif 'png' in mark:
+                self.notebook_log.add_image(out_str, 'image/png')
+            else:
+                self.notebook_log.add_image(out_str, 'image/jpeg')
+
+def add_code_execution_result_to_bot_history(content_to_display, history, unique_id, notebook_log=None):
+    """
+    Ajoute les résultats d'exécution de code à l'historique du bot, incluant texte et images.
+    Gère les erreurs et assure que toute sortie est correctement enregistrée et formatée.
+    """
+    renderer = CodeExecutionResultRenderer(history=history, unique_id=unique_id, notebook_log=notebook_log)
+    for mark, out_str in content_to_display:
+        renderer.add_output(mark, out_str)
+    renderer.finish()
 
 def add_function_response_to_bot_history(hypertext_to_display, history):
     """
@@ -198,8 +284,12 @@ def parse_json(function_args: str, finished: bool):
 def get_image_size(image_path):
     """
     Obtient les dimensions d'une image à partir de son chemin.
-    Retourne la largeur et la hauteur de l'image.
+    Retourne la largeur et la hauteur de l'image, lues dans ses en-têtes ; PIL n'est utilisé que pour les
+    formats non reconnus.
     """
+    size = get_image_size_from_file(image_path)
+    if size is not None:
+        return size
     with Image.open(image_path) as img:
         width, height = img.size
     return width, height
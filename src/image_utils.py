@@ -0,0 +1,159 @@
+import hashlib
+import os
+import struct
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+from tracing import traced
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Marqueurs JPEG "Start Of Frame" qui portent les dimensions de l'image (C4, C8 et CC n'en sont pas)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Taille lue au début d'un fichier pour en trouver les dimensions
+IMAGE_HEADER_READ_SIZE = 64 * 1024
+
+# Les images produites par le code sont écrites sur disque par un petit pool de threads
+_image_writer_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='image-writer')
+_pending_writes: Dict[str, Future] = {}
+_pending_writes_lock = threading.Lock()
+
+
+def get_png_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """ Lit les dimensions dans le bloc IHDR d'un PNG. """
+    if len(data) < 24 or not data.startswith(PNG_SIGNATURE) or data[12:16] != b'IHDR':
+        return None
+    width, height = struct.unpack('>II', data[16:24])
+    return width, height
+
+
+def get_jpeg_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """ Parcourt les segments d'un JPEG jusqu'au marqueur SOF qui contient les dimensions. """
+    if not data.startswith(b'\xff\xd8'):
+        return None
+    index = 2
+    length = len(data)
+    while index + 4 <= length:
+        if data[index] != 0xFF:
+            return None
+        marker = data[index + 1]
+        if marker == 0xFF:
+            # Octet de remplissage
+            index += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            index += 2
+            continue
+        if marker == 0xD9:
+            return None
+        segment_length = struct.unpack('>H', data[index + 2:index + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if index + 9 > length:
+                return None
+            height, width = struct.unpack('>HH', data[index + 5:index + 9])
+            return width, height
+        index += 2 + segment_length
+    return None
+
+
+def get_gif_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """ Lit les dimensions dans le descripteur d'écran logique d'un GIF. """
+    if len(data) < 10 or data[:6] not in (b'GIF87a', b'GIF89a'):
+        return None
+    width, height = struct.unpack('<HH', data[6:10])
+    return width, height
+
+
+def get_bmp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """ Lit les dimensions dans l'en-tête DIB d'un BMP (la hauteur est négative pour les images de haut en bas). """
+    if len(data) < 26 or not data.startswith(b'BM'):
+        return None
+    header_size = struct.unpack('<I', data[14:18])[0]
+    if header_size == 12:
+        width, height = struct.unpack('<HH', data[18:22])
+    else:
+        width, height = struct.unpack('<ii', data[18:26])
+    return abs(width), abs(height)
+
+
+def get_webp_size(data: bytes) -> Optional[Tuple[int, int]]:
+    """ Lit les dimensions dans le premier bloc d'un WEBP (formats VP8, VP8L et VP8X). """
+    if len(data) < 30 or data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and data[20] == 0x2F:
+        bits = struct.unpack('<I', data[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+def get_image_size_from_bytes(data: bytes) -> Optional[Tuple[int, int]]:
+    """ Retourne (largeur, hauteur) à partir des en-têtes de l'image, ou None si le format n'est pas reconnu. """
+    return get_png_size(data) or get_jpeg_size(data) or get_gif_size(data) or get_bmp_size(data) \
+        or get_webp_size(data)
+
+
+def get_image_size_from_file(path) -> Optional[Tuple[int, int]]:
+    """
+    Retourne les dimensions d'une image sans la décoder.
+    Seul le début du fichier est lu, sauf pour un JPEG dont le marqueur SOF se trouve après de longues
+    métadonnées (EXIF, vignette).
+    """
+    with open(path, 'rb') as f:
+        data = f.read(IMAGE_HEADER_READ_SIZE)
+        size = get_image_size_from_bytes(data)
+        if size is None and data.startswith(b'\xff\xd8'):
+            size = get_jpeg_size(data + f.read())
+    return size
+
+
+def get_content_addressed_path(directory, data: bytes, filetype):
+    """ Chemin de l'image dérivé de son contenu : deux images identiques partagent le même fichier. """
+    digest = hashlib.sha1(data).hexdigest()
+    return f'{directory}/{digest}.{filetype}'
+
+
+@traced('image.write')
+def _write_file(path, data: bytes):
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+
+def save_image_bytes(directory, data: bytes, filetype) -> Tuple[str, Future]:
+    """
+    Enregistre l'image sous un nom dérivé de son contenu, en arrière-plan.
+    Retourne le chemin et un Future terminé lorsque le fichier est disponible.
+    """
+    path = get_content_addressed_path(directory, data, filetype)
+    with _pending_writes_lock:
+        future = _pending_writes.get(path)
+        if future is None:
+            if os.path.exists(path):
+                future = Future()
+                future.set_result(path)
+                return path, future
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            future = _image_writer_pool.submit(_write_file, path, data)
+            _pending_writes[path] = future
+            new_write = True
+        else:
+            new_write = False
+    if new_write:
+        # Hors du verrou : le callback s'exécute immédiatement si l'écriture est déjà terminée
+        future.add_done_callback(lambda _: _forget_pending_write(path))
+    return path, future
+
+
+def _forget_pending_write(path):
+    with _pending_writes_lock:
+        _pending_writes.pop(path, None)
@@ -1,5 +1,15 @@
 import jupyter_client
+import atexit
+import json
+import queue
 import re
+import socket
+import threading
+import time
+import zmq
+import zmq.asyncio
+from tracing import span, register_gauges
+from kernel_limits import get_kernel_pid
 
 
 def delete_color_control_char(string):
@@ -7,78 +17,321 @@ def delete_color_control_char(string):
     return ansi_escape.sub('', string)
 
 
+def start_new_kernel():
+    return jupyter_client.manager.start_new_kernel(kernel_name='python3')
+
+
+def shutdown_kernel(kernel_manager, kernel_client):
+    kernel_client.stop_channels()
+    kernel_manager.shutdown_kernel(now=True)
+
+
+# Saves the kernel namespace before the kernel is shut down for inactivity. Modules are saved by name and
+# functions and classes defined in cells by source; every other value is pickled on its own, so one value that
+# cannot be pickled (or would exceed max_bytes) does not prevent saving the others.
+HIBERNATE_CODE = '''def __hibernate_namespace(path, max_bytes):
+    import inspect, json, pickle, types
+    ip = get_ipython()
+    hidden = set(ip.user_ns_hidden)
+    modules, sources, values, lost, total_bytes = {{}}, {{}}, {{}}, [], 0
+    for name, value in list(ip.user_ns.items()):
+        if name.startswith('_') or name in hidden:
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        if isinstance(value, (types.FunctionType, type)) and value.__module__ == '__main__':
+            try:
+                sources[name] = inspect.getsource(value)
+            except Exception:
+                lost.append(name)
+            continue
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            lost.append(name)
+            continue
+        if total_bytes + len(data) > max_bytes:
+            lost.append(name)
+            continue
+        values[name] = data
+        total_bytes += len(data)
+    with open(path, 'wb') as f:
+        pickle.dump({{'modules': modules, 'sources': sources, 'values': values}}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    print(json.dumps({{'saved': sorted(values) + sorted(sources), 'modules': sorted(modules), 'lost': sorted(lost)}}))
+__hibernate_namespace({path!r}, {max_bytes!r})
+del __hibernate_namespace'''
+
+# Restores a namespace saved by HIBERNATE_CODE and prints the names that could not be restored
+RESTORE_CODE = '''def __restore_namespace(path):
+    import importlib, json, pickle
+    ip = get_ipython()
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    lost = []
+    for name, module_name in state['modules'].items():
+        try:
+            ip.user_ns[name] = importlib.import_module(module_name)
+        except Exception:
+            lost.append(name)
+    for name, source in state['sources'].items():
+        try:
+            exec(compile(source, f'<restored {{name}}>', 'exec'), ip.user_ns)
+        except Exception:
+            lost.append(name)
+    for name, data in state['values'].items():
+        try:
+            ip.user_ns[name] = pickle.loads(data)
+        except Exception:
+            lost.append(name)
+    print(json.dumps(sorted(lost)))
+__restore_namespace({path!r})
+del __restore_namespace'''
+
+
+class KernelPool:
+    """
+    Process-wide pool of pre-started kernels.
+    Kernels are started by a background thread so that session creation and restarts only have to
+    take a ready kernel from the queue. The pool is refilled after every checkout.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.ready_kernels = queue.Queue()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.refill_needed = threading.Event()
+        self.closed = False
+        if self.size > 0:
+            self.refill_needed.set()
+            self.refill_thread = threading.Thread(target=self._refill_loop, name='kernel-pool-refill', daemon=True)
+            self.refill_thread.start()
+
+    def _refill_loop(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            while not self.closed and self.ready_kernels.qsize() < self.size:
+                try:
+                    kernel = start_new_kernel()
+                except Exception:
+                    break
+                if self.closed:
+                    shutdown_kernel(*kernel)
+                    return
+                self.ready_kernels.put(kernel)
+            if self.closed:
+                return
+
+    def checkout(self):
+        """
+        Return a (kernel_manager, kernel_client) pair, taken from the pool when one is ready.
+        Falls back to starting a kernel synchronously when the pool is empty.
+        """
+        try:
+            kernel = self.ready_kernels.get_nowait()
+            with self.lock:
+                self.hits += 1
+        except queue.Empty:
+            kernel = None
+            with self.lock:
+                self.misses += 1
+        if self.size > 0:
+            self.refill_needed.set()
+        if kernel is None:
+            kernel = start_new_kernel()
+        return kernel
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'available': self.ready_kernels.qsize(),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def shutdown(self):
+        self.closed = True
+        self.refill_needed.set()
+        while True:
+            try:
+                kernel = self.ready_kernels.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                shutdown_kernel(*kernel)
+            except Exception:
+                pass
+
+
+_kernel_pool = None
+_kernel_pool_lock = threading.Lock()
+
+
+def get_kernel_pool(size=0):
+    """
+    Return the process-wide kernel pool, creating it with `size` ready kernels on first call.
+    """
+    global _kernel_pool
+    with _kernel_pool_lock:
+        if _kernel_pool is None:
+            _kernel_pool = KernelPool(size=size)
+            atexit.register(_kernel_pool.shutdown)
+            register_gauges('kernel_pool', _kernel_pool.get_metrics)
+        return _kernel_pool
+
+
 class JupyterKernel:
-    def __init__(self, work_dir):
-        self.kernel_manager, self.kernel_client = jupyter_client.manager.start_new_kernel(kernel_name='python3')
+    def __init__(self, work_dir, kernel_pool=None, kernel_monitor=None):
+        self.kernel_pool = kernel_pool
+        self.kernel_monitor = kernel_monitor
+        self.kernel_manager, self.kernel_client = self._checkout_kernel()
         self.work_dir = work_dir
         self.interrupt_signal = False
+        # Set by the kernel monitor: latest resource usage, and the message to report when it interrupted
+        # the running cell for exceeding the memory limit
+        self.executing = False
+        self.resource_usage = None
+        self.limit_exceeded = None
+        self.last_activity = time.time()
+        self.hibernated = False
+        self.liveness_check_interval_ms = 1000
+        self._interrupt_receiver, self._interrupt_sender = socket.socketpair()
+        self._interrupt_receiver.setblocking(False)
+        self._interrupt_sender.setblocking(False)
         self._create_work_dir()
+        self._apply_limits()
         self.available_functions = {
             'execute_code': self.execute_code,
             'python': self.execute_code
         }
 
-    def execute_code_(self, code):
-        msg_id = self.kernel_client.execute(code)
+    def execute_code_stream(self, code):
+        """
+        Execute code and yield (mark, out_str) outputs as soon as the kernel publishes them.
+        """
+        # The span is not made current: the caller's context must not change across the yields
+        execution_span = span('kernel.execute', tool='execute_code')
+        self.limit_exceeded = None
+        self.executing = True
+        try:
+            msg_id = self.kernel_client.execute(code)
 
-        # Get the output of the code
-        msg_list = []
-        while True:
-            try:
-                iopub_msg = self.kernel_client.get_iopub_msg(timeout=1)
-                msg_list.append(iopub_msg)
-                if iopub_msg['msg_type'] == 'status' and iopub_msg['content'].get('execution_state') == 'idle':
-                    break
-            except:
-                if self.interrupt_signal:
-                    self.kernel_manager.interrupt_kernel()
-                    self.interrupt_signal = False
+            # Wait on the iopub socket and on the interrupt wake-up socket at the same time, so messages
+            # are handled as soon as they arrive and interrupts do not wait for a poll timeout
+            poller = zmq.Poller()
+            poller.register(self.kernel_client.iopub_channel.socket, zmq.POLLIN)
+            poller.register(self._interrupt_receiver, zmq.POLLIN)
+
+            while True:
+                events = dict(poller.poll(self.liveness_check_interval_ms))
+                outputs, finished = self._handle_poll_events(events, msg_id, execution_span)
+                yield from outputs
+                if finished:
+                    return
+        finally:
+            self.executing = False
+            self.last_activity = time.time()
+            execution_span.end()
+
+    async def async_execute_code_stream(self, code):
+        """
+        Async variant of execute_code_stream.
+        The same sockets are polled from the event loop (zmq.asyncio), so a running cell does not hold a thread
+        and the number of concurrent executions is not bounded by a thread pool.
+        """
+        execution_span = span('kernel.execute', tool='execute_code')
+        self.limit_exceeded = None
+        self.executing = True
+        try:
+            msg_id = self.kernel_client.execute(code)
+
+            poller = zmq.asyncio.Poller()
+            poller.register(self.kernel_client.iopub_channel.socket, zmq.POLLIN)
+            poller.register(self._interrupt_receiver, zmq.POLLIN)
+
+            while True:
+                events = dict(await poller.poll(self.liveness_check_interval_ms))
+                outputs, finished = self._handle_poll_events(events, msg_id, execution_span)
+                for output in outputs:
+                    yield output
+                if finished:
+                    return
+        finally:
+            self.executing = False
+            self.last_activity = time.time()
+            execution_span.end()
+
+    def _handle_poll_events(self, events, msg_id, execution_span):
+        """
+        Handle the result of one poll of the execution sockets without blocking: forward a pending interrupt,
+        check that the kernel is alive and read the iopub messages already received.
+        Return the outputs of the execution `msg_id` and whether the execution is finished.
+        """
+        if self._interrupt_receiver in events:
+            self._drain_interrupt_wakeups()
+        if self.interrupt_signal:
+            self.kernel_manager.interrupt_kernel()
+            self.interrupt_signal = False
+        if not events and not self.kernel_manager.is_alive():
+            execution_span.set_label('error', 'KernelDied')
+            return [('error', 'The Jupyter kernel died while executing the code.')], True
+
+        outputs = []
+        iopub_channel = self.kernel_client.iopub_channel
+        while iopub_channel.msg_ready():
+            iopub_msg = iopub_channel.get_msg(timeout=0)
+            # Skip messages left over from a previous execution
+            if iopub_msg['parent_header'].get('msg_id') != msg_id:
                 continue
+            if iopub_msg['msg_type'] == 'status':
+                if iopub_msg['content'].get('execution_state') == 'idle':
+                    if self.limit_exceeded is not None:
+                        execution_span.set_label('error', 'LimitExceeded')
+                        outputs.append(('error', self.limit_exceeded))
+                    return outputs, True
+                continue
+            outputs.extend(self._parse_iopub_msg(iopub_msg))
+        return outputs, False
 
-        all_output = []
-        for iopub_msg in msg_list:
-            if iopub_msg['msg_type'] == 'stream':
-                if iopub_msg['content'].get('name') == 'stdout':
-                    output = iopub_msg['content']['text']
-                    all_output.append(('stdout', output))
-            elif iopub_msg['msg_type'] == 'execute_result':
-                if 'data' in iopub_msg['content']:
-                    if 'text/plain' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/plain']
-                        all_output.append(('execute_result_text', output))
-                    if 'text/html' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/html']
-                        all_output.append(('execute_result_html', output))
-                    if 'image/png' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/png']
-                        all_output.append(('execute_result_png', output))
-                    if 'image/jpeg' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/jpeg']
-                        all_output.append(('execute_result_jpeg', output))
-            elif iopub_msg['msg_type'] == 'display_data':
-                if 'data' in iopub_msg['content']:
-                    if 'text/plain' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/plain']
-                        all_output.append(('display_text', output))
-                    if 'text/html' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['text/html']
-                        all_output.append(('display_html', output))
-                    if 'image/png' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/png']
-                        all_output.append(('display_png', output))
-                    if 'image/jpeg' in iopub_msg['content']['data']:
-                        output = iopub_msg['content']['data']['image/jpeg']
-                        all_output.append(('display_jpeg', output))
-            elif iopub_msg['msg_type'] == 'error':
-                if 'traceback' in iopub_msg['content']:
-                    output = '\n'.join(iopub_msg['content']['traceback'])
-                    all_output.append(('error', output))
-
-        return all_output
+    def execute_code_(self, code):
+        return list(self.execute_code_stream(code))
 
-    def execute_code(self, code):
+    @staticmethod
+    def _parse_iopub_msg(iopub_msg):
+        output = []
+        if iopub_msg['msg_type'] == 'stream':
+            if iopub_msg['content'].get('name') == 'stdout':
+                output.append(('stdout', iopub_msg['content']['text']))
+        elif iopub_msg['msg_type'] in ('execute_result', 'display_data'):
+            prefix = 'execute_result' if iopub_msg['msg_type'] == 'execute_result' else 'display'
+            data = iopub_msg['content'].get('data')
+            if data:
+                if 'text/plain' in data:
+                    output.append((f'{prefix}_text', data['text/plain']))
+                if 'text/html' in data:
+                    output.append((f'{prefix}_html', data['text/html']))
+                if 'image/png' in data:
+                    output.append((f'{prefix}_png', data['image/png']))
+                if 'image/jpeg' in data:
+                    output.append((f'{prefix}_jpeg', data['image/jpeg']))
+        elif iopub_msg['msg_type'] == 'error':
+            if 'traceback' in iopub_msg['content']:
+                output.append(('error', '\n'.join(iopub_msg['content']['traceback'])))
+        return output
+
+    def _drain_interrupt_wakeups(self):
+        try:
+            while self._interrupt_receiver.recv(1024):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    @staticmethod
+    def build_text_to_gpt(content_to_display):
         text_to_gpt = []
-        content_to_display = self.execute_code_(code)
         for mark, out_str in content_to_display:
             if mark in ('stdout', 'execute_result_text', 'display_text'):
                 text_to_gpt.append(out_str)
@@ -86,8 +339,11 @@ class JupyterKernel:
                 text_to_gpt.append('[image]')
             elif mark == 'error':
                 text_to_gpt.append(delete_color_control_char(out_str))
+        return '\n'.join(text_to_gpt)
 
-        return '\n'.join(text_to_gpt), content_to_display
+    def execute_code(self, code):
+        content_to_display = self.execute_code_(code)
+        return self.build_text_to_gpt(content_to_display), content_to_display
 
     def _create_work_dir(self):
         # set work dir in jupyter environment
@@ -98,11 +354,80 @@ class JupyterKernel:
                     f"del os"
         self.execute_code_(init_code)
 
+    @property
+    def kernel_pid(self):
+        return get_kernel_pid(self.kernel_manager)
+
+    def _apply_limits(self):
+        """
+        Apply the configured resource limits to the kernel process and start tracking its usage.
+        """
+        if self.kernel_monitor is None:
+            return
+        init_code = self.kernel_monitor.limits.get_init_code()
+        if init_code is not None:
+            self.execute_code_(init_code)
+        self.kernel_monitor.register(self)
+
+    def get_usage(self):
+        """
+        Return the latest resource usage measured by the kernel monitor, or None.
+        """
+        return self.resource_usage
+
     def send_interrupt_signal(self):
         self.interrupt_signal = True
+        try:
+            self._interrupt_sender.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            # The receiver already has pending wake-ups
+            pass
+
+    def _checkout_kernel(self):
+        if self.kernel_pool is not None:
+            return self.kernel_pool.checkout()
+        return start_new_kernel()
 
     def restart_jupyter_kernel(self):
-        self.kernel_client.shutdown()
-        self.kernel_manager, self.kernel_client = jupyter_client.manager.start_new_kernel(kernel_name='python3')
+        if self.kernel_client is not None:
+            self.kernel_client.shutdown()
+        self.kernel_manager, self.kernel_client = self._checkout_kernel()
         self.interrupt_signal = False
+        self.hibernated = False
+        self.resource_usage = None
+        self.limit_exceeded = None
         self._create_work_dir()
+        self._apply_limits()
+
+    @staticmethod
+    def _parse_json_output(content_to_display):
+        stdout = ''.join(out_str for mark, out_str in content_to_display if mark == 'stdout').strip()
+        try:
+            return json.loads(stdout.splitlines()[-1])
+        except (IndexError, ValueError):
+            raise RuntimeError(JupyterKernel.build_text_to_gpt(content_to_display))
+
+    def hibernate(self, namespace_path, max_namespace_bytes):
+        """
+        Save what can be saved of the kernel namespace to `namespace_path`, then shut the kernel down.
+        Return the kernel report: {'saved': [...], 'modules': [...], 'lost': [...]}.
+        The kernel is left running if the namespace could not be saved.
+        """
+        report = self._parse_json_output(self.execute_code_(
+            HIBERNATE_CODE.format(path=namespace_path, max_bytes=max_namespace_bytes)
+        ))
+        shutdown_kernel(self.kernel_manager, self.kernel_client)
+        self.kernel_manager, self.kernel_client = None, None
+        self.resource_usage = None
+        self.hibernated = True
+        return report
+
+    def resume(self, namespace_path=None):
+        """
+        Start a new kernel after hibernate() and restore the namespace saved in `namespace_path`.
+        Return the names that could not be restored.
+        """
+        self.restart_jupyter_kernel()
+        if namespace_path is None:
+            return []
+        return self._parse_json_output(self.execute_code_(RESTORE_CODE.format(path=namespace_path)))
@@ -0,0 +1,294 @@
+import os
+import threading
+import time
+import weakref
+from typing import *
+from tracing import register_gauges
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Valeurs par défaut de la section "kernel_limits" du fichier de configuration (None : pas de limite)
+DEFAULT_MEMORY_MB = None
+DEFAULT_CPU_SECONDS = None
+DEFAULT_MAX_PROCESSES = None
+DEFAULT_CPU_CORES = None
+# Part de la limite de mémoire à partir de laquelle l'exécution en cours est interrompue
+DEFAULT_SOFT_MEMORY_RATIO = 0.9
+DEFAULT_MONITOR_INTERVAL = 1.0
+DEFAULT_CGROUP_ROOT = None
+
+CPU_PERIOD_US = 100000
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# Code exécuté dans le noyau à son attribution à une session. RLIMIT_DATA fait échouer les allocations au-delà
+# de la limite (MemoryError) au lieu de laisser le noyau se faire tuer par l'OOM killer. La limite de temps CPU
+# est repoussée avant chaque cellule à cpu_seconds au-delà du temps déjà consommé : à son dépassement, SIGXCPU
+# interrompt la cellule en cours. Le nombre de processus n'est pas limité ici : RLIMIT_NPROC compte tous les
+# processus et threads de l'utilisateur sur la machine, et non ceux du noyau (voir pids.max dans create_cgroup).
+LIMITS_INIT_CODE = '''def __apply_kernel_limits(memory_bytes, cpu_seconds):
+    try:
+        import resource, signal
+    except ImportError:
+        return
+    if memory_bytes:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_bytes, memory_bytes))
+    if cpu_seconds:
+        def reset_cpu_limit(*args):
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            # Arrondi à la seconde supérieure : la cellule dispose d'au moins cpu_seconds
+            used = int(usage.ru_utime + usage.ru_stime) + 1
+            resource.setrlimit(resource.RLIMIT_CPU, (used + cpu_seconds, resource.RLIM_INFINITY))
+        def on_cpu_limit(signum, frame):
+            reset_cpu_limit()
+            raise KeyboardInterrupt(f"Limite de temps CPU de {{cpu_seconds}} s par cellule atteinte")
+        reset_cpu_limit()
+        signal.signal(signal.SIGXCPU, on_cpu_limit)
+        get_ipython().events.register('pre_run_cell', reset_cpu_limit)
+__apply_kernel_limits({memory_bytes!r}, {cpu_seconds!r})
+del __apply_kernel_limits'''
+
+
+class KernelLimits:
+    """ Limites appliquées à chaque noyau : mémoire, temps CPU par cellule, processus et cœurs (cgroups). """
+    def __init__(self, memory_mb=DEFAULT_MEMORY_MB, cpu_seconds=DEFAULT_CPU_SECONDS,
+                 max_processes=DEFAULT_MAX_PROCESSES, cpu_cores=DEFAULT_CPU_CORES,
+                 soft_memory_ratio=DEFAULT_SOFT_MEMORY_RATIO, cgroup_root=DEFAULT_CGROUP_ROOT):
+        self.memory_bytes = int(memory_mb * 1024 * 1024) if memory_mb else None
+        self.cpu_seconds = int(cpu_seconds) if cpu_seconds else None
+        self.max_processes = int(max_processes) if max_processes else None
+        if self.max_processes and not cgroup_root:
+            print('max_processes est ignoré : la limite du nombre de processus nécessite cgroup_root')
+            self.max_processes = None
+        self.cpu_cores = cpu_cores
+        self.soft_memory_bytes = int(self.memory_bytes * soft_memory_ratio) if self.memory_bytes else None
+        self.cgroup_root = cgroup_root
+
+    @property
+    def enabled(self):
+        return any((self.memory_bytes, self.cpu_seconds, self.max_processes, self.cpu_cores))
+
+    def get_init_code(self):
+        if not (self.memory_bytes or self.cpu_seconds):
+            return None
+        return LIMITS_INIT_CODE.format(memory_bytes=self.memory_bytes, cpu_seconds=self.cpu_seconds)
+
+    def create_cgroup(self, pid):
+        """
+        Place le processus du noyau dans un cgroup v2 dédié sous cgroup_root (qui doit exister, être accessible
+        en écriture et avoir les contrôleurs memory, cpu et pids délégués). Retourne son chemin, ou None.
+        """
+        if not self.cgroup_root or pid is None:
+            return None
+        path = os.path.join(self.cgroup_root, f'kernel_{pid}')
+        try:
+            os.makedirs(path, exist_ok=True)
+            if self.memory_bytes:
+                # memory.high freine le noyau (récupération de mémoire) avant la limite dure
+                write_cgroup_file(path, 'memory.high', self.soft_memory_bytes)
+                write_cgroup_file(path, 'memory.max', self.memory_bytes)
+            if self.cpu_cores:
+                write_cgroup_file(path, 'cpu.max', f'{int(self.cpu_cores * CPU_PERIOD_US)} {CPU_PERIOD_US}')
+            if self.max_processes:
+                write_cgroup_file(path, 'pids.max', self.max_processes)
+            write_cgroup_file(path, 'cgroup.procs', pid)
+        except OSError as e:
+            print(f'Impossible de placer le noyau {pid} dans un cgroup: {e}')
+            remove_cgroup(path)
+            return None
+        return path
+
+
+def write_cgroup_file(path, name, value):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(str(value))
+
+
+def remove_cgroup(path):
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+
+def get_process_tree_usage(pid) -> Optional[Tuple[int, float]]:
+    """
+    Retourne (RSS en octets, temps CPU en secondes) du processus et de ses descendants, ou None s'il n'existe
+    plus. psutil est utilisé s'il est installé, sinon /proc.
+    """
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return None
+        rss, cpu_seconds = 0, 0.0
+        for child in processes:
+            try:
+                rss += child.memory_info().rss
+                cpu_times = child.cpu_times()
+                cpu_seconds += cpu_times.user + cpu_times.system
+            except psutil.Error:
+                continue
+        return rss, cpu_seconds
+
+    usage = read_proc_usage(pid)
+    if usage is None:
+        return None
+    rss, cpu_seconds = usage
+    for child_pid in read_proc_children(pid):
+        child_usage = get_process_tree_usage(child_pid)
+        if child_usage is not None:
+            rss += child_usage[0]
+            cpu_seconds += child_usage[1]
+    return rss, cpu_seconds
+
+
+def read_proc_usage(pid) -> Optional[Tuple[int, float]]:
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # Le nom du processus (2e champ) peut contenir des espaces : les champs suivants sont lus après la parenthèse
+    fields = stat[stat.rindex(b')') + 2:].split()
+    utime, stime, rss_pages = int(fields[11]), int(fields[12]), int(fields[21])
+    return rss_pages * PAGE_SIZE, (utime + stime) / CLOCK_TICKS
+
+
+def read_proc_children(pid) -> List[int]:
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children', 'r') as f:
+            return [int(child_pid) for child_pid in f.read().split()]
+    except OSError:
+        return []
+
+
+def get_kernel_pid(kernel_manager):
+    """ PID du processus du noyau (jupyter_client >= 7 : provisioner, versions antérieures : kernel). """
+    provisioner = getattr(kernel_manager, 'provisioner', None)
+    process = getattr(provisioner, 'process', None) or getattr(kernel_manager, 'kernel', None)
+    return getattr(process, 'pid', None)
+
+
+class KernelMonitor:
+    """
+    Thread unique qui relève périodiquement la mémoire (RSS) et le temps CPU de chaque noyau et de ses
+    sous-processus. Un noyau qui dépasse la limite souple de mémoire reçoit une interruption (KeyboardInterrupt
+    dans la cellule) bien avant que la limite dure ou l'OOM killer ne le tuent.
+    """
+    def __init__(self, limits: KernelLimits, interval=DEFAULT_MONITOR_INTERVAL):
+        self.limits = limits
+        self.interval = interval
+        self.kernels = weakref.WeakSet()
+        self.cgroups: Dict[int, str] = {}
+        self.lock = threading.Lock()
+        self.interrupts = 0
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='kernel-monitor', daemon=True)
+            self.thread.start()
+
+    def register(self, jupyter_kernel):
+        """ Suit un noyau ; à appeler à chaque (re)démarrage du processus du noyau. """
+        pid = jupyter_kernel.kernel_pid
+        with self.lock:
+            self.kernels.add(jupyter_kernel)
+            if pid is not None and pid not in self.cgroups:
+                cgroup = self.limits.create_cgroup(pid)
+                if cgroup is not None:
+                    self.cgroups[pid] = cgroup
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                kernels = list(self.kernels)
+            for jupyter_kernel in kernels:
+                try:
+                    self.check(jupyter_kernel)
+                except Exception as e:
+                    print(f'Erreur lors de la mesure des ressources du noyau: {e}')
+            self._remove_dead_cgroups()
+
+    def check(self, jupyter_kernel):
+        pid = jupyter_kernel.kernel_pid
+        if pid is None:
+            return
+        usage = get_process_tree_usage(pid)
+        if usage is None:
+            return
+        rss, cpu_seconds = usage
+        now = time.monotonic()
+        previous = jupyter_kernel.resource_usage
+        cpu_percent = 0.0
+        if previous and previous['pid'] == pid and now > previous['time']:
+            cpu_percent = max(0.0, (cpu_seconds - previous['cpu_seconds']) / (now - previous['time']) * 100)
+        jupyter_kernel.resource_usage = {
+            'pid': pid,
+            'time': now,
+            'rss_bytes': rss,
+            'cpu_seconds': cpu_seconds,
+            'cpu_percent': cpu_percent,
+            'memory_limit_bytes': self.limits.memory_bytes
+        }
+        soft_limit = self.limits.soft_memory_bytes
+        # Une seule interruption par cellule ; hors exécution, il n'y a rien à interrompre
+        if soft_limit and rss > soft_limit and jupyter_kernel.executing and jupyter_kernel.limit_exceeded is None:
+            jupyter_kernel.limit_exceeded = \
+                f'Execution interrupted: the kernel used {rss // (1024 * 1024)} MB of memory, ' \
+                f'above the limit of {soft_limit // (1024 * 1024)} MB. Free memory (del, gc.collect()) ' \
+                f'or process the data in smaller chunks.'
+            with self.lock:
+                self.interrupts += 1
+            jupyter_kernel.send_interrupt_signal()
+
+    def _remove_dead_cgroups(self):
+        with self.lock:
+            dead = [pid for pid in self.cgroups if read_proc_usage(pid) is None]
+            for pid in dead:
+                remove_cgroup(self.cgroups.pop(pid))
+
+    def get_metrics(self):
+        with self.lock:
+            usages = [kernel.resource_usage for kernel in self.kernels if kernel.resource_usage]
+            interrupts = self.interrupts
+        return {
+            'count': len(usages),
+            'rss_bytes_total': sum(usage['rss_bytes'] for usage in usages),
+            'rss_bytes_max': max((usage['rss_bytes'] for usage in usages), default=0),
+            'cpu_seconds_total': sum(usage['cpu_seconds'] for usage in usages),
+            'cpu_percent_total': sum(usage['cpu_percent'] for usage in usages),
+            'limit_interrupts': interrupts
+        }
+
+
+_kernel_monitor = None
+_kernel_monitor_lock = threading.Lock()
+
+
+def get_kernel_monitor(kernel_limits_config: Optional[Dict] = None):
+    """ Retourne le moniteur des noyaux du processus, créé et démarré au premier appel (section "kernel_limits"). """
+    global _kernel_monitor
+    with _kernel_monitor_lock:
+        if _kernel_monitor is None:
+            kernel_limits_config = kernel_limits_config or {}
+            limits = KernelLimits(
+                memory_mb=kernel_limits_config.get('memory_mb', DEFAULT_MEMORY_MB),
+                cpu_seconds=kernel_limits_config.get('cpu_seconds', DEFAULT_CPU_SECONDS),
+                max_processes=kernel_limits_config.get('max_processes', DEFAULT_MAX_PROCESSES),
+                cpu_cores=kernel_limits_config.get('cpu_cores', DEFAULT_CPU_CORES),
+                soft_memory_ratio=float(kernel_limits_config.get('soft_memory_ratio', DEFAULT_SOFT_MEMORY_RATIO)),
+                cgroup_root=kernel_limits_config.get('cgroup_root', DEFAULT_CGROUP_ROOT)
+            )
+            _kernel_monitor = KernelMonitor(
+                limits, interval=float(kernel_limits_config.get('monitor_interval', DEFAULT_MONITOR_INTERVAL))
+            )
+            _kernel_monitor.start()
+            register_gauges('kernels', _kernel_monitor.get_metrics)
+        return _kernel_monitor
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+DEFAULT_SCENARIOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'scenarios.json')
+DEFAULT_FIRST_TOKEN_LATENCY_MS = 300
+DEFAULT_TOKENS_PER_SECOND = 50
+# Nombre moyen de caractères par token, pour découper le texte en chunks
+CHARS_PER_TOKEN = 4
+
+CHAT_COMPLETIONS_PATH = re.compile(r'^(/v1)?(/openai/deployments/[^/]+)?/chat/completions$')
+
+
+def load_scenarios(path=DEFAULT_SCENARIOS_PATH) -> Dict[str, Dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_turn_index(messages: List[Dict]):
+    """
+    Numéro de la réponse à rejouer dans le scénario : nombre de réponses de fonctions reçues depuis le dernier
+    message de l'utilisateur. Le serveur n'a ainsi aucun état à conserver entre les requêtes.
+    """
+    turn_index = 0
+    for message in reversed(messages):
+        if message.get('role') == 'user':
+            break
+        if message.get('role') == 'function':
+            turn_index += 1
+    return turn_index
+
+
+def split_into_tokens(text: str) -> List[str]:
+    return [text[index:index + CHARS_PER_TOKEN] for index in range(0, len(text), CHARS_PER_TOKEN)]
+
+
+def generate_deltas(turn: Dict) -> Iterator[Tuple[Dict, Optional[str]]]:
+    """ Produit les (delta, finish_reason) d'une réponse, comme le fait l'API en streaming. """
+    yield {'role': 'assistant', 'content': '' if turn.get('content') else None}, None
+    for token in split_into_tokens(turn.get('content') or ''):
+        yield {'content': token}, None
+    function_call = turn.get('function_call')
+    if function_call is None:
+        yield {}, 'stop'
+        return
+    arguments = function_call.get('arguments', '')
+    if not isinstance(arguments, str):
+        arguments = json.dumps(arguments, ensure_ascii=False)
+    yield {'function_call': {'name': function_call['name'], 'arguments': ''}}, None
+    for token in split_into_tokens(arguments):
+        yield {'function_call': {'arguments': token}}, None
+    yield {}, 'function_call'
+
+
+class MockChatCompletionHandler(BaseHTTPRequestHandler):
+    """ Imite POST /v1/chat/completions (et le chemin Azure /openai/deployments/<nom>/chat/completions). """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, body: Dict):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if not CHAT_COMPLETIONS_PATH.match(self.path.split('?')[0]):
+            self._send_json(404, {'error': {'message': f'Chemin inconnu: {self.path}', 'type': 'invalid_request_error'}})
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+
+        scenario_name = self.headers.get('X-Mock-Scenario') or self.server.default_scenario
+        scenario = self.server.scenarios.get(scenario_name)
+        if scenario is None:
+            self._send_json(400, {'error': {'message': f'Scénario inconnu: {scenario_name}', 'type': 'invalid_request_error'}})
+            return
+        turns = scenario['turns']
+        turn = turns[min(get_turn_index(request.get('messages', [])), len(turns) - 1)]
+        first_token_latency = turn.get(
+            'first_token_latency_ms', scenario.get('first_token_latency_ms', DEFAULT_FIRST_TOKEN_LATENCY_MS)
+        ) / 1000 * self.server.time_scale
+        tokens_per_second = turn.get('tokens_per_second', scenario.get('tokens_per_second', DEFAULT_TOKENS_PER_SECOND))
+        token_interval = self.server.time_scale / tokens_per_second if tokens_per_second else 0
+
+        completion_id = f'chatcmpl-mock-{uuid.uuid4().hex[:24]}'
+        created = int(time.time())
+        model = request.get('model', 'mock')
+        time.sleep(first_token_latency)
+
+        if not request.get('stream'):
+            content, function_call = turn.get('content'), turn.get('function_call')
+            message = {'role': 'assistant', 'content': content}
+            if function_call is not None:
+                arguments = function_call.get('arguments', '')
+                if not isinstance(arguments, str):
+                    arguments = json.dumps(arguments, ensure_ascii=False)
+                message['function_call'] = {'name': function_call['name'], 'arguments': arguments}
+            self._send_json(200, {
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{
+                    'index': 0, 'message': message,
+                    'finish_reason': 'function_call' if function_call is not None else 'stop'
+                }]
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for index, (delta, finish_reason) in enumerate(generate_deltas(turn)):
+                if index > 1 and token_interval:
+                    time.sleep(token_interval)
+                chunk = {
+                    'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+                }
+                self.wfile.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Le client a interrompu la génération
+            pass
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, scenarios: Optional[Dict[str, Dict]] = None,
+                 default_scenario=None, time_scale=1.0, verbose=False):
+        super().__init__((host, port), MockChatCompletionHandler)
+        self.scenarios = scenarios if scenarios is not None else load_scenarios()
+        self.default_scenario = default_scenario or next(iter(self.scenarios))
+        self.time_scale = time_scale
+        self.verbose = verbose
+        self.thread = None
+
+    @property
+    def api_base(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        """ Démarre le serveur dans un thread d'arrière-plan et retourne son URL de base. """
+        self.thread = threading.Thread(target=self.serve_forever, name='mock-openai-server', daemon=True)
+        self.thread.start()
+        return self.api_base
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serveur local imitant l'API ChatCompletion en streaming.")
+    parser.add_argument("--host", default='127.0.0.1', type=str)
+    parser.add_argument("--port", default=8765, type=int)
+    parser.add_argument("--scenarios", help="fichier JSON des scénarios", default=DEFAULT_SCENARIOS_PATH, type=str)
+    parser.add_argument("--scenario", help="scénario utilisé sans en-tête X-Mock-Scenario", default=None, type=str)
+    parser.add_argument("--time-scale", help="facteur appliqué à toutes les latences (0 : sans attente)",
+                        default=1.0, type=float)
+    parser.add_argument("-v", "--verbose", action='store_true')
+    cli_args = parser.parse_args()
+
+    server = MockOpenAIServer(
+        host=cli_args.host,
+        port=cli_args.port,
+        scenarios=load_scenarios(cli_args.scenarios),
+        default_scenario=cli_args.scenario,
+        time_scale=cli_args.time_scale,
+        verbose=cli_args.verbose
+    )
+    print(f'Serveur OpenAI simulé sur {server.api_base} (scénarios : {", ".join(server.scenarios)})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,13 +1,19 @@
 import nbformat
 from nbformat import v4 as nbf
 import ansi2html
+import base64
 import os
 import argparse
+import atexit
+import itertools
+import tempfile
+import threading
+from tracing import traced
 
 # main code
 parser = argparse.ArgumentParser()
 parser.add_argument("-n", "--notebook", help="chemin du notebook", default=None, type=str)
-args = parser.parse_args()
+args, _ = parser.parse_known_args()
 if args.notebook:
     notebook_path = os.path.join(os.getcwd(), args.notebook)
     base, ext = os.path.splitext(notebook_path)
@@ -17,8 +23,25 @@ if args.notebook:
         print(f'le fichier situé {notebook_path} existe déjà, choisissez un autre nom.')
         exit()
 
-# Global variable for code cells
-nb = nbf.new_notebook()
+# Flush a notebook at most once per interval, or as soon as this many updates are pending
+NOTEBOOK_FLUSH_INTERVAL = 1.0
+NOTEBOOK_MAX_PENDING_UPDATES = 20
+
+# Sessions after the first one get a numbered notebook next to the one given with --notebook
+_session_notebook_counter = itertools.count(1)
+
+
+def get_session_notebook_path():
+    """
+    Return the notebook path of a new session when --notebook is set, None otherwise.
+    """
+    if not args.notebook:
+        return None
+    index = next(_session_notebook_counter)
+    if index == 1:
+        return notebook_path
+    base, ext = os.path.splitext(notebook_path)
+    return f'{base}_{index}{ext}'
 
 
 def ansi_to_html(ansi_text):
@@ -27,45 +50,149 @@ def ansi_to_html(ansi_text):
     return html_text
 
 
-def write_to_notebook():
-    if args.notebook:
-        with open(notebook_path, 'w', encoding='utf-8') as f:
-            nbformat.write(nb, f)
-
-
-def add_code_cell_to_notebook(code):
-    code_cell = nbf.new_code_cell(source=code)
-    nb['cells'].append(code_cell)
-    write_to_notebook()
-
-
-def add_code_cell_output_to_notebook(output):
-    html_content = ansi_to_html(output)
-    cell_output = nbf.new_output(output_type='display_data', data={'text/html': html_content})
-    nb['cells'][-1]['outputs'].append(cell_output)
-    write_to_notebook()
-
-
-def add_code_cell_error_to_notebook(error):
-    nbf_error_output = nbf.new_output(
-        output_type='error',
-        ename='Error',
-        evalue='Error message',
-        traceback=[error]
-    )
-    nb['cells'][-1]['outputs'].append(nbf_error_output)
-    write_to_notebook()
-
-
-def add_image_to_notebook(image, mime_type):
-    image_output = nbf.new_output(output_type='display_data', data={mime_type: image})
-    nb['cells'][-1]['outputs'].append(image_output)
-    write_to_notebook()
-
-
-def add_markdown_to_notebook(content, title=None):
-    if title:
-        content = "##### " + title + ":\n" + content
-    markdown_cell = nbf.new_markdown_cell(content)
-    nb['cells'].append(markdown_cell)
-    write_to_notebook()
+def write_notebook_atomically(path, notebook):
+    content = nbformat.writes(notebook)
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.notebook_', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class NotebookLog:
+    """
+    Compact record of the cells of one session.
+    Events are small tuples; images are kept as references to the files already written on disk, and the
+    notebook itself is only built when it is exported or autosaved (--notebook option).
+    """
+    def __init__(self, autosave_path=None):
+        self.events = []
+        self.lock = threading.Lock()
+        self.autosave_path = autosave_path
+
+    def _record(self, event):
+        with self.lock:
+            self.events.append(event)
+        if self.autosave_path:
+            get_notebook_writer().mark_dirty(self)
+
+    def add_code_cell(self, code):
+        self._record(('code', code))
+
+    def add_code_cell_output(self, output):
+        self._record(('output', output))
+
+    def add_code_cell_error(self, error):
+        self._record(('error', error))
+
+    def add_image(self, image_path, mime_type):
+        self._record(('image', image_path, mime_type))
+
+    def add_markdown(self, content, title=None):
+        if title:
+            content = "##### " + title + ":\n" + content
+        self._record(('markdown', content))
+
+    def to_notebook(self):
+        """ Build the nbformat notebook from the recorded events. """
+        with self.lock:
+            events = list(self.events)
+
+        nb = nbf.new_notebook()
+        for event in events:
+            kind = event[0]
+            if kind == 'markdown':
+                nb['cells'].append(nbf.new_markdown_cell(event[1]))
+            elif kind == 'code':
+                nb['cells'].append(nbf.new_code_cell(source=event[1]))
+            elif not nb['cells'] or 'outputs' not in nb['cells'][-1]:
+                # Outputs always follow their code cell
+                continue
+            elif kind == 'output':
+                nb['cells'][-1]['outputs'].append(
+                    nbf.new_output(output_type='display_data', data={'text/html': ansi_to_html(event[1])})
+                )
+            elif kind == 'error':
+                nb['cells'][-1]['outputs'].append(
+                    nbf.new_output(output_type='error', ename='Error', evalue='Error message', traceback=[event[1]])
+                )
+            elif kind == 'image':
+                _, image_path, mime_type = event
+                try:
+                    with open(image_path, 'rb') as f:
+                        image = base64.b64encode(f.read()).decode('utf-8')
+                except OSError:
+                    continue
+                nb['cells'][-1]['outputs'].append(nbf.new_output(output_type='display_data', data={mime_type: image}))
+        return nb
+
+    @traced('notebook.export')
+    def export(self, path):
+        """ Build the notebook and write it to `path`. """
+        write_notebook_atomically(path, self.to_notebook())
+        return path
+
+
+class NotebookWriter:
+    """
+    Background writer for the notebooks autosaved with --notebook.
+    Updates only mark a notebook log as dirty; the writer thread coalesces them and rewrites each dirty
+    notebook atomically (temporary file + rename) after NOTEBOOK_FLUSH_INTERVAL seconds or
+    NOTEBOOK_MAX_PENDING_UPDATES updates, and once more at shutdown. Callers never wait for the disk.
+    """
+    def __init__(self, flush_interval=NOTEBOOK_FLUSH_INTERVAL, max_pending_updates=NOTEBOOK_MAX_PENDING_UPDATES):
+        self.flush_interval = flush_interval
+        self.max_pending_updates = max_pending_updates
+        self.dirty_logs = {}
+        self.flush_requested = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='notebook-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def mark_dirty(self, notebook_log):
+        with self.condition:
+            pending_updates = self.dirty_logs.get(notebook_log, 0) + 1
+            self.dirty_logs[notebook_log] = pending_updates
+            if pending_updates >= self.max_pending_updates:
+                self.flush_requested = True
+                self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.flush_requested, timeout=self.flush_interval)
+                dirty_logs, self.dirty_logs = self.dirty_logs, {}
+                self.flush_requested = False
+                closed = self.closed
+            for notebook_log in dirty_logs:
+                try:
+                    notebook_log.export(notebook_log.autosave_path)
+                except Exception as e:
+                    print(f'Erreur lors de l\'écriture du notebook: {e}')
+            if closed:
+                return
+
+
+_notebook_writer = None
+_notebook_writer_lock = threading.Lock()
+
+
+def get_notebook_writer():
+    global _notebook_writer
+    with _notebook_writer_lock:
+        if _notebook_writer is None:
+            _notebook_writer = NotebookWriter()
+        return _notebook_writer
@@ -0,0 +1,236 @@
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import *
+
+# Valeurs par défaut de la section "response_cache" du fichier de configuration
+DEFAULT_MODE = 'off'
+DEFAULT_DIRECTORY = 'cache/responses'
+DEFAULT_MAX_MB = 256
+
+CACHE_MODES = ('off', 'record', 'replay')
+# Arguments sans effet sur le contenu de la réponse, exclus de la clé
+IGNORED_REQUEST_KEYS = ('stream', 'api_key', 'api_base', 'api_type', 'api_version', 'organization', 'request_timeout')
+
+
+class ResponseCacheMiss(Exception):
+    """ Levée en mode replay strict lorsqu'une requête n'a pas été enregistrée. """
+
+
+def get_request_key(kwargs_for_chat_completion: Dict):
+    """ Empreinte canonique d'une requête : deux requêtes identiques (à l'ordre des clés près) ont la même clé. """
+    request = {key: value for key, value in kwargs_for_chat_completion.items() if key not in IGNORED_REQUEST_KEYS}
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Cache disque des réponses en streaming de ChatCompletion.
+    - record : la requête est envoyée à l'API, les chunks sont transmis normalement et, si la réponse est lue
+      jusqu'au bout, enregistrés avec leur instant d'arrivée dans <directory>/<clé[:2]>/<clé>.json ;
+    - replay : une requête déjà enregistrée est rejouée sans appel à l'API, à pleine vitesse ou avec son timing
+      d'origine (realtime) ; une requête inconnue est envoyée à l'API et enregistrée, ou lève
+      ResponseCacheMiss en mode strict (exécutions hors ligne et déterministes).
+    La taille totale est bornée par max_bytes : les réponses les moins récemment utilisées sont supprimées.
+    """
+    def __init__(self, mode=DEFAULT_MODE, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_MB * 1024 * 1024,
+                 realtime=False, strict=False):
+        assert mode in CACHE_MODES, f"Mode de cache de réponses inconnu: {mode}"
+        self.mode = mode
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.realtime = realtime
+        self.strict = strict
+        self.lock = threading.Lock()
+        self.entry_sizes: Optional[Dict[str, int]] = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def get_entry_path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def load(self, key) -> Optional[Dict]:
+        path = self.get_entry_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # La date de modification sert d'horodatage LRU
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, kwargs_for_chat_completion: Dict, chunks: List[Tuple[float, Dict]]):
+        entry = {
+            'key': key,
+            'created': time.time(),
+            'model': kwargs_for_chat_completion.get('model') or kwargs_for_chat_completion.get('engine'),
+            'messages': len(kwargs_for_chat_completion.get('messages', [])),
+            'chunks': chunks
+        }
+        path = self.get_entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.response_', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        with self.lock:
+            entry_sizes = self._get_entry_sizes()
+            entry_sizes[path] = os.path.getsize(path)
+            self._evict(entry_sizes)
+
+    def _get_entry_sizes(self):
+        if self.entry_sizes is None:
+            self.entry_sizes = {}
+            for root, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    if filename.endswith('.json'):
+                        path = os.path.join(root, filename)
+                        self.entry_sizes[path] = os.path.getsize(path)
+        return self.entry_sizes
+
+    def _evict(self, entry_sizes: Dict[str, int]):
+        if not self.max_bytes or sum(entry_sizes.values()) <= self.max_bytes:
+            return
+        def get_last_used(path):
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0
+        total_bytes = sum(entry_sizes.values())
+        for path in sorted(entry_sizes, key=get_last_used):
+            if total_bytes <= self.max_bytes:
+                break
+            total_bytes -= entry_sizes.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _lookup(self, kwargs_for_chat_completion: Dict):
+        """ Retourne (clé, entrée enregistrée ou None) et applique le mode strict. """
+        key = get_request_key(kwargs_for_chat_completion)
+        entry = self.load(key) if self.mode == 'replay' else None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None and self.mode == 'replay' and self.strict:
+            raise ResponseCacheMiss(f"Aucune réponse enregistrée pour la requête {key}")
+        return key, entry
+
+    def create(self, kwargs_for_chat_completion: Dict, create_function: Callable):
+        """ Équivalent de create_function(**kwargs) (openai.ChatCompletion.create) passant par le cache. """
+        if not self.enabled or not kwargs_for_chat_completion.get('stream'):
+            return create_function(**kwargs_for_chat_completion)
+        key, entry = self._lookup(kwargs_for_chat_completion)
+        if entry is not None:
+            return self._replay(entry)
+        start_time = time.time()
+        return self._record(key, kwargs_for_chat_completion, create_function(**kwargs_for_chat_completion), start_time)
+
+    async def acreate(self, kwargs_for_chat_completion: Dict, acreate_function: Callable):
+        """ Variante asynchrone de create (openai.ChatCompletion.acreate). """
+        if not self.enabled or not kwargs_for_chat_completion.get('stream'):
+            return await acreate_function(**kwargs_for_chat_completion)
+        key, entry = self._lookup(kwargs_for_chat_completion)
+        if entry is not None:
+            return self._async_replay(entry)
+        start_time = time.time()
+        response = await acreate_function(**kwargs_for_chat_completion)
+        return self._async_record(key, kwargs_for_chat_completion, response, start_time)
+
+    def _replay(self, entry: Dict):
+        start_time, paused = time.time(), 0.0
+        for offset, chunk in entry['chunks']:
+            if self.realtime:
+                delay = start_time + paused + offset - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield_time = time.time()
+            yield chunk
+            paused += time.time() - yield_time
+
+    async def _async_replay(self, entry: Dict):
+        start_time, paused = time.time(), 0.0
+        for offset, chunk in entry['chunks']:
+            if self.realtime:
+                delay = start_time + paused + offset - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield_time = time.time()
+            yield chunk
+            paused += time.time() - yield_time
+
+    def _record(self, key, kwargs_for_chat_completion: Dict, response: Iterable, start_time):
+        # Le temps passé par l'appelant entre deux chunks (exécution du code) est exclu du timing enregistré
+        chunks, paused = [], 0.0
+        try:
+            for chunk in response:
+                chunks.append((time.time() - start_time - paused, chunk))
+                yield_time = time.time()
+                yield chunk
+                paused += time.time() - yield_time
+        finally:
+            if hasattr(response, 'close'):
+                response.close()
+        # Une réponse interrompue (arrêt de la génération) n'atteint pas cette ligne et n'est pas enregistrée
+        self._store_quietly(key, kwargs_for_chat_completion, chunks)
+
+    async def _async_record(self, key, kwargs_for_chat_completion: Dict, response: AsyncIterable, start_time):
+        chunks, paused = [], 0.0
+        try:
+            async for chunk in response:
+                chunks.append((time.time() - start_time - paused, chunk))
+                yield_time = time.time()
+                yield chunk
+                paused += time.time() - yield_time
+        finally:
+            if hasattr(response, 'aclose'):
+                await response.aclose()
+        self._store_quietly(key, kwargs_for_chat_completion, chunks)
+
+    def _store_quietly(self, key, kwargs_for_chat_completion: Dict, chunks):
+        try:
+            self.store(key, kwargs_for_chat_completion, chunks)
+        except Exception as e:
+            print(f'Erreur lors de l\'enregistrement de la réponse: {e}')
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache(response_cache_config: Optional[Dict] = None):
+    """ Retourne le cache de réponses partagé, créé au premier appel à partir de la section "response_cache". """
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            response_cache_config = response_cache_config or {}
+            max_mb = response_cache_config.get('max_mb', DEFAULT_MAX_MB)
+            _response_cache = ResponseCache(
+                mode=response_cache_config.get('mode', DEFAULT_MODE),
+                directory=response_cache_config.get('directory', DEFAULT_DIRECTORY),
+                max_bytes=int(max_mb * 1024 * 1024) if max_mb else None,
+                realtime=bool(response_cache_config.get('realtime', False)),
+                strict=bool(response_cache_config.get('strict', False))
+            )
+        return _response_cache
@@ -1,4 +1,5 @@
 from functional import *
+import asyncio
 
 # Classe de base pour définir une stratégie de traitement des choix.
 class ChoiceStrategy(metaclass=ABCMeta):
@@ -6,6 +7,12 @@ class ChoiceStrategy(metaclass=ABCMeta):
         self.choice = choice
         self.delta = choice['delta']
 
+    def bind(self, choice):
+        # Réutilise l'instance pour un autre choix (voir ChunkDispatcher)
+        self.choice = choice
+        self.delta = choice['delta']
+        return self
+
     @abstractmethod
     def support(self):        # Méthode pour vérifier si la stratégie peut gérer le choix actuel.
         pass
@@ -14,6 +21,11 @@ class ChoiceStrategy(metaclass=ABCMeta):
     def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
         pass
 
+    async def execute_async_stream(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+        # Variante asynchrone de execute : produit les états intermédiaires (history, whether_exit), le dernier
+        # état produit étant l'état final.
+        yield self.execute(bot_backend=bot_backend, history=history, whether_exit=whether_exit)
+
 
 class RoleChoiceStrategy(ChoiceStrategy):
 # Stratégie de traitement des choix liés au rôle.
@@ -74,33 +86,21 @@ class ArgumentsFunctionCallChoiceStrategy(ChoiceStrategy):
     def execute(self, bot_backend: BotBackend, history: List, whether_exit: bool):
         bot_backend.add_function_args_str(function_args_str=self.delta['function_call']['arguments'])
 
-        if bot_backend.function_name == 'python':  # handle hallucinatory function calls
+        if bot_backend.function_name in ('python', 'execute_code'):
             """
             Dans la pratique, nous avons remarqué que GPT, en particulier GPT-3.5, peut occasionnellement produire des appels de fonction hallucinants.
             hallucinants. Ces appels impliquent une fonction inexistante nommée `python` avec des arguments consistant 
-            uniquement du texte de code brut (pas un format JSON).
+            uniquement du texte de code brut (pas un format JSON). Le décodeur incrémental les traite en mode brut.
             """
-            temp_code_str = bot_backend.function_args_str
-            bot_backend.update_code_str(code_str=temp_code_str)
-            bot_backend.update_display_code_block(
-                display_code_block="\n🔴Exécution:\n```python\n{}\n```".format(temp_code_str)
-            )
-            history = copy.deepcopy(bot_backend.bot_history)
-            history[-1][1] += bot_backend.display_code_block
-        elif bot_backend.function_name == 'execute_code':
-            temp_code_str = parse_json(function_args=bot_backend.function_args_str, finished=False)
-            if temp_code_str is not None:
-                bot_backend.update_code_str(code_str=temp_code_str)
+            function_args_parser = bot_backend.function_args_parser
+            if function_args_parser is not None and function_args_parser.has_code:
+                bot_backend.update_code_str(code_str=function_args_parser.code)
                 bot_backend.update_display_code_block(
                     display_code_block="\n🔴Exécution:\n```python\n{}\n```".format(
-                        temp_code_str
+                        function_args_parser.code
                     )
                 )
-                history = copy.deepcopy(bot_backend.bot_history)
-                history[-1][1] += bot_backend.display_code_block
-            else:
-                history = copy.deepcopy(bot_backend.bot_history)
-                history[-1][1] += bot_backend.display_code_block
+            history = bot_backend.render_bot_history()
         else:
             pass
 
@@ -132,53 +132,120 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
 
         return history, whether_exit
 
+    async def execute_async_stream(self, bot_backend: BotBackend, history: List, whether_exit: bool):
+
+        if bot_backend.content:
+            bot_backend.add_gpt_response_content_message()
+
+        bot_backend.update_finish_reason(finish_reason=self.choice['finish_reason'])
+        if bot_backend.finish_reason == 'function_call':
+
+            if bot_backend.function_name in bot_backend.jupyter_kernel.available_functions:
+                frame = None
+                async for next_frame in self.handle_execute_code_finish_reason_async_stream(
+                    bot_backend=bot_backend, history=history, whether_exit=whether_exit
+                ):
+                    if frame is not None:
+                        yield frame
+                    frame = next_frame
+                history, whether_exit = frame
+            else:
+                # Les outils appellent des API bloquantes : ils sont exécutés hors de la boucle d'événements
+                history, whether_exit = await asyncio.to_thread(
+                    self.handle_tool_finish_reason,
+                    bot_backend=bot_backend, history=history, whether_exit=whether_exit
+                )
+
+        bot_backend.reset_gpt_response_log_values(exclude=['finish_reason'])
+
+        yield history, whether_exit
+
     def handle_execute_code_finish_reason(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        function_dict = bot_backend.jupyter_kernel.available_functions
+        """ Exécute le code et ajoute ses sorties à l'historique ; retourne l'état final (history, whether_exit). """
         try:
+            history, renderer, code_str = self.start_code_execution(bot_backend=bot_backend)
 
-            code_str = self.get_code_str(bot_backend)
+            content_to_display = []
+            for mark, out_str in bot_backend.jupyter_kernel.execute_code_stream(code_str):
+                content_to_display.append((mark, out_str))
+                renderer.add_output(mark, out_str)
 
-            bot_backend.update_code_str(code_str=code_str)
-            bot_backend.update_display_code_block(
-                display_code_block="\n🟢Fini:\n```python\n{}\n```".format(code_str)
+            self.complete_code_execution(
+                bot_backend=bot_backend, renderer=renderer, content_to_display=content_to_display
             )
-            history = copy.deepcopy(bot_backend.bot_history)
-            history[-1][1] += bot_backend.display_code_block
+            return history, whether_exit
 
-            # function response
-            bot_backend.update_code_executing_state(code_executing=True)
-            text_to_gpt, content_to_display = function_dict[
-                bot_backend.function_name
-            ](code_str)
-            bot_backend.update_code_executing_state(code_executing=False)
+        except Exception as e:
+            return self.handle_code_execution_error(bot_backend=bot_backend, history=history, error=e)
+
+    async def handle_execute_code_finish_reason_async_stream(self, bot_backend: BotBackend, history: List,
+                                                             whether_exit: bool):
+        """
+        Variante asynchrone de handle_execute_code_finish_reason : produit l'historique après chaque sortie du noyau,
+        pour l'afficher pendant l'exécution ; le dernier état produit est l'état final.
+        """
+        try:
+            history, renderer, code_str = self.start_code_execution(bot_backend=bot_backend)
+            yield history, whether_exit
+
+            content_to_display = []
+            async for mark, out_str in bot_backend.jupyter_kernel.async_execute_code_stream(code_str):
+                content_to_display.append((mark, out_str))
+                renderer.add_output(mark, out_str)
+                yield history, whether_exit
+
+            await renderer.wait_for_images()
+            self.complete_code_execution(
+                bot_backend=bot_backend, renderer=renderer, content_to_display=content_to_display
+            )
+            yield history, whether_exit
 
-            # add function call to conversion
-            bot_backend.add_function_call_response_message(function_response=text_to_gpt, save_tokens=True)
+        except Exception as e:
+            yield self.handle_code_execution_error(bot_backend=bot_backend, history=history, error=e)
 
-            if bot_backend.interrupt_signal_sent:
-                bot_backend.append_system_msg(prompt='Lexécution du code est arrêtée manuellement par lutilisateur, il nest pas nécessaire de corriger le problème.')
+    def start_code_execution(self, bot_backend: BotBackend):
+        code_str = self.get_code_str(bot_backend)
 
-            add_code_execution_result_to_bot_history(
-                content_to_display=content_to_display, history=history, unique_id=bot_backend.unique_id
-            )
-            return history, whether_exit
+        bot_backend.update_code_str(code_str=code_str)
+        bot_backend.update_display_code_block(
+            display_code_block="\n🟢Fini:\n```python\n{}\n```".format(code_str)
+        )
+        history = bot_backend.render_bot_history()
 
-        except json.JSONDecodeError:
+        # function response
+        bot_backend.mark_tool_execution_start()
+        bot_backend.update_code_executing_state(code_executing=True)
+        renderer = CodeExecutionResultRenderer(
+            history=history, unique_id=bot_backend.unique_id, notebook_log=bot_backend.notebook_log
+        )
+        return history, renderer, code_str
+
+    @staticmethod
+    def complete_code_execution(bot_backend: BotBackend, renderer: CodeExecutionResultRenderer,
+                                content_to_display: List):
+        text_to_gpt = JupyterKernel.build_text_to_gpt(content_to_display)
+        bot_backend.update_code_executing_state(code_executing=False)
+
+        # add function call to conversion
+        bot_backend.add_function_call_response_message(function_response=text_to_gpt, save_tokens=True)
+
+        if bot_backend.interrupt_signal_sent:
+            bot_backend.append_system_msg(prompt='Lexécution du code est arrêtée manuellement par lutilisateur, il nest pas nécessaire de corriger le problème.')
+
+        renderer.finish()
+
+    @staticmethod
+    def handle_code_execution_error(bot_backend: BotBackend, history: List, error: Exception):
+        if isinstance(error, json.JSONDecodeError):
             history.append(
                 [None, f"GPT genere la mauvaise fonction: {bot_backend.function_args_str}"]
             )
-            whether_exit = True
-            return history, whether_exit
-
-        except KeyError as key_error:
-            history.append([None, f'Backend key_error: {key_error}'])
-            whether_exit = True
-            return history, whether_exit
-
-        except Exception as e:
-            history.append([None, f'Backend erreur: {e}'])
-            whether_exit = True
-            return history, whether_exit
+        elif isinstance(error, KeyError):
+            history.append([None, f'Backend key_error: {error}'])
+        else:
+            history.append([None, f'Backend erreur: {error}'])
+        whether_exit = True
+        return history, whether_exit
 
     @staticmethod
     def handle_tool_finish_reason(bot_backend: BotBackend, history: List, whether_exit: bool):
@@ -199,7 +266,9 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
 
         else:
             # function response
-            function_response, hypertext_to_display = function(**kwargs)
+            bot_backend.mark_tool_execution_start()
+            with span('tool.execute', tool=function_name):
+                function_response, hypertext_to_display = function(**kwargs)
 
             # add function call to conversion
             bot_backend.add_function_call_response_message(function_response=function_response, save_tokens=False)
@@ -214,46 +283,139 @@ class FinishReasonChoiceStrategy(ChoiceStrategy):
         if bot_backend.function_name == 'python':
             code_str = bot_backend.function_args_str
         else:
-            code_str = parse_json(function_args=bot_backend.function_args_str, finished=True)
+            code_str = None
+            if bot_backend.function_args_parser is not None:
+                code_str = bot_backend.function_args_parser.finish()
+            if code_str is None:
+                code_str = parse_json(function_args=bot_backend.function_args_str, finished=True)
             if code_str is None:
                 raise json.JSONDecodeError
         return code_str
 
 
-class ChoiceHandler:
-    strategies = [
-        RoleChoiceStrategy, ContentChoiceStrategy, NameFunctionCallChoiceStrategy,
-        ArgumentsFunctionCallChoiceStrategy, FinishReasonChoiceStrategy
-    ]
-
-    def __init__(self, choice):
-        self.choice = choice
+class ChunkDispatcher:
+    """
+    Aiguilleur des chunks d'une réponse en streaming, construit une fois par réponse.
+    Les stratégies sont instanciées une seule fois ; chaque delta est routé d'après ses clés vers les stratégies
+    concernées (rôle, contenu, nom de fonction, arguments, puis fin de réponse). dispatch_batch traite plusieurs
+    chunks à la fois en fusionnant les deltas consécutifs de texte ou d'arguments.
+    """
+    def __init__(self, bot_backend: BotBackend):
+        self.bot_backend = bot_backend
+        self.role_strategy = RoleChoiceStrategy(choice=EMPTY_CHOICE)
+        self.content_strategy = ContentChoiceStrategy(choice=EMPTY_CHOICE)
+        self.name_strategy = NameFunctionCallChoiceStrategy(choice=EMPTY_CHOICE)
+        self.arguments_strategy = ArgumentsFunctionCallChoiceStrategy(choice=EMPTY_CHOICE)
+        self.finish_strategy = FinishReasonChoiceStrategy(choice=EMPTY_CHOICE)
+        # Table de routage : clé du delta -> stratégies candidates
+        self.delta_routes = (
+            ('role', (self.role_strategy,)),
+            ('content', (self.content_strategy,)),
+            ('function_call', (self.name_strategy, self.arguments_strategy))
+        )
 
-    def handle(self, bot_backend: BotBackend, history: List, whether_exit: bool):
-        for Strategy in self.strategies:
-            strategy_instance = Strategy(choice=self.choice)
-            if not strategy_instance.support():
+    def get_strategies(self, choice) -> List[ChoiceStrategy]:
+        delta = choice['delta']
+        strategies = []
+        for key, candidates in self.delta_routes:
+            if key not in delta:
                 continue
-            history, whether_exit = strategy_instance.execute(
-                bot_backend=bot_backend,
-                history=history,
-                whether_exit=whether_exit
-            )
+            for strategy in candidates:
+                if strategy.bind(choice).support():
+                    strategies.append(strategy)
+        if choice['finish_reason'] is not None:
+            strategies.append(self.finish_strategy.bind(choice))
+        return strategies
+
+    def dispatch(self, chunk, history: List):
+        """ Traite un chunk et retourne (history, whether_exit). """
+        whether_exit = False
+        parse_span = span('parse_chunk', export=False)
+        if chunk['choices']:
+            for strategy in self.get_strategies(chunk['choices'][0]):
+                if strategy is self.finish_strategy:
+                    parse_span.end()
+                history, whether_exit = strategy.execute(
+                    bot_backend=self.bot_backend, history=history, whether_exit=whether_exit
+                )
+        parse_span.end()
+        return history, whether_exit
+
+    async def dispatch_async_stream(self, chunk, history: List):
+        """ Variante asynchrone de dispatch : produit les états intermédiaires, le dernier étant l'état final du chunk. """
+        whether_exit = False
+        parse_span = span('parse_chunk', export=False)
+        if chunk['choices']:
+            for strategy in self.get_strategies(chunk['choices'][0]):
+                if strategy is self.finish_strategy:
+                    parse_span.end()
+                frame = None
+                async for next_frame in strategy.execute_async_stream(
+                    bot_backend=self.bot_backend, history=history, whether_exit=whether_exit
+                ):
+                    if frame is not None:
+                        yield frame
+                    frame = next_frame
+                history, whether_exit = frame
+        parse_span.end()
+        yield history, whether_exit
+
+    def dispatch_batch(self, chunks: Iterable, history: List):
+        """ Traite une série de chunks et retourne l'état final (history, whether_exit). """
+        whether_exit = False
+        for chunk in merge_chunks(chunks):
+            history, whether_exit = self.dispatch(chunk, history)
+            if whether_exit:
+                break
         return history, whether_exit
 
 
-def parse_response(chunk, history: List, bot_backend: BotBackend):
+# Choix vide utilisé pour préallouer les stratégies
+EMPTY_CHOICE = {'delta': {}, 'finish_reason': None}
+
+
+def get_mergeable_delta(chunk):
     """
-    :return: history, whether_exit
+    Retourne ('content', texte) ou ('arguments', texte) pour un chunk qui ne fait qu'ajouter du texte ou des
+    arguments de fonction, None sinon.
     """
-    whether_exit = False
-    if chunk['choices']:
-        choice = chunk['choices'][0]
-        choice_handler = ChoiceHandler(choice=choice)
-        history, whether_exit = choice_handler.handle(
-            history=history,
-            bot_backend=bot_backend,
-            whether_exit=whether_exit
-        )
+    if len(chunk['choices']) != 1:
+        return None
+    choice = chunk['choices'][0]
+    if choice['finish_reason'] is not None:
+        return None
+    delta = choice['delta']
+    if len(delta) != 1:
+        return None
+    if delta.get('content') is not None:
+        return 'content', delta['content']
+    function_call = delta.get('function_call')
+    if function_call is not None and len(function_call) == 1 and 'arguments' in function_call:
+        return 'arguments', function_call['arguments']
+    return None
+
+
+def merge_chunks(chunks: Iterable):
+    """ Fusionne les chunks consécutifs de texte (ou d'arguments) en un seul chunk. """
+    pending_kind, pending_parts = None, []
+    for chunk in chunks:
+        mergeable = get_mergeable_delta(chunk)
+        if mergeable is not None and (pending_kind is None or mergeable[0] == pending_kind):
+            pending_kind = mergeable[0]
+            pending_parts.append(mergeable[1])
+            continue
+        if pending_kind is not None:
+            yield make_merged_chunk(pending_kind, pending_parts)
+            pending_kind, pending_parts = None, []
+        if mergeable is not None:
+            pending_kind, pending_parts = mergeable[0], [mergeable[1]]
+        else:
+            yield chunk
+    if pending_kind is not None:
+        yield make_merged_chunk(pending_kind, pending_parts)
+
 
-    return history, whether_exit
+def make_merged_chunk(kind, parts: List[str]):
+    text = ''.join(parts)
+    delta = {'content': text} if kind == 'content' else {'function_call': {'arguments': text}}
+    return {'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}
@@ -0,0 +1,100 @@
+import threading
+import time
+from typing import *
+from tracing import register_gauges
+
+# Valeurs par défaut de la section "session_reaper" du fichier de configuration
+# Durée d'inactivité (en secondes) avant la mise en veille d'une session ; 0 ou null désactive la mise en veille
+DEFAULT_IDLE_TIMEOUT = 1800
+DEFAULT_CHECK_INTERVAL = 60
+# Taille maximale des valeurs de l'espace de noms enregistrées par noyau
+DEFAULT_NAMESPACE_MAX_MB = 256
+
+
+class SessionReaper:
+    """
+    Thread d'arrière-plan qui met en veille les sessions inactives : chaque session sans message ni exécution de
+    code depuis idle_timeout secondes enregistre l'espace de noms de son noyau, puis arrête le noyau. La session
+    repart d'un nouveau noyau, dont l'espace de noms est restauré, à son message suivant. Les sessions sont celles
+    déclarées au gestionnaire de cache.
+    """
+    def __init__(self, cache_manager, idle_timeout=DEFAULT_IDLE_TIMEOUT, check_interval=DEFAULT_CHECK_INTERVAL,
+                 namespace_max_bytes=DEFAULT_NAMESPACE_MAX_MB * 1024 * 1024):
+        self.cache_manager = cache_manager
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.namespace_max_bytes = namespace_max_bytes
+        self.lock = threading.Lock()
+        self.metrics = {
+            'hibernations': 0,
+            'hibernation_failures': 0,
+            'last_reap_duration': None
+        }
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='session-reaper', daemon=True)
+            self.thread.start()
+
+    def reap(self):
+        """ Met en veille les sessions inactives depuis idle_timeout secondes. """
+        start_time = time.time()
+        hibernations = failures = 0
+        for bot_backend in self.cache_manager.get_live_sessions():
+            if bot_backend.hibernated or bot_backend.get_idle_time() < self.idle_timeout:
+                continue
+            try:
+                if bot_backend.hibernate(self.namespace_max_bytes):
+                    hibernations += 1
+            except Exception as e:
+                failures += 1
+                print(f'Erreur lors de la mise en veille de la session {bot_backend.unique_id}: {e}')
+        with self.lock:
+            self.metrics['hibernations'] += hibernations
+            self.metrics['hibernation_failures'] += failures
+            self.metrics['last_reap_duration'] = time.time() - start_time
+
+    def get_metrics(self):
+        bot_backends = self.cache_manager.get_live_sessions()
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['live'] = len(bot_backends)
+        metrics['hibernated'] = sum(1 for bot_backend in bot_backends if bot_backend.hibernated)
+        return metrics
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.reap()
+            except Exception as e:
+                print(f'Erreur lors de la recherche des sessions inactives: {e}')
+
+
+_session_reaper = None
+_session_reaper_lock = threading.Lock()
+
+
+def get_session_reaper(reaper_config: Optional[Dict], cache_manager) -> Optional[SessionReaper]:
+    """
+    Retourne le thread de mise en veille du processus, créé et démarré au premier appel à partir de la section
+    "session_reaper" (None si la mise en veille est désactivée).
+    """
+    global _session_reaper
+    reaper_config = reaper_config or {}
+    idle_timeout = reaper_config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+    if not idle_timeout:
+        return None
+    with _session_reaper_lock:
+        if _session_reaper is None:
+            namespace_max_mb = reaper_config.get('namespace_max_mb', DEFAULT_NAMESPACE_MAX_MB)
+            _session_reaper = SessionReaper(
+                cache_manager,
+                idle_timeout=float(idle_timeout),
+                check_interval=float(reaper_config.get('check_interval', DEFAULT_CHECK_INTERVAL)),
+                namespace_max_bytes=int(namespace_max_mb * 1024 * 1024)
+            )
+            _session_reaper.start()
+            register_gauges('sessions', _session_reaper.get_metrics)
+        return _session_reaper
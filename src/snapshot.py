@@ -0,0 +1,310 @@
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+
+HASH_CHUNK_SIZE = 1024 * 1024
+READ_ONLY_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def move_file(source_path, target_path):
+    """ Déplace un fichier : simple renommage sur le même système de fichiers, sinon une seule copie. """
+    try:
+        os.replace(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+        os.remove(source_path)
+
+
+def write_json_atomically(path, data):
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.manifest_', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def get_manifest_index(filename):
+    # snapshot_<n>.json
+    try:
+        return int(filename[len('snapshot_'):-len('.json')])
+    except ValueError:
+        return None
+
+
+def load_manifests(snapshot_dir) -> List[Tuple[str, Dict]]:
+    """ Charge les manifestes d'un répertoire snapshots_<id>, du plus ancien au plus récent. """
+    manifests = []
+    try:
+        filenames = os.listdir(snapshot_dir)
+    except OSError:
+        return manifests
+    for filename in filenames:
+        if not filename.startswith('snapshot_') or not filename.endswith('.json'):
+            continue
+        index = get_manifest_index(filename)
+        if index is None:
+            continue
+        path = os.path.join(snapshot_dir, filename)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifests.append((index, path, json.load(f)))
+        except (OSError, ValueError):
+            continue
+    manifests.sort(key=lambda item: item[0])
+    return [(path, manifest) for _, path, manifest in manifests]
+
+
+def get_referenced_bytes(manifests: Iterable[Dict]):
+    """ Taille cumulée des objets distincts référencés par des manifestes. """
+    sizes = {}
+    for manifest in manifests:
+        for entry in manifest['files'].values():
+            if 'sha256' in entry:
+                sizes[entry['sha256']] = entry['size']
+    return sum(sizes.values())
+
+
+class SnapshotStore:
+    """
+    Instantanés incrémentaux des répertoires de travail.
+    Les fichiers sont rangés une seule fois par contenu dans cache/objects/<sha[:2]>/<sha>, en lecture seule ;
+    chaque instantané n'est qu'un manifeste JSON (chemin relatif -> empreinte) dans cache/snapshots_<id>/.
+    Quand c'est possible, l'objet est un lien physique vers le fichier sauvegardé : aucune donnée n'est copiée.
+    Un fichier inchangé depuis l'instantané précédent (même taille, même date de modification) ou déjà lié à un
+    objet n'est pas relu. Un objet n'est lié qu'à des fichiers qui ne seront plus modifiés (répertoires de travail
+    retirés), de sorte que son contenu correspond toujours à son empreinte ; les téléversements ne passent pas par
+    le magasin et sont dédupliqués au premier instantané qui les contient.
+    """
+    def __init__(self, cache_dir='cache'):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        # Protège le magasin d'objets entre la création des instantanés et le ramasse-miettes
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot-writer')
+        self.trash_counter = itertools.count(1)
+        # (périphérique, inode) -> empreinte des objets connus
+        self.known_inodes: Dict[Tuple[int, int], str] = {}
+
+    def get_snapshot_dir(self, session_id):
+        return os.path.join(self.cache_dir, f'snapshots_{session_id}')
+
+    def get_object_path(self, sha):
+        return os.path.join(self.objects_dir, sha[:2], sha)
+
+    def store_file(self, path, sha=None):
+        """ Range le fichier dans le magasin d'objets et retourne son empreinte. """
+        if sha is None:
+            sha = hash_file(path)
+        object_path = self.get_object_path(sha)
+        with self.lock:
+            if os.path.exists(object_path):
+                object_stat = os.stat(object_path)
+                self.known_inodes[(object_stat.st_dev, object_stat.st_ino)] = sha
+                return sha
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            temp_path = f'{object_path}.{threading.get_ident()}.tmp'
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                # Système de fichiers différent ou sans liens physiques
+                shutil.copy2(path, temp_path)
+            os.chmod(temp_path, READ_ONLY_MODE)
+            os.replace(temp_path, object_path)
+            object_stat = os.stat(object_path)
+            self.known_inodes[(object_stat.st_dev, object_stat.st_ino)] = sha
+        return sha
+
+    def list_snapshots(self, session_id) -> List[Dict]:
+        """ Liste les instantanés d'une session : identifiant, date de création, nombre et taille des fichiers. """
+        snapshots = []
+        for _, manifest in load_manifests(self.get_snapshot_dir(session_id)):
+            files = manifest['files'].values()
+            snapshots.append({
+                'id': manifest['id'],
+                'created': manifest['created'],
+                'files': len(files),
+                'size': sum(entry.get('size', 0) for entry in files)
+            })
+        return snapshots
+
+    def snapshot(self, session_id, source_dir, previous: Optional[Dict] = None):
+        """ Crée un instantané de `source_dir` et retourne son manifeste. """
+        snapshot_dir = self.get_snapshot_dir(session_id)
+        with self.lock:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            manifests = load_manifests(snapshot_dir)
+            if previous is None and manifests:
+                previous = manifests[-1][1]
+            previous_files = previous['files'] if previous else {}
+
+            files, dirs = {}, []
+            for root, dir_names, file_names in os.walk(source_dir):
+                for name in dir_names:
+                    path = os.path.join(root, name)
+                    if not os.path.islink(path):
+                        dirs.append(os.path.relpath(path, source_dir))
+                for name in file_names + [name for name in dir_names if os.path.islink(os.path.join(root, name))]:
+                    path = os.path.join(root, name)
+                    relative_path = os.path.relpath(path, source_dir)
+                    file_stat = os.lstat(path)
+                    if stat.S_ISLNK(file_stat.st_mode):
+                        files[relative_path] = {'symlink': os.readlink(path)}
+                        continue
+                    if not stat.S_ISREG(file_stat.st_mode):
+                        continue
+                    entry = {
+                        'size': file_stat.st_size,
+                        'mtime_ns': file_stat.st_mtime_ns,
+                        'mode': stat.S_IMODE(file_stat.st_mode)
+                    }
+                    sha = None
+                    if file_stat.st_nlink > 1:
+                        # Fichier déjà lié à un objet par un instantané précédent
+                        sha = self.known_inodes.get((file_stat.st_dev, file_stat.st_ino))
+                    previous_entry = previous_files.get(relative_path)
+                    if previous_entry and 'sha256' in previous_entry \
+                            and previous_entry['size'] == entry['size'] \
+                            and previous_entry['mtime_ns'] == entry['mtime_ns'] \
+                            and os.path.exists(self.get_object_path(previous_entry['sha256'])):
+                        sha = previous_entry['sha256']
+                    entry['sha256'] = self.store_file(path, sha=sha)
+                    # Les instantanés suivants reconnaîtront l'objet par son inode sans relire le fichier
+                    self.known_inodes[(file_stat.st_dev, file_stat.st_ino)] = entry['sha256']
+                    files[relative_path] = entry
+
+            index = get_manifest_index(os.path.basename(manifests[-1][0])) + 1 if manifests else 1
+            manifest = {
+                'id': index,
+                'session': session_id,
+                'created': time.time(),
+                'dirs': sorted(dirs),
+                'files': files
+            }
+            write_json_atomically(os.path.join(snapshot_dir, f'snapshot_{index}.json'), manifest)
+            return manifest
+
+    def snapshot_and_remove(self, session_id, work_dir) -> Optional[Future]:
+        """
+        Vide `work_dir` immédiatement et en crée l'instantané en arrière-plan.
+        Le répertoire est renommé (opération instantanée) puis recréé vide ; l'instantané est pris sur la copie
+        renommée, qui est ensuite supprimée. Retourne un Future terminé avec le manifeste.
+        """
+        if not os.path.exists(work_dir):
+            return None
+        trash_dir = os.path.join(self.cache_dir, f'trash_{session_id}_{next(self.trash_counter)}')
+        while os.path.exists(trash_dir):
+            trash_dir = os.path.join(self.cache_dir, f'trash_{session_id}_{next(self.trash_counter)}')
+        os.rename(work_dir, trash_dir)
+        os.makedirs(work_dir)
+        return self.executor.submit(self._snapshot_trash_dir, session_id, trash_dir)
+
+    def _snapshot_trash_dir(self, session_id, trash_dir):
+        try:
+            return self.snapshot(session_id, trash_dir)
+        finally:
+            shutil.rmtree(trash_dir, ignore_errors=True)
+
+    def restore(self, session_id, snapshot_id, target_dir):
+        """
+        Restaure l'instantané `snapshot_id` dans `target_dir`.
+        Les fichiers sont copiés (et non liés) pour que les objets du magasin ne soient jamais modifiés ; les
+        fichiers de `target_dir` qui ne font pas partie de l'instantané sont conservés.
+        """
+        path = os.path.join(self.get_snapshot_dir(session_id), f'snapshot_{snapshot_id}.json')
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'Instantané introuvable: {snapshot_id}')
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        with self.lock:
+            for relative_path in manifest['dirs']:
+                os.makedirs(os.path.join(target_dir, relative_path), exist_ok=True)
+            for relative_path, entry in manifest['files'].items():
+                target_path = os.path.join(target_dir, relative_path)
+                os.makedirs(os.path.dirname(target_path) or '.', exist_ok=True)
+                if os.path.isdir(target_path) and not os.path.islink(target_path):
+                    shutil.rmtree(target_path)
+                elif os.path.lexists(target_path):
+                    os.remove(target_path)
+                if 'symlink' in entry:
+                    os.symlink(entry['symlink'], target_path)
+                    continue
+                shutil.copyfile(self.get_object_path(entry['sha256']), target_path)
+                os.chmod(target_path, entry['mode'])
+                os.utime(target_path, ns=(entry['mtime_ns'], entry['mtime_ns']))
+        return manifest
+
+    def collect_garbage(self):
+        """
+        Supprime les objets qui ne sont plus référencés par aucun manifeste ni lié dans un répertoire de travail.
+        Retourne les octets libérés.
+        """
+        with self.lock:
+            referenced = set()
+            try:
+                names = os.listdir(self.cache_dir)
+            except OSError:
+                return 0
+            for name in names:
+                if name.startswith('snapshots_'):
+                    for _, manifest in load_manifests(os.path.join(self.cache_dir, name)):
+                        referenced.update(
+                            entry['sha256'] for entry in manifest['files'].values() if 'sha256' in entry
+                        )
+
+            freed_bytes = 0
+            if not os.path.isdir(self.objects_dir):
+                return 0
+            for prefix in os.listdir(self.objects_dir):
+                prefix_dir = os.path.join(self.objects_dir, prefix)
+                if not os.path.isdir(prefix_dir):
+                    continue
+                for sha in os.listdir(prefix_dir):
+                    if sha in referenced or sha.endswith('.tmp'):
+                        continue
+                    path = os.path.join(prefix_dir, sha)
+                    try:
+                        object_stat = os.lstat(path)
+                        if object_stat.st_nlink > 1:
+                            continue
+                        os.remove(path)
+                        self.known_inodes.pop((object_stat.st_dev, object_stat.st_ino), None)
+                        freed_bytes += object_stat.st_size
+                    except OSError:
+                        continue
+                if not os.listdir(prefix_dir):
+                    os.rmdir(prefix_dir)
+            return freed_bytes
+
+
+_snapshot_store = None
+_snapshot_store_lock = threading.Lock()
+
+
+def get_snapshot_store():
+    global _snapshot_store
+    with _snapshot_store_lock:
+        if _snapshot_store is None:
+            _snapshot_store = SnapshotStore()
+        return _snapshot_store
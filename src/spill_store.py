@@ -0,0 +1,159 @@
+import array
+import os
+import shutil
+import threading
+from typing import *
+
+# Limite par défaut (en tokens) d'une sortie d'outil ajoutée à la conversation, pour un modèle absent de
+# "tool_output_max_tokens"
+DEFAULT_TOOL_OUTPUT_MAX_TOKENS = 500
+# Part de la limite accordée au début de la sortie, le reste allant à la fin
+HEAD_RATIO = 0.5
+# Nombre de lignes lues par défaut par l'outil read_output
+DEFAULT_READ_LINES = 200
+# Borne du nombre de caractères par token, pour éviter d'encoder une sortie manifestement trop longue
+MAX_CHARS_PER_TOKEN = 8
+
+
+class SpillStore:
+    """
+    Stockage sur disque des sorties d'outils trop longues pour la conversation, dans cache/spill_<id>/.
+    Chaque sortie est écrite telle quelle dans <call_id>.txt, avec dans <call_id>.idx la position (en octets)
+    du début de chaque ligne : une plage de lignes se lit sans parcourir le fichier.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.next_call_id = 1
+        self.lock = threading.Lock()
+
+    def get_paths(self, call_id):
+        return os.path.join(self.directory, f'{call_id}.txt'), os.path.join(self.directory, f'{call_id}.idx')
+
+    def store(self, text: str):
+        """ Enregistre une sortie et retourne son identifiant. """
+        data = text.encode('utf-8')
+        offsets = array.array('Q', [0])
+        position = data.find(b'\n')
+        while position != -1:
+            offsets.append(position + 1)
+            position = data.find(b'\n', position + 1)
+        if offsets[-1] != len(data):
+            offsets.append(len(data))
+
+        with self.lock:
+            call_id = self.next_call_id
+            self.next_call_id += 1
+        os.makedirs(self.directory, exist_ok=True)
+        text_path, index_path = self.get_paths(call_id)
+        with open(text_path, 'wb') as f:
+            f.write(data)
+        with open(index_path, 'wb') as f:
+            offsets.tofile(f)
+        return call_id
+
+    def _load_offsets(self, call_id):
+        _, index_path = self.get_paths(call_id)
+        offsets = array.array('Q')
+        with open(index_path, 'rb') as f:
+            offsets.frombytes(f.read())
+        return offsets
+
+    def get_line_count(self, call_id):
+        _, index_path = self.get_paths(call_id)
+        return os.path.getsize(index_path) // array.array('Q').itemsize - 1
+
+    def read_lines(self, call_id, start_line, end_line) -> Tuple[List[str], int]:
+        """ Retourne les lignes start_line à end_line (numérotées à partir de 1, incluses) et le nombre total de lignes. """
+        offsets = self._load_offsets(call_id)
+        line_count = len(offsets) - 1
+        start_line = max(1, start_line)
+        end_line = min(line_count, end_line)
+        if start_line > end_line:
+            return [], line_count
+        text_path, _ = self.get_paths(call_id)
+        with open(text_path, 'rb') as f:
+            f.seek(offsets[start_line - 1])
+            data = f.read(offsets[end_line] - offsets[start_line - 1])
+        # Découpage sur '\n' seulement, comme l'index : splitlines() couperait aussi sur '\r' (barres de progression)
+        lines = data.decode('utf-8', errors='replace').split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        return lines, line_count
+
+    def clear(self):
+        """ Supprime les sorties enregistrées ; les identifiants ne sont pas réutilisés. """
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def get_tool_output_max_tokens(config: Dict, model_name):
+    limits = config.get('tool_output_max_tokens') or {}
+    return int(limits.get(model_name, limits.get('default', DEFAULT_TOOL_OUTPUT_MAX_TOKENS)))
+
+
+def exceeds_token_limit(encoder, text, max_tokens):
+    if len(text) <= max_tokens:
+        return False
+    if len(text) > max_tokens * MAX_CHARS_PER_TOKEN:
+        return True
+    return len(encoder.encode(text)) > max_tokens
+
+
+def get_head(encoder, text, max_tokens):
+    """ Début de `text` limité à max_tokens tokens, coupé en fin de ligne si possible. """
+    tokens = encoder.encode(text[:max_tokens * MAX_CHARS_PER_TOKEN])[:max_tokens]
+    head = encoder.decode(tokens)
+    if '\n' in head:
+        head = head[:head.rindex('\n') + 1]
+    return head
+
+
+def get_tail(encoder, text, max_tokens):
+    """ Fin de `text` limitée à max_tokens tokens, commençant en début de ligne si possible. """
+    tokens = encoder.encode(text[-max_tokens * MAX_CHARS_PER_TOKEN:])
+    tail = encoder.decode(tokens[-max_tokens:]) if tokens else ''
+    if '\n' in tail[:-1]:
+        tail = tail[tail.index('\n') + 1:]
+    return tail
+
+
+def get_prefix_length(count_tokens, text, max_tokens):
+    """ Nombre de caractères du plus long début de `text` qui tient dans max_tokens tokens. """
+    high = min(len(text), max_tokens * MAX_CHARS_PER_TOKEN)
+    if count_tokens(text[:high]) <= max_tokens:
+        return high
+    low = 0
+    while low < high - 1:
+        middle = (low + high) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle
+    return low
+
+
+def truncate_output(encoder, text, max_tokens, call_id, line_count):
+    """
+    Garde le début et la fin de la sortie dans la limite de max_tokens tokens et indique les lignes omises,
+    lisibles avec l'outil read_output.
+    """
+    head = get_head(encoder, text, int(max_tokens * HEAD_RATIO))
+    tail = get_tail(encoder, text, max_tokens - int(max_tokens * HEAD_RATIO))
+    # Le début (ou la fin) peut n'être qu'un morceau de la première (ou dernière) ligne, si elle est trop longue
+    head_cut = bool(head) and not head.endswith('\n')
+    tail_cut = bool(tail) and len(tail) < len(text) and text[-len(tail) - 1] != '\n'
+    first_omitted_line = head.count('\n') + 1
+    if tail_cut:
+        last_omitted_line = line_count
+    else:
+        last_omitted_line = line_count - tail.count('\n') - (0 if tail.endswith('\n') or not tail else 1)
+    last_omitted_line = max(first_omitted_line, last_omitted_line)
+    if first_omitted_line == last_omitted_line:
+        omitted = f'ligne {first_omitted_line} omise'
+    else:
+        omitted = f'lignes {first_omitted_line} à {last_omitted_line} omises'
+    if head_cut or tail_cut:
+        omitted += ' en tout ou en partie'
+    return f'{head}\n[La sortie est trop volumineuse : {omitted} sur {line_count}. La sortie complète peut être lue ' \
+           f'avec read_output(call_id={call_id}, start_line=..., end_line=...), et une ligne trop longue par ' \
+           f'morceaux avec start_char=....]\n{tail}'
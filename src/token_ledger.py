@@ -0,0 +1,121 @@
+import json
+import bisect
+import tiktoken
+from functools import lru_cache
+from typing import *
+
+# Surcoût fixe par message et par champ `name` (format ChatML utilisé par l'API)
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+# Tokens qui amorcent la réponse de l'assistant
+TOKENS_PER_REPLY = 3
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding_for_which_model):
+    """ Retourne l'encodeur tiktoken du modèle, mis en cache pour toute la durée du processus. """
+    try:
+        return tiktoken.encoding_for_model(encoding_for_which_model)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_text_tokens(encoder, text):
+    """ Compte les tokens d'une chaîne (les valeurs nulles comptent pour zéro). """
+    if not text:
+        return 0
+    return len(encoder.encode(text))
+
+
+def count_message_tokens(encoder, message: Dict):
+    """ Compte les tokens d'un message, y compris le rôle, le nom et le surcoût de formatage. """
+    nb_tokens = TOKENS_PER_MESSAGE
+    nb_tokens += count_text_tokens(encoder, message.get('role'))
+    nb_tokens += count_text_tokens(encoder, message.get('content'))
+    if message.get('name'):
+        nb_tokens += count_text_tokens(encoder, message['name']) + TOKENS_PER_NAME
+    return nb_tokens
+
+
+def count_functions_tokens(encoder, functions: Optional[List[Dict]]):
+    """ Compte les tokens du schéma des fonctions envoyé avec chaque requête. """
+    if not functions:
+        return 0
+    return count_text_tokens(encoder, json.dumps(functions, ensure_ascii=False, separators=(',', ':')))
+
+
+class TokenLedger:
+    """
+    Registre des tokens d'une conversation.
+    Chaque message est compté une seule fois lors de son ajout et les sommes préfixes permettent
+    de trouver le point de coupe de la conversation par recherche dichotomique.
+    """
+    def __init__(self, encoding_for_which_model, functions: Optional[List[Dict]] = None):
+        self.encoding_for_which_model = encoding_for_which_model
+        self.encoder = get_encoder(encoding_for_which_model)
+        self.functions = functions
+        self.functions_tokens = count_functions_tokens(self.encoder, functions)
+        self.messages: List[Dict] = []
+        self.message_tokens: List[int] = []
+        self.prefix_sums: List[int] = [0]
+
+    def __len__(self):
+        return len(self.message_tokens)
+
+    def append(self, message: Dict):
+        """ Compte un nouveau message et met à jour les sommes préfixes. """
+        nb_tokens = count_message_tokens(self.encoder, message)
+        self.messages.append(message)
+        self.message_tokens.append(nb_tokens)
+        self.prefix_sums.append(self.prefix_sums[-1] + nb_tokens)
+        return nb_tokens
+
+    def pop(self):
+        """ Retire le dernier message compté. """
+        self.messages.pop()
+        self.prefix_sums.pop()
+        return self.message_tokens.pop()
+
+    def clear(self):
+        """ Vide le registre. """
+        self.messages.clear()
+        self.message_tokens.clear()
+        del self.prefix_sums[1:]
+
+    def set_encoding_model(self, encoding_for_which_model):
+        """ Change de modèle d'encodage ; les messages ne sont recomptés que si l'encodeur change réellement. """
+        encoder = get_encoder(encoding_for_which_model)
+        self.encoding_for_which_model = encoding_for_which_model
+        if encoder is self.encoder:
+            return
+        self.encoder = encoder
+        self.functions_tokens = count_functions_tokens(self.encoder, self.functions)
+        messages = list(self.messages)
+        self.clear()
+        for message in messages:
+            self.append(message)
+
+    def count_tokens(self, text):
+        """ Compte les tokens d'une chaîne avec l'encodeur courant. """
+        return count_text_tokens(self.encoder, text)
+
+    def count_message(self, message: Dict):
+        """ Compte les tokens d'un message sans l'ajouter au registre. """
+        return count_message_tokens(self.encoder, message)
+
+    def total(self):
+        """ Nombre total de tokens des messages comptés. """
+        return self.prefix_sums[-1]
+
+    def suffix_tokens(self, start):
+        """ Nombre de tokens des messages à partir de l'indice `start`. """
+        return self.prefix_sums[-1] - self.prefix_sums[start]
+
+    def find_cut_index(self, budget, lo=1):
+        """
+        Retourne le plus petit indice i >= lo tel que les messages [i:] tiennent dans `budget` tokens.
+        Retourne len(self) si même le dernier message ne tient pas.
+        """
+        target = self.prefix_sums[-1] - budget
+        index = bisect.bisect_left(self.prefix_sums, target, lo, len(self.prefix_sums))
+        return min(index, len(self.message_tokens))
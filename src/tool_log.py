@@ -0,0 +1,211 @@
+import argparse
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import weakref
+from typing import *
+
+# Valeurs par défaut de la section "tool_log" du fichier de configuration
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+DEFAULT_COMPRESS = True
+
+
+class ToolLogWriter:
+    """
+    Écrivain d'arrière-plan partagé par toutes les sessions.
+    Les enregistrements sont sérialisés et écrits par un thread dédié : l'appel d'outil ne paie que le coût
+    d'une mise en file. Chaque fichier est renouvelé (rotation) lorsqu'il dépasse max_bytes, les anciens
+    fichiers étant éventuellement compressés en gzip ; le premier enregistrement d'un nouveau fichier contient
+    la conversation complète.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT, compress=DEFAULT_COMPRESS):
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.records = queue.Queue()
+        self.file_sizes = {}
+        self.conversations = {}
+        self.thread = threading.Thread(target=self._run, name='tool-log-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, path, record: Dict):
+        self.records.put((path, record))
+
+    def release(self, path):
+        """ Oublie l'état d'un journal (session terminée ou journal supprimé), après ses écritures en attente. """
+        self.records.put((path, None))
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.records.get()
+            if item is None:
+                return
+            path, record = item
+            if record is None:
+                self.conversations.pop(path, None)
+                self.file_sizes.pop(path, None)
+                continue
+            try:
+                self._write_record(path, record)
+            except Exception as e:
+                print(f'Erreur lors de l\'écriture du journal des outils: {e}')
+
+    def _write_record(self, path, record: Dict):
+        # État courant de chaque conversation (références vers les mêmes messages), pour que chaque nouveau
+        # fichier commence par un point de reprise complet et reste rejouable après la rotation
+        conversation = self.conversations.setdefault(path, [])
+        del conversation[record['base_length']:]
+        conversation.extend(record['messages'])
+
+        data = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        size = self.file_sizes.get(path)
+        if size is None:
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+        if self.max_bytes and size and size + len(data) > self.max_bytes:
+            self._rotate(path)
+            size = 0
+        if size == 0 and record['base_length'] > 0:
+            record = dict(record, base_length=0, messages=conversation, checkpoint=True)
+            data = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with open(path, 'ab') as log_file:
+            log_file.write(data)
+        self.file_sizes[path] = size + len(data)
+
+    def _rotate(self, path):
+        suffix = '.gz' if self.compress else ''
+        for index in range(self.backup_count, 0, -1):
+            for candidate_suffix in ('', '.gz'):
+                source = f'{path}.{index}{candidate_suffix}'
+                if not os.path.exists(source):
+                    continue
+                if index == self.backup_count:
+                    os.remove(source)
+                else:
+                    os.replace(source, f'{path}.{index + 1}{candidate_suffix}')
+        if self.backup_count <= 0:
+            os.remove(path)
+            return
+        os.replace(path, f'{path}.1')
+        if suffix:
+            with open(f'{path}.1', 'rb') as source, gzip.open(f'{path}.1.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(f'{path}.1')
+
+
+_tool_log_writer = None
+_tool_log_writer_lock = threading.Lock()
+
+
+def get_tool_log_writer(tool_log_config: Optional[Dict] = None):
+    """ Retourne l'écrivain de journal partagé, créé au premier appel à partir de la section "tool_log". """
+    global _tool_log_writer
+    with _tool_log_writer_lock:
+        if _tool_log_writer is None:
+            tool_log_config = tool_log_config or {}
+            _tool_log_writer = ToolLogWriter(
+                max_bytes=int(tool_log_config.get('max_bytes', DEFAULT_MAX_BYTES)),
+                backup_count=int(tool_log_config.get('backup_count', DEFAULT_BACKUP_COUNT)),
+                compress=bool(tool_log_config.get('compress', DEFAULT_COMPRESS))
+            )
+        return _tool_log_writer
+
+
+class ToolLog:
+    """
+    Journal JSONL des appels d'outils d'une session.
+    Chaque enregistrement ne contient que les messages ajoutés à la conversation depuis l'enregistrement
+    précédent, avec l'indice `base_length` à partir duquel ils s'insèrent : replay_conversation() peut ainsi
+    reconstruire l'état de la conversation à n'importe quel appel.
+    """
+    def __init__(self, path, session_id, writer: ToolLogWriter):
+        self.path = path
+        self.session_id = session_id
+        self.writer = writer
+        self.seq = 0
+        self.logged_length = 0
+        # L'écrivain garde une copie de la conversation pour les points de reprise : libérée avec la session
+        weakref.finalize(self, writer.release, path)
+
+    def truncate(self, length):
+        """ Signale que la conversation a été raccourcie à `length` messages (redémarrage, annulation). """
+        self.logged_length = min(self.logged_length, length)
+
+    def record_tool_call(self, conversation: List[Dict], model_choice, tool_name, parameters: str,
+                         response: Optional[str], duration: Optional[float]):
+        self.seq += 1
+        base_length = min(self.logged_length, len(conversation))
+        record = {
+            'seq': self.seq,
+            'time': time.time(),
+            'session': self.session_id,
+            'model': model_choice,
+            'tool': tool_name,
+            'duration': duration,
+            'parameters_size': len(parameters),
+            'response_size': None if response is None else len(response),
+            'base_length': base_length,
+            # Les messages ne sont plus modifiés une fois ajoutés : la copie superficielle suffit
+            'messages': conversation[base_length:]
+        }
+        self.logged_length = len(conversation)
+        self.writer.write(self.path, record)
+
+
+def get_tool_log_files(path):
+    """ Liste les fichiers du journal, du plus ancien (rotation la plus ancienne) au plus récent. """
+    files = []
+    index = 1
+    while True:
+        candidates = [f'{path}.{index}', f'{path}.{index}.gz']
+        existing = [candidate for candidate in candidates if os.path.exists(candidate)]
+        if not existing:
+            break
+        files.append(existing[0])
+        index += 1
+    files.reverse()
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_tool_log_records(path):
+    """ Itère sur les enregistrements du journal dans l'ordre chronologique. """
+    for file_path in get_tool_log_files(path):
+        opener = gzip.open if file_path.endswith('.gz') else open
+        with opener(file_path, 'rt', encoding='utf-8') as log_file:
+            for line in log_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def replay_conversation(path, until_seq=None):
+    """
+    Reconstruit la conversation telle qu'elle était après l'appel d'outil numéro `until_seq`
+    (après le dernier appel si None).
+    """
+    conversation = []
+    for record in read_tool_log_records(path):
+        if until_seq is not None and record['seq'] > until_seq:
+            break
+        del conversation[record['base_length']:]
+        conversation.extend(record['messages'])
+    return conversation
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Reconstruit une conversation à partir d'un journal d'outils.")
+    parser.add_argument("path", help="chemin du journal (cache/tool_<id>.jsonl)", type=str)
+    parser.add_argument("-s", "--seq", help="numéro de l'appel d'outil jusqu'auquel rejouer", default=None, type=int)
+    cli_args = parser.parse_args()
+    print(json.dumps(replay_conversation(cli_args.path, until_seq=cli_args.seq), ensure_ascii=False, indent=2))
@@ -2,9 +2,15 @@ import openai
 import base64
 import os
 import io
-import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
 from PIL import Image
 from abc import ABCMeta, abstractmethod
+from image_utils import get_image_size_from_file, save_image_bytes
+from tracing import traced
+from spill_store import DEFAULT_READ_LINES, MAX_CHARS_PER_TOKEN, get_prefix_length
 
 # Créer une interaction pour un modèle de vision par ordinateur, prenant en compte une image en base64 et une requête textuelle
 def create_vision_chat_completion(vision_model, base64_image, prompt):
@@ -43,24 +49,143 @@ def create_image(prompt):
     except:
         return None
 
-# Convertir une image sur disque en chaîne base64
-def image_to_base64(path):
+# Résolution utile pour le modèle de vision : l'image est ramenée dans un carré de 2048 px puis son petit côté
+# à 768 px, les pixels supplémentaires étant ignorés par le modèle
+DEFAULT_VISION_MAX_LONG_SIDE = 2048
+DEFAULT_VISION_MAX_SHORT_SIDE = 768
+DEFAULT_VISION_JPEG_QUALITY = 85
+DEFAULT_VISION_CACHE_MB = 64
+VISION_IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.gif')
+
+
+def get_vision_target_size(width, height, max_long_side=DEFAULT_VISION_MAX_LONG_SIDE,
+                           max_short_side=DEFAULT_VISION_MAX_SHORT_SIDE):
+    """ Dimensions de l'image envoyée au modèle de vision (jamais agrandie). """
+    scale = min(1.0, max_long_side / max(width, height), max_short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Convertir une image sur disque en chaîne base64, redimensionnée et recompressée en JPEG
+@traced('image.encode')
+def image_to_base64(path, max_long_side=DEFAULT_VISION_MAX_LONG_SIDE, max_short_side=DEFAULT_VISION_MAX_SHORT_SIDE,
+                    jpeg_quality=DEFAULT_VISION_JPEG_QUALITY):
     try:
-        _, suffix = os.path.splitext(path)
-        if suffix not in {'.jpg', '.jpeg', '.png', '.webp'}:
-            img = Image.open(path)
-            img_png = img.convert('RGB')
-            img_png.tobytes()
-            byte_buffer = io.BytesIO()
-            img_png.save(byte_buffer, 'PNG')
-            encoded_string = base64.b64encode(byte_buffer.getvalue()).decode('utf-8')
-        else:
+        size = get_image_size_from_file(path)
+        if size is not None and path.lower().endswith(('.jpg', '.jpeg')) \
+                and get_vision_target_size(*size, max_long_side, max_short_side) == size:
+            # JPEG déjà à la bonne taille : envoyé tel quel
             with open(path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-        return encoded_string
+                return base64.b64encode(image_file.read()).decode('utf-8')
+
+        with Image.open(path) as img:
+            target_size = get_vision_target_size(*img.size, max_long_side, max_short_side)
+            # Pour un JPEG, le décodeur peut réduire l'image directement (bien plus rapide qu'un décodage complet)
+            img.draft('RGB', target_size)
+            if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+                rgba = img.convert('RGBA')
+                img_rgb = Image.new('RGB', rgba.size, (255, 255, 255))
+                img_rgb.paste(rgba, mask=rgba.split()[-1])
+            else:
+                img_rgb = img.convert('RGB')
+            if img_rgb.size != target_size:
+                img_rgb = img_rgb.resize(target_size, Image.LANCZOS)
+            byte_buffer = io.BytesIO()
+            img_rgb.save(byte_buffer, 'JPEG', quality=jpeg_quality)
+        return base64.b64encode(byte_buffer.getvalue()).decode('utf-8')
     except:
         return None
 
+
+class ImageEncodingCache:
+    """
+    Cache LRU des images encodées pour le modèle de vision.
+    La clé est (chemin, date de modification, taille du fichier, résolution cible) : une image modifiée est
+    réencodée. Les encodages s'exécutent dans un pool de threads ; un encodage en cours est partagé par les
+    demandes concurrentes, ce qui permet de le lancer dès le téléversement (prefetch).
+    """
+    def __init__(self, max_bytes=DEFAULT_VISION_CACHE_MB * 1024 * 1024, max_long_side=DEFAULT_VISION_MAX_LONG_SIDE,
+                 max_short_side=DEFAULT_VISION_MAX_SHORT_SIDE, jpeg_quality=DEFAULT_VISION_JPEG_QUALITY, max_workers=2):
+        self.max_bytes = max_bytes
+        self.max_long_side = max_long_side
+        self.max_short_side = max_short_side
+        self.jpeg_quality = jpeg_quality
+        self.entries: OrderedDict = OrderedDict()
+        self.current_bytes = 0
+        self.pending: Dict[Tuple, Future] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-encoder')
+        self.hits = 0
+        self.misses = 0
+
+    def _get_key(self, path):
+        file_stat = os.stat(path)
+        return os.path.realpath(path), file_stat.st_mtime_ns, file_stat.st_size, self.max_long_side, \
+            self.max_short_side
+
+    def submit(self, path) -> Future:
+        """ Retourne un Future de l'image encodée en base64 (None si l'image ne peut pas être lue). """
+        try:
+            key = self._get_key(path)
+        except OSError:
+            future = Future()
+            future.set_result(None)
+            return future
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                future = Future()
+                future.set_result(self.entries[key])
+                return future
+            future = self.pending.get(key)
+            if future is not None:
+                self.hits += 1
+                return future
+            self.misses += 1
+            future = self.executor.submit(
+                image_to_base64, path, self.max_long_side, self.max_short_side, self.jpeg_quality
+            )
+            self.pending[key] = future
+        future.add_done_callback(lambda done: self._store(key, done))
+        return future
+
+    def _store(self, key, future: Future):
+        encoded_string = None if future.exception() else future.result()
+        with self.lock:
+            self.pending.pop(key, None)
+            if encoded_string is None or len(encoded_string) > self.max_bytes:
+                return
+            self.entries[key] = encoded_string
+            self.current_bytes += len(encoded_string)
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def encode(self, path):
+        return self.submit(path).result()
+
+    def prefetch(self, path):
+        self.submit(path)
+
+
+_image_encoding_cache = None
+_image_encoding_cache_lock = threading.Lock()
+
+
+def get_image_encoding_cache(vision_image_config: Optional[Dict] = None):
+    """ Retourne le cache d'encodage partagé, créé au premier appel à partir de la section "vision_image". """
+    global _image_encoding_cache
+    with _image_encoding_cache_lock:
+        if _image_encoding_cache is None:
+            vision_image_config = vision_image_config or {}
+            _image_encoding_cache = ImageEncodingCache(
+                max_bytes=int(vision_image_config.get('cache_mb', DEFAULT_VISION_CACHE_MB) * 1024 * 1024),
+                max_long_side=int(vision_image_config.get('max_long_side', DEFAULT_VISION_MAX_LONG_SIDE)),
+                max_short_side=int(vision_image_config.get('max_short_side', DEFAULT_VISION_MAX_SHORT_SIDE)),
+                jpeg_quality=int(vision_image_config.get('jpeg_quality', DEFAULT_VISION_JPEG_QUALITY))
+            )
+        return _image_encoding_cache
+
 # Convertir une chaîne base64 en bytes d'image
 def base64_to_image_bytes(image_base64):
     try:
@@ -69,8 +194,8 @@ def base64_to_image_bytes(image_base64):
         return None
 
 # Interroger un modèle de vision sur le contenu d'une image et afficher la réponse
-def inquire_image(work_dir, vision_model, path, prompt):
-    image_base64 = image_to_base64(f'{work_dir}/{path}')
+def inquire_image(work_dir, vision_model, path, prompt, vision_image_config=None):
+    image_base64 = get_image_encoding_cache(vision_image_config).encode(f'{work_dir}/{path}')
     hypertext_to_display = None
     if image_base64 is None:
         return "Erreur: Erreur de générartion d'image", None
@@ -93,17 +218,54 @@ def dalle(unique_id, prompt):
     if img_bytes is None:
         return "Erreur: Erreur de générartion d'image", None
 
-    temp_path = f'cache/temp_{unique_id}'
-    if not os.path.exists(temp_path):
-        os.mkdir(temp_path)
-    path = f'{temp_path}/{hash(time.time())}.png'
-
-    with open(path, 'wb') as f:
-        f.write(img_bytes)
+    path, write_future = save_image_bytes(f'cache/temp_{unique_id}', img_bytes, 'png')
+    write_future.result()
 
     hypertext_to_display = f'<img src=\"file={path}\" width="50%" style=\'max-width:none; max-height:none\'>'
     return text_to_gpt, hypertext_to_display
 
+# Lire une plage de lignes d'une sortie d'outil tronquée dans la conversation
+def read_output(spill_store, get_max_tokens, count_tokens, call_id, start_line=1, end_line=None, start_char=0):
+    start_line = max(1, int(start_line))
+    end_line = int(end_line) if end_line is not None else start_line + DEFAULT_READ_LINES - 1
+    start_char = max(0, int(start_char))
+    try:
+        lines, line_count = spill_store.read_lines(int(call_id), start_line, end_line)
+    except (OSError, ValueError):
+        return f"Erreur: aucune sortie enregistrée avec call_id={call_id}", None
+    if not lines:
+        return f"Aucune ligne entre {start_line} et {end_line} : la sortie {call_id} compte {line_count} lignes.", None
+    if start_char >= len(lines[0]) > 0:
+        return f"La ligne {start_line} de la sortie {call_id} ne compte que {len(lines[0])} caractères.", None
+    lines[0] = lines[0][start_char:]
+
+    # Les lignes sont rendues dans la limite de tokens des sorties d'outils du modèle courant ; une ligne qui ne
+    # tient pas dans la place restante est coupée et se poursuit avec start_char
+    max_tokens = get_max_tokens()
+    selected, nb_tokens, next_char = [], 0, None
+    for line in lines:
+        line_tokens = count_tokens(line) + 1 if len(line) <= max_tokens * MAX_CHARS_PER_TOKEN else None
+        if line_tokens is not None and nb_tokens + line_tokens <= max_tokens:
+            selected.append(line)
+            nb_tokens += line_tokens
+            continue
+        if not selected:
+            next_char = max(1, get_prefix_length(count_tokens, line, max(0, max_tokens - 1)))
+            selected.append(line[:next_char])
+            next_char += start_char
+        break
+    last_line = start_line + len(selected) - 1
+    header = f"[Sortie {call_id} : lignes {start_line} à {last_line} sur {line_count}"
+    if start_char:
+        header += f", à partir du caractère {start_char} de la ligne {start_line}"
+    text_to_gpt = header + "]\n" + '\n'.join(selected)
+    if next_char is not None:
+        text_to_gpt += f"\n[Limite de tokens atteinte : ligne {last_line} coupée, reprendre avec " \
+                       f"start_line={last_line}, start_char={next_char}]"
+    elif last_line < min(end_line, line_count):
+        text_to_gpt += f"\n[Limite de tokens atteinte : reprendre avec start_line={last_line + 1}]"
+    return text_to_gpt, None
+
 # Classe abstraite pour les outils utilisant des modèles d'IA
 class Tool(metaclass=ABCMeta):
     def __init__(self, config):
@@ -147,7 +309,8 @@ class ImageInquireTool(Tool):
             },
             "additional_parameters": {
                 "work_dir": lambda bot_backend: bot_backend.jupyter_work_dir,
-                "vision_model": self.config['model']['GPT-4V']['model_name']
+                "vision_model": self.config['model']['GPT-4V']['model_name'],
+                "vision_image_config": self.config.get('vision_image')
             }
         }
 
@@ -180,9 +343,52 @@ class DALLETool(Tool):
             }
         }
 
+# Outil pour relire les sorties volumineuses conservées hors de la conversation
+class ReadOutputTool(Tool):
+    def support(self):
+        return True
+
+    def get_tool_data(self):
+        return {
+            "tool_name": "read_output",
+            "tool": read_output,
+            "system_prompt": "Les sorties de code trop volumineuses sont tronquées dans la conversation, mais conservées en entier. Utilisez l'outil `read_output` avec le `call_id` indiqué pour lire les lignes omises au lieu de réexécuter le code.",
+            "tool_description": {
+                "name": "read_output",
+                "description": "Cette fonction retourne une plage de lignes d'une sortie d'outil tronquée dans la conversation.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "call_id": {
+                            "type": "integer",
+                            "description": "Identifiant de la sortie, indiqué dans le message de troncature"
+                        },
+                        "start_line": {
+                            "type": "integer",
+                            "description": "Première ligne à lire (numérotée à partir de 1)"
+                        },
+                        "end_line": {
+                            "type": "integer",
+                            "description": "Dernière ligne à lire, incluse"
+                        },
+                        "start_char": {
+                            "type": "integer",
+                            "description": "Position (en caractères) à partir de laquelle lire la première ligne, pour reprendre une ligne coupée"
+                        }
+                    },
+                    "required": ["call_id"]
+                }
+            },
+            "additional_parameters": {
+                "spill_store": lambda bot_backend: bot_backend.spill_store,
+                "get_max_tokens": lambda bot_backend: bot_backend.get_tool_output_max_tokens,
+                "count_tokens": lambda bot_backend: bot_backend.count_tokens
+            }
+        }
+
 # Récupérer les outils disponibles selon la configuration
 def get_available_tools(config):
-    tools = [ImageInquireTool]
+    tools = [ImageInquireTool, ReadOutputTool]
 
     available_tools = []
     for tool in tools:
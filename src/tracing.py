@@ -0,0 +1,375 @@
+import atexit
+import bisect
+import contextvars
+import functools
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+# Valeurs par défaut de la section "tracing" du fichier de configuration
+DEFAULT_ENABLED = False
+DEFAULT_TRACE_FILE = 'cache/traces.jsonl'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_METRICS_PORT = 9464
+# Bornes supérieures (en secondes) des classes des histogrammes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+METRICS_PREFIX = 'agentllm'
+# Labels transmis par un span à ses enfants : l'exécution du code hérite ainsi du modèle du tour
+INHERITED_LABELS = ('model', 'tool')
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_span_ids = itertools.count(1)
+
+
+class NullSpan:
+    """ Span sans effet retourné lorsque le traçage est désactivé : aucune mesure, aucune allocation. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_label(self, key, value):
+        pass
+
+    def end(self):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    Intervalle de temps mesuré d'une étape (stage), rattaché au span courant du contexte.
+    Utilisé avec `with`, il devient le span courant de son bloc ; sinon il est terminé par end(), ce qui permet
+    de mesurer une étape qui traverse des `yield` sans modifier le contexte de l'appelant.
+    """
+    __slots__ = ('tracer', 'name', 'span_id', 'trace_id', 'parent_id', 'labels', 'export',
+                 'start_time', 'start_counter', 'duration', 'token')
+
+    def __init__(self, tracer, name, parent: Optional['Span'], labels: Dict, export=True):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = next(_span_ids)
+        if parent is not None:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            for key in INHERITED_LABELS:
+                if key in parent.labels:
+                    labels.setdefault(key, parent.labels[key])
+        else:
+            self.trace_id = self.span_id
+            self.parent_id = None
+        self.labels = labels
+        self.export = export
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+        self.duration = None
+        self.token = None
+
+    def set_label(self, key, value):
+        self.labels[key] = value
+
+    def end(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start_counter
+            self.tracer.finish(self)
+
+    def __enter__(self):
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_span.reset(self.token)
+        if exc_type is not None:
+            self.labels['error'] = exc_type.__name__
+        self.end()
+        return False
+
+    def to_record(self):
+        return {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': self.start_time,
+            'duration': self.duration,
+            'labels': self.labels
+        }
+
+
+class SpanActivation:
+    """ Rend un span existant courant le temps d'un bloc, sans le terminer. """
+    __slots__ = ('span', 'token')
+
+    def __init__(self, span: Span):
+        self.span = span
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current_span.reset(self.token)
+        return False
+
+
+class Histogram:
+    __slots__ = ('bucket_counts', 'sum', 'count')
+
+    def __init__(self, bucket_count):
+        self.bucket_counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: Iterable[Tuple[str, Any]]):
+    return ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels)
+
+
+class MetricsRegistry:
+    """
+    Histogrammes des durées par étape, modèle et outil, et jauges lues à la demande (get_metrics des
+    composants partagés), exposés au format texte de Prometheus.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.histograms: Dict[Tuple[str, str, str], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, model, tool, value):
+        key = (stage, model, tool)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(len(self.buckets))
+            histogram.bucket_counts[bucket_index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    def render(self):
+        lines = []
+        name = f'{METRICS_PREFIX}_stage_duration_seconds'
+        lines.append(f'# HELP {name} Durée des étapes du traitement d\'un tour.')
+        lines.append(f'# TYPE {name} histogram')
+        with self.lock:
+            histograms = [(key, list(h.bucket_counts), h.sum, h.count) for key, h in sorted(self.histograms.items())]
+        for (stage, model, tool), bucket_counts, total, count in histograms:
+            labels = [('stage', stage), ('model', model), ('tool', tool)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{format_labels(labels + [("le", repr(float(bound)))])}}} {cumulative}')
+            lines.append(f'{name}_bucket{{{format_labels(labels + [("le", "+Inf")])}}} {count}')
+            lines.append(f'{name}_sum{{{format_labels(labels)}}} {total}')
+            lines.append(f'{name}_count{{{format_labels(labels)}}} {count}')
+
+        for prefix, collector in list(_gauge_collectors.items()):
+            try:
+                metrics = collector()
+            except Exception:
+                continue
+            for metric_name, value in metrics.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                gauge_name = f'{METRICS_PREFIX}_{prefix}_{metric_name}'
+                lines.append(f'# TYPE {gauge_name} gauge')
+                lines.append(f'{gauge_name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+    """
+    Destination des spans terminés : chaque durée alimente l'histogramme de son étape et, si un fichier de
+    traces est configuré, le span est écrit en JSONL par un thread dédié (l'appelant ne paie qu'une mise en file).
+    """
+    def __init__(self, enabled=DEFAULT_ENABLED, trace_file: Optional[str] = DEFAULT_TRACE_FILE,
+                 buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.trace_file = trace_file
+        self.metrics = MetricsRegistry(buckets=buckets)
+        self.records = queue.Queue()
+        self.thread = None
+        if self.enabled and self.trace_file:
+            self.thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def finish(self, span: Span):
+        self.metrics.observe(span.name, span.labels.get('model', ''), span.labels.get('tool', ''), span.duration)
+        if span.export and self.thread is not None:
+            self.records.put(span)
+
+    def close(self):
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            spans = [self.records.get()]
+            # Les spans en attente sont écrits en une seule fois
+            while True:
+                try:
+                    spans.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            closed = None in spans
+            try:
+                self._write_spans([span for span in spans if span is not None])
+            except Exception as e:
+                print(f'Erreur lors de l\'écriture des traces: {e}')
+            if closed:
+                return
+
+    def _write_spans(self, spans: List[Span]):
+        if not spans:
+            return
+        directory = os.path.dirname(self.trace_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.trace_file, 'a', encoding='utf-8') as trace_file:
+            for span in spans:
+                trace_file.write(json.dumps(span.to_record(), ensure_ascii=False, default=str) + '\n')
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """ Sert GET /metrics au format texte de Prometheus. """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.tracer.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tracer: Tracer, host=DEFAULT_METRICS_HOST, port=DEFAULT_METRICS_PORT):
+        super().__init__((host, port), MetricsRequestHandler)
+        self.tracer = tracer
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='metrics-server', daemon=True)
+        self.thread.start()
+        return self
+
+
+_tracer: Optional[Tracer] = None
+_metrics_server: Optional[MetricsServer] = None
+_tracer_lock = threading.Lock()
+_gauge_collectors: Dict[str, Callable[[], Dict]] = {}
+
+
+def get_tracer(tracing_config: Optional[Dict] = None):
+    """
+    Retourne le traceur du processus, créé au premier appel à partir de la section "tracing".
+    Le point d'accès /metrics est démarré si metrics_port est défini.
+    """
+    global _tracer, _metrics_server
+    with _tracer_lock:
+        if _tracer is None:
+            tracing_config = tracing_config or {}
+            _tracer = Tracer(
+                enabled=bool(tracing_config.get('enabled', DEFAULT_ENABLED)),
+                trace_file=tracing_config.get('trace_file', DEFAULT_TRACE_FILE),
+                buckets=tracing_config.get('buckets', DEFAULT_BUCKETS)
+            )
+            metrics_port = tracing_config.get('metrics_port', DEFAULT_METRICS_PORT)
+            if _tracer.enabled and metrics_port is not None:
+                try:
+                    _metrics_server = MetricsServer(
+                        _tracer, host=tracing_config.get('metrics_host', DEFAULT_METRICS_HOST), port=int(metrics_port)
+                    ).start()
+                except OSError as e:
+                    print(f'Impossible de démarrer le point d\'accès des métriques: {e}')
+        return _tracer
+
+
+def register_gauges(prefix, collector: Callable[[], Dict]):
+    """ Publie les valeurs numériques retournées par collector() comme jauges <prefix>_<nom>. """
+    _gauge_collectors[prefix] = collector
+
+
+def span(name, export=True, parent=None, **labels):
+    """
+    Crée un span pour l'étape `name`, enfant de `parent` ou, à défaut, du span courant.
+    Retourne NULL_SPAN lorsque le traçage est désactivé. export=False limite le span aux histogrammes (étapes
+    très fréquentes, comme l'analyse de chaque chunk).
+    """
+    tracer = _tracer
+    if tracer is None or not tracer.enabled:
+        return NULL_SPAN
+    if not isinstance(parent, Span):
+        parent = _current_span.get()
+    return Span(tracer, name, parent, labels, export=export)
+
+
+def use_span(existing_span):
+    """ Rend `existing_span` courant le temps d'un bloc `with`. """
+    if existing_span is NULL_SPAN:
+        return NULL_SPAN
+    return SpanActivation(existing_span)
+
+
+def iterate_in_span(async_iterable: AsyncIterable, existing_span):
+    """
+    Itère sur un générateur asynchrone en rendant `existing_span` courant pendant le calcul de chaque élément
+    seulement : le contexte de l'appelant n'est jamais modifié à travers un `yield`.
+    """
+    if existing_span is NULL_SPAN:
+        return async_iterable
+    return _iterate_in_span(async_iterable, existing_span)
+
+
+async def _iterate_in_span(async_iterable: AsyncIterable, existing_span: Span):
+    iterator = async_iterable.__aiter__()
+    try:
+        while True:
+            with SpanActivation(existing_span):
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield item
+    finally:
+        if hasattr(iterator, 'aclose'):
+            await iterator.aclose()
+
+
+def traced(name, **labels):
+    """ Décorateur mesurant chaque appel de la fonction comme un span `name`. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None or not tracer.enabled:
+                return function(*args, **kwargs)
+            with Span(tracer, name, _current_span.get(), dict(labels)):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,5 +1,7 @@
 import gradio as gr
+import time
 from response_parser import *
+from tracing import use_span, iterate_in_span
 
 # Initialisation du dictionnaire d'état et du cache si nécessaire
 def initialization(state_dict: Dict) -> None:
@@ -81,9 +83,17 @@ def refresh_file_display(state_dict: Dict) -> List[str]:
             paths.append(path)
     return paths
 
+# Export du notebook Jupyter de la session
+def export_notebook(state_dict: Dict) -> List[str]:
+    bot_backend = get_bot_backend(state_dict)
+    notebook_path = bot_backend.export_notebook()
+    return refresh_file_display(state_dict) + [notebook_path]
+
 # Actualisation du compteur de tokens
 def refresh_token_count(state_dict: Dict):
     bot_backend = get_bot_backend(state_dict)
+    if bot_backend is None:
+        return gr.Markdown.update()
     model_choice = bot_backend.gpt_model_choice
     sliced = bot_backend.sliced
     token_count = bot_backend.context_window_tokens
@@ -91,6 +101,14 @@ def refresh_token_count(state_dict: Dict):
     display_text = f"**Contexte de tokens:** {token_count}/{token_limit}"
     if sliced:
         display_text += '\\\nLimite de tokens dépassée, la conversion a été segmentée.'
+    usage = bot_backend.jupyter_kernel.get_usage()
+    if bot_backend.hibernated:
+        display_text += "\\\n**Noyau:** en veille, redémarré au prochain message"
+    elif usage is not None:
+        display_text += f"\\\n**Noyau:** mémoire {usage['rss_bytes'] / (1024 * 1024):.0f} Mo"
+        if usage['memory_limit_bytes']:
+            display_text += f"/{usage['memory_limit_bytes'] / (1024 * 1024):.0f} Mo"
+        display_text += f", CPU {usage['cpu_seconds']:.1f} s ({usage['cpu_percent']:.0f} %)"
     return gr.Markdown.update(value=display_text)
 
 # Redémarrage de l'interface utilisateur
@@ -119,62 +137,220 @@ def stop_generating(state_dict: Dict) -> None:
     else:
         bot_backend.update_stop_generating_state(stop_generating=True)
 
-# Gestion des interactions et des réponses du bot
-def bot(state_dict: Dict, history: List) -> List:
-    bot_backend = get_bot_backend(state_dict)
+class UIFrameLimiter:
+    """
+    Limite le nombre de trames envoyées au navigateur : une trame au plus par intervalle, les trames
+    intermédiaires étant fusionnées (seule la dernière est affichée). Les trames forcées (appel de fonction,
+    début et fin d'exécution du code, fin de réponse) sont toujours envoyées immédiatement.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_frame_time = 0.0
+        self.pending_frame = None
+
+    def push(self, frame, force=False):
+        """ Retourne la trame à envoyer maintenant, ou None si elle est retenue jusqu'à la fin de l'intervalle. """
+        now = time.monotonic()
+        if force or now - self.last_frame_time >= self.interval:
+            self.pending_frame = None
+            self.last_frame_time = now
+            return frame
+        self.pending_frame = frame
+        return None
+
+    def flush(self):
+        """ Retourne la trame retenue (None s'il n'y en a pas). """
+        frame, self.pending_frame = self.pending_frame, None
+        if frame is not None:
+            self.last_frame_time = time.monotonic()
+        return frame
+
+    def get_delay(self):
+        """ Délai avant qu'une trame non forcée puisse être envoyée (0 si elle peut l'être maintenant). """
+        return max(0.0, self.last_frame_time + self.interval - time.monotonic())
+
+    def get_timeout(self):
+        """ Délai avant l'envoi de la trame retenue, None s'il n'y en a pas. """
+        if self.pending_frame is None:
+            return None
+        return self.get_delay()
+
+
+async def iterate_with_timeout(async_iterable, get_timeout):
+    """
+    Itère sur `async_iterable` en produisant None chaque fois qu'aucun élément n'arrive avant get_timeout()
+    secondes : une trame retenue est ainsi affichée même si le flux marque une pause.
+    """
+    iterator = async_iterable.__aiter__()
+    next_item = None
+    try:
+        while True:
+            timeout = get_timeout()
+            if next_item is None and timeout is None:
+                # Aucune trame en attente : l'élément suivant est attendu directement, sans tâche intermédiaire
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            else:
+                if next_item is None:
+                    next_item = asyncio.ensure_future(iterator.__anext__())
+                if not (await asyncio.wait({next_item}, timeout=timeout))[0]:
+                    yield None
+                    continue
+                item_future, next_item = next_item, None
+                try:
+                    item = item_future.result()
+                except StopAsyncIteration:
+                    return
+            yield item
+    finally:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
+            # Le générateur doit avoir fini de traiter l'annulation avant d'être fermé
+            await asyncio.wait({next_item})
+        # Fermeture explicite : les blocs finally du flux (spans, exécution du code) s'exécutent dès maintenant
+        # plutôt qu'au passage du ramasse-miettes
+        aclose = getattr(iterator, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+def get_turn_frame(bot_backend: BotBackend, history: List) -> Tuple:
+    """ Trame (historique et boutons) à afficher pendant un tour. """
+    if bot_backend.code_executing:
+        return history, gr.Button.update(value='⏹️ Interrupt execution'), gr.Button.update(visible=False)
+    return (
+        history,
+        gr.Button.update(interactive=False if bot_backend.stop_generating else True, value='⏹️ Arrêter la génération'),
+        gr.Button.update(visible=False)
+    )
 
-    while bot_backend.finish_reason in ('new_input', 'function_call'):
-        if history[-1][1]:
-            history.append([None, ""])
-        else:
-            history[-1][1] = ""
-
-        try:
-            response = chat_completion(bot_backend=bot_backend)
-            for chunk in response:
-                if chunk['choices'] and chunk['choices'][0]['finish_reason'] == 'function_call':
-                    if bot_backend.function_name in bot_backend.jupyter_kernel.available_functions:
-                        yield history, gr.Button.update(value='⏹️ Interrupt execution'), gr.Button.update(visible=False)
-                    else:
-                        yield history, gr.Button.update(interactive=False), gr.Button.update(visible=False)
-
-                if bot_backend.stop_generating:
-                    response.close()
-                    if bot_backend.content:
-                        bot_backend.add_gpt_response_content_message()
-                    if bot_backend.display_code_block:
-                        bot_backend.update_display_code_block(
-                            display_code_block="\n⚫Arrêté:\n```python\n{}\n```".format(bot_backend.code_str)
-                        )
-                        history = copy.deepcopy(bot_backend.bot_history)
-                        history[-1][1] += bot_backend.display_code_block
-                        bot_backend.add_function_call_response_message(function_response=None)
-
-                    bot_backend.reset_gpt_response_log_values()
-                    break
-
-                history, whether_exit = parse_response(
-                    chunk=chunk,
-                    history=history,
-                    bot_backend=bot_backend
-                )
-
-                yield (
-                    history,
-                    gr.Button.update(
-                        interactive=False if bot_backend.stop_generating else True,
-                        value='⏹️ Arrêter la génération'
-                    ),
-                    gr.Button.update(visible=False)
-                )
-                if whether_exit:
-                    exit(-1)
-        except openai.OpenAIError as openai_error:
-            bot_backend.reset_gpt_response_log_values(exclude=['finish_reason'])
-            yield history, gr.Button.update(interactive=False), gr.Button.update(visible=True)
-            raise openai_error
-
-    yield history, gr.Button.update(interactive=False, value='⏹️ Arrêter la génération'), gr.Button.update(visible=False)
+
+# Gestion des interactions et des réponses du bot (générateur asynchrone : les conversations en attente de
+# l'API ou du noyau partagent la boucle d'événements au lieu d'occuper chacune un thread)
+async def bot(state_dict: Dict, history: List) -> AsyncGenerator:
+    bot_backend = get_bot_backend(state_dict)
+    # Le bouton de réessai lance un tour sans nouveau message : une session mise en veille doit aussi être réveillée
+    # ici, sinon le code s'exécuterait sur un noyau arrêté
+    await asyncio.to_thread(bot_backend.wake_up)
+    # Les chunks sont fusionnés en trames d'au plus une par intervalle : Gradio renvoie tout l'historique à chaque trame
+    frame_limiter = UIFrameLimiter(interval=bot_backend.config.get('ui_frame_interval_ms', 50) / 1000)
+
+    # Les étapes du tour (troncature, requête, analyse, exécution) sont rattachées à ce span
+    turn_span = span('turn', model=bot_backend.config['model'][bot_backend.gpt_model_choice]['model_name'])
+    try:
+        while bot_backend.finish_reason in ('new_input', 'function_call'):
+            if history[-1][1]:
+                history.append([None, ""])
+            else:
+                history[-1][1] = ""
+
+            try:
+                first_chunk_span = span('chat_completion.first_chunk', parent=turn_span)
+                with use_span(turn_span):
+                    response = await async_chat_completion(bot_backend=bot_backend)
+                dispatcher = ChunkDispatcher(bot_backend=bot_backend)
+                # Les chunks qui ne terminent pas la réponse sont accumulés jusqu'à la trame suivante puis traités
+                # ensemble par dispatch_batch, qui fusionne les deltas de texte ; seul le chunk final passe par
+                # dispatch_async_stream, qui affiche l'exécution du code au fur et à mesure
+                pending_chunks = []
+                whether_exit = False
+
+                def get_timeout():
+                    return frame_limiter.get_delay() if pending_chunks else frame_limiter.get_timeout()
+
+                def dispatch_pending_chunks():
+                    with use_span(turn_span):
+                        state = dispatcher.dispatch_batch(pending_chunks, history=history)
+                    pending_chunks.clear()
+                    return state
+
+                async for chunk in iterate_with_timeout(response, get_timeout):
+                    if chunk is None:
+                        if pending_chunks:
+                            history, whether_exit = dispatch_pending_chunks()
+                            yield frame_limiter.push(get_turn_frame(bot_backend, history), force=True)
+                            if whether_exit:
+                                exit(-1)
+                        else:
+                            yield frame_limiter.flush()
+                        continue
+                    first_chunk_span.end()
+                    finished = bool(chunk['choices']) and chunk['choices'][0]['finish_reason'] is not None
+
+                    if not finished and not bot_backend.stop_generating:
+                        pending_chunks.append(chunk)
+                        if frame_limiter.get_delay() == 0:
+                            history, whether_exit = dispatch_pending_chunks()
+                            yield frame_limiter.push(get_turn_frame(bot_backend, history), force=whether_exit)
+                            if whether_exit:
+                                exit(-1)
+                        continue
+                    if pending_chunks:
+                        history, whether_exit = dispatch_pending_chunks()
+                        if whether_exit:
+                            yield frame_limiter.push(get_turn_frame(bot_backend, history), force=True)
+                            exit(-1)
+
+                    if chunk['choices'] and chunk['choices'][0]['finish_reason'] == 'function_call':
+                        if bot_backend.function_name in bot_backend.jupyter_kernel.available_functions:
+                            yield frame_limiter.push(
+                                (history, gr.Button.update(value='⏹️ Interrupt execution'), gr.Button.update(visible=False)),
+                                force=True
+                            )
+                        else:
+                            yield frame_limiter.push(
+                                (history, gr.Button.update(interactive=False), gr.Button.update(visible=False)),
+                                force=True
+                            )
+
+                    if bot_backend.stop_generating:
+                        await response.aclose()
+                        if bot_backend.content:
+                            bot_backend.add_gpt_response_content_message()
+                        if bot_backend.display_code_block:
+                            bot_backend.update_display_code_block(
+                                display_code_block="\n⚫Arrêté:\n```python\n{}\n```".format(bot_backend.code_str)
+                            )
+                            history = bot_backend.render_bot_history()
+                            bot_backend.add_function_call_response_message(function_response=None)
+
+                        bot_backend.reset_gpt_response_log_values()
+                        break
+
+                    # La sortie du code est affichée au fur et à mesure de son exécution
+                    code_executing = bot_backend.code_executing
+                    async for state in iterate_with_timeout(
+                        iterate_in_span(dispatcher.dispatch_async_stream(chunk=chunk, history=history), turn_span),
+                        frame_limiter.get_timeout
+                    ):
+                        if state is None:
+                            yield frame_limiter.flush()
+                            continue
+                        history, whether_exit = state
+                        # Le début et la fin de l'exécution du code changent les boutons : la trame est forcée
+                        force = bot_backend.code_executing != code_executing or whether_exit
+                        code_executing = bot_backend.code_executing
+                        frame = frame_limiter.push(get_turn_frame(bot_backend, history), force=force)
+                        if frame is not None:
+                            yield frame
+                    if whether_exit:
+                        exit(-1)
+                # Flux terminé sans chunk final
+                if pending_chunks:
+                    history, whether_exit = dispatch_pending_chunks()
+                    yield frame_limiter.push(get_turn_frame(bot_backend, history), force=True)
+                    if whether_exit:
+                        exit(-1)
+            except openai.OpenAIError as openai_error:
+                bot_backend.reset_gpt_response_log_values(exclude=['finish_reason'])
+                yield history, gr.Button.update(interactive=False), gr.Button.update(visible=True)
+                raise openai_error
+
+        yield history, gr.Button.update(interactive=False, value='⏹️ Arrêter la génération'), gr.Button.update(visible=False)
+    finally:
+        turn_span.end()
 
 if __name__ == '__main__':
     config = get_config()
@@ -212,6 +388,7 @@ if __name__ == '__main__':
                     undo_file_button = gr.Button(value="↩️Annuler le téléchargement du fichier", interactive=False)
         with gr.Tab("Fichiers"):
             file_output = gr.Files()
+            export_notebook_button = gr.Button(value='📓 Exporter le notebook')
 
         # Liaison des fonctions aux composants
         txt_msg = text_box.submit(add_text, [state, chatbot, text_box], [chatbot, text_box], queue=False).then(
@@ -249,6 +426,8 @@ if __name__ == '__main__':
             fn=refresh_file_display, inputs=[state], outputs=[file_output]
         )
 
+        export_notebook_button.click(fn=export_notebook, inputs=[state], outputs=[file_output])
+
         stop_generation_button.click(fn=stop_generating, inputs=[state], queue=False).then(
             fn=lambda: gr.Button.update(interactive=False), inputs=None, outputs=[stop_generation_button], queue=False
         )
@@ -273,6 +452,11 @@ if __name__ == '__main__':
         )
 
         block.load(fn=initialization, inputs=[state])
+        # Actualisation périodique de l'utilisation des ressources du noyau
+        block.load(
+            fn=refresh_token_count, inputs=[state], outputs=[token_monitor],
+            every=config.get('kernel_limits', {}).get('ui_refresh_interval', 5)
+        )
 
     block.queue()
     block.launch(inbrowser=True)